@@ -175,7 +175,7 @@ def status():
 @json_api
 def delete():
     key = request.forms['key']
-    switch = Switch.remove(key=key)
+    switch = Switch.find_and_remove(key=key)
     log.info('Switch %r removed' % key)
     signals.switch_deleted.send(switch)
     return {}
@@ -6,11 +6,19 @@ switchboard.base
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
+import os
+import copy
 import time
+import uuid
 import logging
 import threading
+import weakref
+from datetime import timedelta
 
+from .helpers import utcnow
 from .models import MongoModel
+from .serialization import CompactCodec, get_codec
+from .snapshots import get_snapshot_file
 from .signals import request_finished
 from .settings import settings
 
@@ -20,20 +28,325 @@ log = logging.getLogger(__name__)
 NoValue = object()
 
 
+class CacheData(dict):
+    """
+    The data of a :class:`CachedDict`, along with the version of every key
+    that has been patched since the data was last loaded in full (see
+    :meth:`CachedDict.patch`). ``generation`` identifies that full load; data
+    from different generations can't be compared key by key. ``synced_at`` is
+    the (UTC) time the data was last read from the database, for delta sync.
+
+    Published data is never modified; patches make a copy. Values loaded
+    with a codec are decoded the first time they are accessed, and replace
+    their encoded form in place (which doesn't change the keys, so it's safe
+    while other threads are reading).
+    """
+    synced_at = None
+
+    def __init__(self, data=(), generation=None, versions=None,
+                 synced_at=None):
+        super().__init__(data)
+        self.generation = generation
+        self.versions = {} if versions is None else versions
+        self.synced_at = synced_at
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if type(value) is Encoded:
+            value = value.decode()
+            super().__setitem__(key, value)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def get_versions(self):
+        return (self.generation, self.versions)
+
+
+class Encoded:
+    """
+    A value of :class:`CacheData` that hasn't been decoded yet.
+    """
+    __slots__ = ('codec', 'payload')
+
+    def __init__(self, codec, payload):
+        self.codec = codec
+        self.payload = payload
+
+    def decode(self):
+        return self.codec.decode_item(self.payload)
+
+
+class SharedSnapshot:
+    """
+    The cache data of a shared :class:`CachedDict`, seen by every thread in
+    the process. Published data is never modified; a refresh replaces
+    ``state`` with a new ``(data, last_updated)`` tuple in a single
+    assignment, so readers need no locking and always see a matching pair.
+    """
+    def __init__(self):
+        self.state = (None, None)
+        # Held by whichever thread is refreshing the data.
+        self.lock = threading.Lock()
+        # The background Refresher keeping this snapshot current, if any.
+        self.refresher = None
+        # The background Watcher applying changes to it as they happen, if any.
+        self.watcher = None
+        # The background AutoCreator creating missing keys, if any.
+        self.auto_creator = None
+
+    def is_refreshed_in_background(self):
+        refresher = self.refresher
+        if refresher is not None and refresher.is_alive():
+            return True
+        watcher = self.watcher
+        return watcher is not None and watcher.is_alive() and watcher.watching
+
+
+class Refresher(threading.Thread):
+    """
+    Daemon thread that refreshes a shared :class:`CachedDict` every
+    ``interval`` seconds, so that request threads never have to.
+    """
+    def __init__(self, cached_dict, interval):
+        super().__init__(name='switchboard-refresher', daemon=True)
+        self.cached_dict = cached_dict
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.cached_dict.refresh()
+            except Exception:
+                log.exception('Unable to refresh the cache in the background')
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
+
+
+class Watcher(threading.Thread):
+    """
+    Daemon thread that applies changes from a change stream (see
+    :meth:`CachedDict._watch`) to a shared :class:`CachedDict` as they happen.
+    While the stream is open request threads don't poll for changes; when it
+    drops they go back to polling until it has been reopened, every
+    ``retry_interval`` seconds.
+    """
+    def __init__(self, cached_dict, retry_interval):
+        super().__init__(name='switchboard-watcher', daemon=True)
+        self.cached_dict = cached_dict
+        self.retry_interval = retry_interval
+        self.stopped = threading.Event()
+        self.watching = False
+        self.stream = None
+
+    def run(self):
+        resume_token = None
+        while not self.stopped.is_set():
+            opened = False
+            try:
+                with self.cached_dict._watch(resume_token) as stream:
+                    self.stream = stream
+                    opened = True
+                    if resume_token is None:
+                        # Whatever changed before the stream was opened.
+                        self.cached_dict._populate(reset=True)
+                    self.watching = True
+                    while stream.alive and not self.stopped.is_set():
+                        change = stream.try_next()
+                        if change is not None:
+                            self.cached_dict._apply_change(change)
+                        resume_token = stream.resume_token
+            except Exception:
+                if not self.stopped.is_set():
+                    log.exception('Unable to watch for changes, polling '
+                                  'until the change stream is reopened')
+                # Changes may have been missed if the stream couldn't be
+                # resumed, so start over with a full load.
+                if not opened:
+                    resume_token = None
+            finally:
+                self.watching = False
+                self.stream = None
+            self.stopped.wait(self.retry_interval)
+
+    def stop(self):
+        self.stopped.set()
+        stream = self.stream
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:  # pragma: nocover
+                pass
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
+
+
+class AutoCreator(threading.Thread):
+    """
+    Daemon thread that creates the instances for keys missing from a
+    :class:`MongoModelDict` (see :meth:`MongoModelDict.lookup`) in batches:
+    the keys queued within ``delay`` seconds of each other are created with
+    one bulk upsert and patched into the cache together.
+    """
+    def __init__(self, cached_dict, delay):
+        super().__init__(name='switchboard-auto-creator', daemon=True)
+        self.cached_dict = cached_dict
+        self.delay = delay
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.queued = threading.Event()
+        self.stopped = threading.Event()
+
+    def add(self, key):
+        with self.lock:
+            self.pending.add(key)
+        self.queued.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.queued.wait()
+            # Wait for the rest of the batch.
+            self.stopped.wait(self.delay)
+            self.flush()
+
+    def flush(self):
+        """
+        Creates the keys queued so far.
+        """
+        with self.lock:
+            keys, self.pending = self.pending, set()
+            self.queued.clear()
+        if not keys:
+            return
+        try:
+            self.cached_dict._create_missing(sorted(keys))
+        except Exception:
+            log.exception('Unable to create missing keys: %s', sorted(keys))
+
+    def stop(self):
+        self.stopped.set()
+        self.queued.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
+
+
+# Shared snapshots by CachedDict instance. A threading.local subclass has a
+# separate __dict__ per thread, so process-wide state has to live outside it.
+_snapshots = weakref.WeakKeyDictionary()
+_snapshots_lock = threading.Lock()
+
+
+def _after_fork():
+    """
+    Locks held by other threads at the time of a fork are never released in
+    the child and threads don't survive a fork at all, so forked children
+    (e.g. pre-fork server workers) get fresh locks, refreshers and watchers.
+    """
+    for cached_dict, snapshot in list(_snapshots.items()):
+        snapshot.lock = threading.Lock()
+        refresher = snapshot.refresher
+        if refresher is not None and not refresher.stopped.is_set():
+            snapshot.refresher = Refresher(cached_dict, refresher.interval)
+            snapshot.refresher.start()
+        watcher = snapshot.watcher
+        if watcher is not None and not watcher.stopped.is_set():
+            snapshot.watcher = Watcher(cached_dict, watcher.retry_interval)
+            snapshot.watcher.start()
+        # Started again on the next missing key.
+        snapshot.auto_creator = None
+
+
+if hasattr(os, 'register_at_fork'):  # pragma: nocover
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _is_versions(value):
+    # Versions are stored as a (generation, versions) pair; caches that
+    # don't pickle may hand back a list instead of a tuple.
+    return (isinstance(value, (tuple, list)) and len(value) == 2
+            and isinstance(value[1], dict))
+
+
 class CachedDict(threading.local):
-    def __init__(self, timeout=30):
+    #: Above this many changed keys, the data is reloaded in full rather than
+    #: fetching the changed keys one by one.
+    max_changes = 100
+    #: How many seconds delta sync looks back before the last sync, to allow
+    #: for clock skew between the processes making changes.
+    delta_overlap = 60
+    #: Encoded data larger than this many bytes is split across several cache
+    #: keys, to stay under memcache's item size limit (1MB by default).
+    chunk_size = 900 * 1024
+    #: Writes to the cache backend hold a lock (taken with the backend's
+    #: atomic ``add``) for at most this many seconds, so a crashed holder
+    #: doesn't block the others for good.
+    lock_timeout = 30
+    #: How many seconds a full reload waits for the lock before writing to the
+    #: cache backend regardless.
+    lock_wait = 1
+
+    def __init__(self, timeout=30, shared=None, delta_sync=None, codec=None,
+                 snapshot_file=None):
         """
         Not guaranteed to be called with expected c'tor args of
         all usages (due to usage of threading.local)
+
+        With ``shared=True`` all threads use a single copy of the cache data
+        and only one of them refreshes it when it expires, instead of each
+        thread loading and polling for its own copy. Defaults to the
+        ``SWITCHBOARD_SHARED_CACHE`` setting.
+
+        With ``delta_sync=True``, changes made elsewhere are picked up by
+        asking the database for just the keys changed since the data was last
+        synced, rather than reloading everything. Defaults to the
+        ``SWITCHBOARD_DELTA_SYNC`` setting.
+
+        With a ``codec`` (see :mod:`switchboard.serialization`), the data is
+        stored in the cache backend in the codec's format, split into chunks
+        if it's large, rather than pickled as a whole by the cache client.
+
+        With a ``snapshot_file`` (see :mod:`switchboard.snapshots`; defaults to
+        one at the ``SWITCHBOARD_SNAPSHOT_PATH`` setting), one process per host
+        loads the data and writes it to the file, and the others read it from
+        there.
         """
         cls_name = type(self).__name__
 
+        if shared is None:
+            shared = getattr(settings, 'SWITCHBOARD_SHARED_CACHE', False)
+        if delta_sync is None:
+            delta_sync = getattr(settings, 'SWITCHBOARD_DELTA_SYNC', False)
+        if snapshot_file is None:
+            path = getattr(settings, 'SWITCHBOARD_SNAPSHOT_PATH', None)
+            snapshot_file = get_snapshot_file(path) if path else None
+
         self._cache = None
         self._last_updated = None
         self.timeout = timeout
+        self.shared = shared
+        self.delta_sync = delta_sync
+        self.codec = codec
+        self.snapshot_file = snapshot_file
+        self._file_version = None
         self.cache = settings.SWITCHBOARD_CACHE
         self.cache_key = cls_name
         self.last_updated_cache_key = f'{cls_name}.last_updated'
+        self.versions_cache_key = f'{cls_name}.versions'
+        self.lock_cache_key = f'{cls_name}.lock'
 
     def __getitem__(self, key):
         self._populate()
@@ -157,14 +470,389 @@ class CachedDict(threading.local):
         """
         self._cache = None
         self._last_updated = None
+        if self.shared:
+            self._snapshot().state = (None, None)
+
+    def _snapshot(self):
+        """
+        Returns the :class:`SharedSnapshot` for this instance.
+        """
+        try:
+            return _snapshots[self]
+        except KeyError:
+            with _snapshots_lock:
+                return _snapshots.setdefault(self, SharedSnapshot())
+
+    def patch(self, key, value=NoValue, local=False):
+        """
+        Sets ``key`` to ``value`` (or removes it, if no value is given) in the
+        local data and in the cache backend, bumping the key's version so that
+        other processes fetch just this key (see :meth:`_get_changed_data`)
+        instead of reloading everything.
+
+        The cache backend's copy is read, patched and written back under the
+        cache lock (see :meth:`_acquire_lock`), so other keys are as fresh as
+        the cache backend's and never rolled back to this process's copy, and
+        concurrent patches from other processes aren't lost. Returns ``False``
+        if there was nothing to patch (no data loaded yet, it was reloaded in
+        full elsewhere, or the lock couldn't be taken), in which case the data
+        should be reset instead.
+        """
+        return self.patch_many({key: value}, local)
+
+    def patch_many(self, changes, local=False):
+        """
+        Same as :meth:`patch`, for a dict of keys to values (``NoValue``
+        removes a key), with a single update of the cache backend.
+        """
+        if not self.shared:
+            return self._patch(changes, local)
+        snapshot = self._snapshot()
+        with snapshot.lock:
+            self._cache, self._last_updated = snapshot.state
+            patched = self._patch(changes, local)
+            if patched:
+                snapshot.state = (self._cache, self._last_updated)
+        return patched
+
+    def _patch(self, changes, local=False):
+        if local or not self.cache:
+            data = self._cache
+            if not isinstance(data, CacheData):
+                return False
+            versions = data.versions
+        else:
+            if not self._acquire_lock():
+                return False
+            try:
+                return self._patch_global(changes)
+            finally:
+                self._release_lock()
+        return self._apply_patch(data, versions, changes, local)
+
+    def _patch_global(self, changes):
+        try:
+            remote = self.cache.get(self.versions_cache_key)
+            data = self._get_global_data()
+        except:  # pragma: nocover
+            log.exception('Unable to get the global cache to patch')
+            return False
+        if (not isinstance(data, CacheData)
+                or not _is_versions(remote)
+                or tuple(remote)[0] != data.generation):
+            return False
+        return self._apply_patch(data, tuple(remote)[1], changes, False)
+
+    def _apply_patch(self, data, versions, changes, local):
+        data = CacheData(data, data.generation, dict(versions),
+                         data.synced_at)
+        for key, value in changes.items():
+            data.versions[key] = versions.get(key, 0) + 1
+            if value is NoValue:
+                data.pop(key, None)
+            else:
+                data[key] = value
+        now = int(time.time())
+
+        if self.cache and not local:
+            try:
+                self._set_global_data(data)
+                self.cache.set(self.versions_cache_key, data.get_versions())
+                self.cache.set(self.last_updated_cache_key, now)
+            except:  # pragma: nocover
+                log.exception('Unable to patch the global cache')
+                return False
+            self._last_updated = now
+        self._cache = data
+        return True
+
+    def _fetch_changes(self):
+        """
+        Returns a copy of the local data with only the keys whose version
+        changed in the cache backend fetched again, or ``None`` if the data
+        has to be loaded in full instead.
+        """
+        local = self._cache
+        if not isinstance(local, CacheData) or local.generation is None:
+            return None
+        try:
+            remote = self.cache.get(self.versions_cache_key)
+        except:  # pragma: nocover
+            log.exception('Unable to get cache versions')
+            return None
+        if not _is_versions(remote) or tuple(remote)[0] != local.generation:
+            return None
+        versions = tuple(remote)[1]
+        changed = [k for k in set(versions) | set(local.versions)
+                   if versions.get(k) != local.versions.get(k)]
+        if len(changed) > self.max_changes:
+            return None
+        try:
+            values = self._get_changed_data(changed)
+        except:
+            log.exception('Unable to fetch changed cache data')
+            return None
+        if values is None:
+            return None
+        data = CacheData(local, local.generation, dict(versions),
+                         local.synced_at)
+        for key in changed:
+            if key in values:
+                data[key] = values[key]
+            else:
+                data.pop(key, None)
+        return data
+
+    def _fetch_delta(self):
+        """
+        Returns a copy of the local data with everything changed in the
+        database since it was last synced merged in, or ``None`` if the data
+        has to be loaded in full instead.
+        """
+        local = self._cache
+        if not isinstance(local, CacheData) or local.synced_at is None:
+            return None
+        synced_at = utcnow()
+        # Timestamps come from the clocks of whichever processes made the
+        # changes, so look back a little further to allow for clock skew.
+        since = local.synced_at - timedelta(seconds=self.delta_overlap)
+        try:
+            delta = self._get_delta(since)
+        except:
+            log.exception('Unable to fetch changes from the database')
+            return None
+        if delta is None:
+            return None
+        changed, deleted = delta
+        data = CacheData(local, local.generation, local.versions, synced_at)
+        # Anything that still exists was saved again after being deleted.
+        for key in deleted:
+            data.pop(key, None)
+        data.update(changed)
+        return data
+
+    def _get_delta(self, since):
+        """
+        Returns a tuple of (changed, deleted): a dict of the keys changed
+        after the ``since`` datetime with their values, and the keys deleted
+        after it. Returns ``None`` if delta sync isn't supported.
+        """
+        return None
+
+    def _get_changed_data(self, keys):
+        """
+        Returns the current values of ``keys``, leaving out the ones that no
+        longer exist, or ``None`` if fetching keys individually isn't
+        supported.
+        """
+        return None
 
     def _populate(self, reset=False):
         """
         Ensures the cache is populated and still valid.
+        """
+        snapshot_file = self.snapshot_file
+        if snapshot_file is not None and not reset:
+            data = self._populate_from_file(snapshot_file)
+            if data is not None:
+                return data
+        if self.shared:
+            data = self._populate_shared(reset)
+        else:
+            data = self._refresh(reset)
+        if snapshot_file is not None and snapshot_file.is_writer:
+            self._write_snapshot_file(data)
+        return data
+
+    def _populate_from_file(self, snapshot_file):
+        """
+        Returns the data from the snapshot file, or ``None`` if this process
+        has to load it itself: it's the writer, there is no snapshot yet, or
+        the writer hasn't kept it current for longer than the timeout. Readers
+        try to take over as the writer once per timeout, in case the writer
+        has gone away.
+        """
+        if snapshot_file.is_writer:
+            return None
+        expired = self.is_local_expired()
+        if expired:
+            self._last_updated = int(time.time())
+            if snapshot_file.acquire():
+                return None
+        age = snapshot_file.age()
+        if age is not None and age > self.timeout:
+            # The writer is idle or stuck; load the data as if there were no
+            # snapshot (refreshing it once per timeout) until it's back.
+            if expired or self._file_version is not None:
+                self._last_updated = None
+            self._file_version = None
+            return None
+        version = snapshot_file.version()
+        if version and version == self._file_version:
+            # May have been patched since.
+            return self._cache
+        version, data = snapshot_file.read(self._get_file_codec(),
+                                           self._wrap_encoded)
+        if data is None:
+            return None
+        self._cache = data
+        self._file_version = version
+        return data
+
+    def _write_snapshot_file(self, data):
+        snapshot_file = self.snapshot_file
+        if data is None:
+            return
+        if data is snapshot_file.written:
+            snapshot_file.touch()
+            return
+        codec = self._get_file_codec()
+        try:
+            snapshot_file.write(codec, self._encode_items(data, codec),
+                                getattr(data, 'generation', None),
+                                getattr(data, 'versions', None),
+                                getattr(data, 'synced_at', None))
+        except:
+            log.exception('Unable to write the snapshot file')
+        else:
+            snapshot_file.written = data
+
+    def publish_snapshot_file(self):
+        """
+        Loads the data and writes it to the snapshot file, without becoming
+        the elected writer; e.g. from the master process of a pre-fork server
+        before the workers are forked, so that they start with a snapshot.
+        """
+        if self.shared:
+            data = self._populate_shared()
+        else:
+            data = self._refresh()
+        self._write_snapshot_file(data)
+
+    def _get_file_codec(self):
+        """
+        Returns the codec for the snapshot file.
+        """
+        return self.codec
+
+    def _populate_shared(self, reset=False):
+        """
+        Same as ``_refresh``, but using the process-wide snapshot. The
+        snapshot is only refreshed by one thread at a time; while it is,
+        other threads carry on with the data they already have.
+        """
+        snapshot = self._snapshot()
+        self._cache, self._last_updated = snapshot.state
+        if not reset and self._cache is not None:
+            if (snapshot.is_refreshed_in_background()
+                    or not self.is_local_expired()):
+                return self._cache
+            if not snapshot.lock.acquire(blocking=False):
+                # Someone else is already refreshing; serve what we have.
+                return self._cache
+        else:
+            snapshot.lock.acquire()
+        try:
+            # Pick up anything published while we were waiting for the lock.
+            self._cache, self._last_updated = snapshot.state
+            if reset or self._cache is None or self.is_local_expired():
+                self._refresh(reset)
+                snapshot.state = (self._cache, self._last_updated)
+        finally:
+            snapshot.lock.release()
+        return self._cache
+
+    def refresh(self):
+        """
+        Checks the cache backend for changes and refreshes the shared
+        snapshot straight away, regardless of the timeout.
+        """
+        snapshot = self._snapshot()
+        with snapshot.lock:
+            self._cache, self._last_updated = snapshot.state
+            self._refresh(force=True)
+            snapshot.state = (self._cache, self._last_updated)
+        snapshot_file = self.snapshot_file
+        if snapshot_file is not None and snapshot_file.is_writer:
+            self._write_snapshot_file(self._cache)
+
+    def start_refresher(self, interval=None):
+        """
+        Starts a background thread that calls :meth:`refresh` every
+        ``interval`` seconds (the timeout by default). While it runs, request
+        threads always use the current snapshot without refreshing it
+        themselves, so data is at most ``interval`` seconds (plus the time a
+        refresh takes) out of date. Requires shared mode.
+        """
+        if not self.shared:
+            raise ValueError('The background refresher requires a shared '
+                             'cache (shared=True).')
+        self.stop_refresher()
+        snapshot = self._snapshot()
+        try:
+            self.refresh()
+        except Exception:
+            log.exception('Unable to prime the cache for the refresher')
+        snapshot.refresher = Refresher(self, interval or self.timeout)
+        snapshot.refresher.start()
+
+    def start_watcher(self, retry_interval=None):
+        """
+        Starts a background thread that applies changes to the shared
+        snapshot as they are made (see :meth:`_watch`), so request threads
+        stop polling for them. If the change stream drops, polling resumes
+        until it is reopened, which is retried every ``retry_interval``
+        seconds (the timeout by default). Requires shared mode.
+        """
+        if not self.shared:
+            raise ValueError('The watcher requires a shared cache '
+                             '(shared=True).')
+        self.stop_watcher()
+        snapshot = self._snapshot()
+        snapshot.watcher = Watcher(self, retry_interval or self.timeout)
+        snapshot.watcher.start()
+
+    def stop_watcher(self):
+        """
+        Stops the watcher, if one is running; request threads go back to
+        polling for changes.
+        """
+        snapshot = self._snapshot()
+        watcher, snapshot.watcher = snapshot.watcher, None
+        if watcher is not None:
+            watcher.stop()
+
+    def _watch(self, resume_token=None):
+        """
+        Returns a change stream (as returned by PyMongo's
+        ``Collection.watch``) of changes to the data, resuming after
+        ``resume_token`` if given.
+        """
+        raise NotImplementedError  # pragma: nocover
+
+    def _apply_change(self, change):
+        """
+        Applies a change from the change stream to the local data.
+        """
+        raise NotImplementedError  # pragma: nocover
+
+    def stop_refresher(self):
+        """
+        Stops the background refresher, if one is running; request threads
+        go back to refreshing expired data themselves.
+        """
+        snapshot = self._snapshot()
+        refresher, snapshot.refresher = snapshot.refresher, None
+        if refresher is not None:
+            refresher.stop()
+
+    def _refresh(self, reset=False, force=False):
+        """
+        Ensures the local cache is populated and still valid.
 
         The cache is checked when:
 
-        - The local timeout has been reached
+        - The local timeout has been reached (or ``force`` is set)
         - The local cache is not set
 
         The cache is invalid when:
@@ -174,8 +862,15 @@ class CachedDict(threading.local):
         if reset:
             self._cache = None
         elif not self.cache:
-            self._cache = None
-        elif self.is_local_expired():
+            # Without a cache backend the data is read from the database every
+            # time; with delta sync, only what changed is.
+            if self.delta_sync:
+                self._cache = self._fetch_delta()
+            else:
+                self._cache = None
+            if self._cache is not None:
+                self._last_updated = int(time.time())
+        elif force or self.is_local_expired():
             now = int(time.time())
             # Avoid hitting memcache if we don't have a local cache.
             if self._cache is None:
@@ -183,11 +878,21 @@ class CachedDict(threading.local):
             else:
                 global_changed = self.has_global_changed()
 
+            # Only some keys changed since the local cache was loaded.
+            if global_changed and self._cache is not None:
+                if self.delta_sync:
+                    changes = self._fetch_delta()
+                else:
+                    changes = self._fetch_changes()
+                if changes is not None:
+                    self._cache = changes
+                    global_changed = False
+
             # If the cache is expired globally, or local cache isn't present.
             if global_changed or self._cache is None:
                 # The value may or may not exist in the cache.
                 try:
-                    self._cache = self.cache.get(self.cache_key)
+                    self._cache = self._get_global_data()
                     assert isinstance(self._cache, dict)
                 except:
                     self._cache = None
@@ -216,19 +921,134 @@ class CachedDict(threading.local):
 
         return self._cache
 
+    def _acquire_lock(self, wait=0):
+        """
+        Takes the lock that serializes writes to the cache backend, retrying
+        for up to ``wait`` seconds. Returns ``False`` if the lock is held
+        elsewhere or the cache backend has no atomic ``add``.
+        """
+        add = getattr(self.cache, 'add', None)
+        if add is None:
+            return False
+        deadline = time.monotonic() + wait
+        while True:
+            try:
+                if add(self.lock_cache_key, os.getpid(), self.lock_timeout):
+                    return True
+            except:  # pragma: nocover
+                log.exception('Unable to take the cache lock')
+                return False
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+
+    def _release_lock(self):
+        try:
+            self.cache.delete(self.lock_cache_key)
+        except:  # pragma: nocover
+            log.exception('Unable to release the cache lock')
+
     def _update_cache_data(self):
-        self._cache = self.get_cache_data()
+        if not self.cache:
+            self._load_cache_data()
+            return
+        # Loaded under the lock, so that patches made after the load aren't
+        # overwritten with data from before them.
+        locked = self._acquire_lock(self.lock_wait)
+        try:
+            self._load_cache_data()
+        finally:
+            if locked:
+                self._release_lock()
+
+    def _load_cache_data(self):
+        # A full load starts a new generation of versions.
+        synced_at = utcnow()
+        self._cache = CacheData(self.get_cache_data(), uuid.uuid4().hex,
+                                synced_at=synced_at)
         self._last_updated = int(time.time())
         # We only set last_updated_cache_key when we know the cache is current
         # because setting this will force all clients to invalidate their
         # cached data if it's newer
         if self.cache:
             try:
-                self.cache.set(self.cache_key, self._cache)
+                self._set_global_data(self._cache)
+                self.cache.set(self.versions_cache_key,
+                               self._cache.get_versions())
                 self.cache.set(self.last_updated_cache_key, self._last_updated)
             except:  # pragma: nocover
                 log.exception('Unable to refresh global cache from database')
 
+    def _get_global_data(self):
+        """
+        Returns the data stored in the cache backend, or ``None``.
+        """
+        value = self.cache.get(self.cache_key)
+        if self.codec is None or not value:
+            return value
+        if (isinstance(value, (tuple, list)) and len(value) == 3
+                and value[0] == 'chunks'):
+            _, token, count = value
+            chunks = [self.cache.get(f'{self.cache_key}:{token}:{n}')
+                      for n in range(count)]
+            if any(chunk is None for chunk in chunks):
+                # Evicted, or replaced while we were reading it.
+                return None
+            value = b''.join(chunks)
+        if not isinstance(value, bytes):
+            return None
+        decoded = self.codec.decode(value)
+        if decoded is None:
+            return None
+        return self._wrap_encoded(*decoded)
+
+    def _wrap_encoded(self, items, generation, versions, synced_at):
+        codec = self._get_file_codec()
+        return CacheData({k: Encoded(codec, v) for k, v in items.items()},
+                         generation, versions, synced_at)
+
+    def _encode_items(self, data, codec):
+        """
+        Returns a dict of ``data``'s values encoded with ``codec``, reusing
+        values that haven't been decoded yet.
+        """
+        items = {}
+        for key in data:
+            value = dict.__getitem__(data, key)
+            if type(value) is Encoded and value.codec is codec:
+                items[key] = bytes(value.payload)
+            else:
+                items[key] = codec.encode_item(value)
+        return items
+
+    def _set_global_data(self, data):
+        """
+        Stores data in the cache backend. Encoded data too large for a single
+        item is split into chunks under keys unique to this write, so readers
+        never mix chunks of different writes; the header under ``cache_key``
+        is written last. Chunks of replaced data are left for the cache to
+        evict.
+        """
+        codec = self.codec
+        if codec is None:
+            self.cache.set(self.cache_key, data)
+            return
+        items = self._encode_items(data, codec)
+        payload = codec.encode(items, getattr(data, 'generation', None),
+                               getattr(data, 'versions', None),
+                               getattr(data, 'synced_at', None))
+        size = self.chunk_size
+        if len(payload) <= size:
+            self.cache.set(self.cache_key, payload)
+            return
+        token = uuid.uuid4().hex
+        count = 0
+        for start in range(0, len(payload), size):
+            self.cache.set(f'{self.cache_key}:{token}:{count}',
+                           payload[start:start + size])
+            count += 1
+        self.cache.set(self.cache_key, ('chunks', token, count))
+
     def _get_cache_data(self):
         raise NotImplementedError  # pragma: nocover
 
@@ -267,11 +1087,24 @@ class MongoModelDict(CachedDict):
         >>> 'test' #doctest: +SKIP
 
     """
+    #: How many seconds the background creation of missing keys waits for
+    #: more of them, to create them together.
+    auto_create_delay = 1
+
     def __init__(self, model, key='pk', value=None,
                  auto_create=False, *args, **kwargs):
         assert value is not None
 
+        async_auto_create = kwargs.pop('async_auto_create', None)
+        if async_auto_create is None:
+            async_auto_create = getattr(
+                settings, 'SWITCHBOARD_ASYNC_AUTO_CREATE', False)
+
+        if kwargs.get('codec') is None:
+            kwargs['codec'] = getattr(settings, 'SWITCHBOARD_CACHE_CODEC', None)
+        kwargs['codec'] = get_codec(kwargs['codec'], model)
         super().__init__(*args, **kwargs)
+        self._file_codec = CompactCodec(model, fields=())
 
         cls_name = type(self).__name__
         name = model.__name__
@@ -281,14 +1114,20 @@ class MongoModelDict(CachedDict):
 
         self.model = model
         self.auto_create = auto_create
+        self.async_auto_create = async_auto_create
+        # Unsaved instances for missing keys, for as long as the data is
+        # the data they were missing from.
+        self._missing = (None, {})
 
         self.cache_key = f'{cls_name}:{name}:{self.key}'
         self.last_updated_cache_key = '{}.last_updated:{}:{}'.format(cls_name,
                                                                  name,
                                                                  self.key)
+        self.versions_cache_key = f'{cls_name}.versions:{name}:{self.key}'
         request_finished.connect(self._cleanup)
         MongoModel.post_save.connect(self._post_save)
         MongoModel.post_delete.connect(self._post_delete)
+        MongoModel.post_save_many.connect(self._post_save_many)
 
     def __setitem__(self, key, value):
         if isinstance(value, self.model):
@@ -305,7 +1144,7 @@ class MongoModelDict(CachedDict):
             self.model.update({self.key: key}, {'$set': {self.value: value}})
 
     def __delitem__(self, key):
-        self.model.remove(**{self.key: key})
+        self.model.find_and_remove(**{self.key: key})
 
     def setdefault(self, key, value):
         if isinstance(value, self.model):
@@ -321,12 +1160,142 @@ class MongoModelDict(CachedDict):
         result = self.model.get_or_create(**{self.key: key})[0]
         return result
 
+    def lookup(self, key, data=None):
+        """
+        Same as item access, except that with ``async_auto_create`` a missing
+        key doesn't wait for its instance to be created. The key is queued to
+        be created in the background (see :class:`AutoCreator`) and an unsaved
+        instance with the model's defaults is returned in the meantime; the
+        same one until the data changes. ``data`` is the data returned by
+        :meth:`_populate`, if the caller already has it.
+        """
+        if data is None:
+            if not (self.auto_create and self.async_auto_create):
+                return super().__getitem__(key)
+            data = self._populate()
+        try:
+            return data[key]
+        except KeyError:
+            pass
+        if not (self.auto_create and self.async_auto_create):
+            value = self.get_default(key)
+            if value is NoValue:
+                raise KeyError(key)
+            return value
+        missing_from, missing = self._missing
+        if missing_from is not data:
+            missing = {}
+            self._missing = (data, missing)
+        instance = missing.get(key)
+        if instance is None:
+            instance = missing[key] = self.model(**{self.key: key})
+            self._auto_creator().add(key)
+        return instance
+
+    def _auto_creator(self):
+        snapshot = self._snapshot()
+        auto_creator = snapshot.auto_creator
+        if auto_creator is None or not auto_creator.is_alive():
+            with _snapshots_lock:
+                auto_creator = snapshot.auto_creator
+                if auto_creator is None or not auto_creator.is_alive():
+                    auto_creator = AutoCreator(self, self.auto_create_delay)
+                    auto_creator.start()
+                    snapshot.auto_creator = auto_creator
+        return auto_creator
+
+    def stop_auto_creator(self):
+        """
+        Creates any keys still queued and stops the background creation of
+        missing keys.
+        """
+        auto_creator = self._snapshot().auto_creator
+        if auto_creator is not None:
+            auto_creator.stop()
+            self._snapshot().auto_creator = None
+
+    def _create_missing(self, keys):
+        documents = [self.model(**{self.key: key}).to_bson() for key in keys]
+        instances = self.model.create_missing(self.key, documents)
+        changes = {getattr(i, self.key): i for i in instances}
+        if not self.patch_many(changes):
+            self._populate(reset=True)
+
     def _get_cache_data(self):
         return {getattr(i, self.key): i for i in self.model.all()}
 
+    def _get_delta(self, since):
+        if not self.model.track_changes:
+            return None
+        changed, deleted = self.model.changed_since(since)
+        return ({getattr(i, self.key): i for i in changed},
+                [d.get(self.key) for d in deleted])
+
+    def _watch(self, resume_token=None):
+        # Short waits, so that the watcher notices when it's stopped.
+        return self.model.c.watch(full_document='updateLookup',
+                                  resume_after=resume_token,
+                                  max_await_time_ms=1000)
+
+    def _apply_change(self, change):
+        operation = change['operationType']
+        if operation not in ('insert', 'update', 'replace', 'delete'):
+            # The collection was dropped or renamed.
+            self._populate(reset=True)
+            return
+        _id = change['documentKey']['_id']
+        instance = None
+        if operation != 'delete':
+            document = change.get('fullDocument')
+            if document is None:
+                # Deleted since; the delete is next in the stream.
+                return
+            instance = self.model(**document)
+        key = getattr(instance, self.key, NoValue)
+        data = self._snapshot().state[0] if self.shared else self._cache
+        # Deletes only have the _id, and updates may have changed the key.
+        # Encoded values are only decoded if they could have the _id.
+        for old_key, value in list(dict.items(data or {})):
+            if old_key == key:
+                continue
+            if type(value) is Encoded:
+                if not value.codec.may_have_id(value.payload, _id):
+                    continue
+                value = data[old_key]
+            if getattr(value, '_id', None) == _id:
+                self.patch(old_key, local=True)
+        if instance is not None:
+            self.patch(key, instance, local=True)
+
+    def _get_file_codec(self):
+        # Snapshot files need a codec even if the cache backend doesn't.
+        return self.codec or self._file_codec
+
+    def _get_changed_data(self, keys):
+        values = {}
+        for key in keys:
+            instance = self.model.get(**{self.key: key})
+            if instance is not None:
+                values[key] = instance
+        return values
+
     # Signals
     def _post_save(self, sender, **kwargs):
-        self._populate(reset=True)
+        # Only the saved document needs updating. The sender is copied so
+        # that later changes to it don't leak into the cache unsaved.
+        if (not isinstance(sender, self.model)
+                or not self.patch(getattr(sender, self.key),
+                                  copy.deepcopy(sender))):
+            self._populate(reset=True)
+
+    def _post_save_many(self, sender, **kwargs):
+        # All of the saved documents are patched in with a single update.
+        changes = {getattr(i, self.key): copy.deepcopy(i)
+                   for i in sender if isinstance(i, self.model)}
+        if len(changes) < len(sender) or not self.patch_many(changes):
+            self._populate(reset=True)
 
     def _post_delete(self, sender, **kwargs):
-        self._populate(reset=True)
+        if (not isinstance(sender, self.model)
+                or not self.patch(getattr(sender, self.key))):
+            self._populate(reset=True)
@@ -5,12 +5,15 @@ switchboard.builtins
 :copyright: (c) 2015 Kyle Adams.
 :license: Apache License 2.0, see LICENSE for more details.
 """
+import functools
 import socket
 import ipaddress
 import urllib
 
 from . import operator
 from .conditions import (
+    FieldMatcher,
+    IntervalIndex,
     RequestConditionSet,
     Percent,
     String,
@@ -31,11 +34,106 @@ class IPAddress(String):
         return value
 
 
+@functools.lru_cache(maxsize=1024)
+def parse_address(value):
+    """
+    Returns the :mod:`ipaddress` address for a string, or ``None`` if it isn't
+    one. IPv4 addresses mapped into IPv6 are returned as IPv4 addresses.
+    """
+    try:
+        address = ipaddress.ip_address(value)
+    except ValueError:
+        return None
+    return getattr(address, 'ipv4_mapped', None) or address
+
+
+class NetworkIndex:
+    """
+    A set of IPv4 and IPv6 networks (or single addresses), kept as an
+    :class:`~switchboard.conditions.IntervalIndex` of addresses per IP
+    version, so that checking whether an address is in any of them is a
+    binary search however many networks there are. Addresses may be given as
+    strings.
+    """
+    def __init__(self, networks=()):
+        intervals = {4: [], 6: []}
+        for network in networks:
+            if not isinstance(network, (ipaddress.IPv4Network,
+                                        ipaddress.IPv6Network)):
+                network = ipaddress.ip_network(str(network).strip(),
+                                               strict=False)
+            intervals[network.version].append(
+                (int(network.network_address),
+                 int(network.broadcast_address)))
+        self.tables = {version: IntervalIndex(ranges, step=1)
+                       for version, ranges in intervals.items()}
+
+    def __contains__(self, address):
+        if isinstance(address, str):
+            address = parse_address(address)
+        if address is None:
+            return False
+        return int(address) in self.tables[address.version]
+
+
+class NetworkMatcher(FieldMatcher):
+    """
+    A :class:`~switchboard.conditions.FieldMatcher` for :class:`IPNetwork`
+    conditions, which looks addresses up in a :class:`NetworkIndex` of the
+    included and of the excluded networks.
+    """
+    def __init__(self, field, conditions):
+        super().__init__(field, conditions)
+        self.include_index = NetworkIndex(self.include)
+        self.exclude_index = NetworkIndex(self.exclude)
+
+    def is_active(self, actual_value):
+        if actual_value in self.exclude_index:
+            return False
+        if actual_value in self.include_index:
+            return True
+        return None
+
+
+class IPNetwork(String):
+    """
+    Implements a network field, in CIDR notation (e.g. ``10.0.0.0/8`` or
+    ``2001:db8::/32``); the actual value is an address, which must be in the
+    network. A single address is a network of one.
+    """
+    def is_active(self, value, actual_value):
+        return self.matches(self.prepare(value), actual_value)
+
+    def prepare(self, value):
+        return ipaddress.ip_network(value.strip(), strict=False)
+
+    def matches(self, prepared_value, actual_value):
+        if isinstance(actual_value, str):
+            actual_value = parse_address(actual_value)
+        return actual_value is not None and actual_value in prepared_value
+
+    def compile(self, conditions):
+        if not self.compiles_is_active():
+            return super().compile(conditions)
+        return NetworkMatcher(self, conditions)
+
+    def clean(self, value):
+        try:
+            self.prepare(str(value))
+        except ValueError:
+            raise Invalid('You must enter a valid IP address or network.')
+        return value
+
+
 class IPAddressConditionSet(RequestConditionSet):
     percent = Percent()
     ip_address = IPAddress(label='IP Address')
+    ip_network = IPNetwork(label='IP Network')
     internal_ip = Boolean(label='Internal IPs')
 
+    def __init__(self):
+        self._internal_ips = (None, NetworkIndex())
+
     def get_namespace(self):
         return 'ip'
 
@@ -44,13 +142,36 @@ class IPAddressConditionSet(RequestConditionSet):
         # Ensure we map ``percent`` to the ``id`` column
         if field_name == 'percent':
             # any number is fine, `Percent` takes it mod 100
-            return int(ipaddress.ip_address(instance.remote_addr))
+            address = parse_address(instance.remote_addr)
+            if address is None or (address.version == 4
+                                   and ':' in instance.remote_addr):
+                # Invalid, or IPv4 mapped into IPv6, which keeps the bucket
+                # of the whole IPv6 address.
+                address = ipaddress.ip_address(instance.remote_addr)
+            return int(address)
         elif field_name == 'ip_address':
             return instance.remote_addr
+        elif field_name == 'ip_network':
+            return parse_address(instance.remote_addr)
         elif field_name == 'internal_ip':
-            return instance.remote_addr in settings.SWITCHBOARD_INTERNAL_IPS
+            address = parse_address(instance.remote_addr)
+            return address in self.get_internal_ips()
         return super().get_field_value(instance, field_name)
 
+    def get_internal_ips(self):
+        """
+        Returns a :class:`NetworkIndex` of ``SWITCHBOARD_INTERNAL_IPS``, a
+        list (or comma-delimited string) of addresses and networks. The index
+        is rebuilt whenever the setting is replaced.
+        """
+        value = getattr(settings, 'SWITCHBOARD_INTERNAL_IPS', None) or ()
+        internal_ips = self._internal_ips
+        if internal_ips[0] is not value:
+            networks = value.split(',') if isinstance(value, str) else value
+            internal_ips = self._internal_ips = (
+                value, NetworkIndex(n for n in networks if str(n).strip()))
+        return internal_ips[1]
+
     def get_group_label(self):  # pragma: nocover
         return 'IP Address'
 
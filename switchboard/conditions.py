@@ -8,9 +8,12 @@ switchboard.conditions
 
 # Credit to Haystack for abstraction concepts
 
+import bisect
 import datetime
 import re
+import zoneinfo
 
+from .helpers import LRUCache
 from .models import EXCLUDE
 
 
@@ -22,6 +25,13 @@ def titlize(s):
     return s.title().replace('_', ' ')
 
 
+def _defined_in(cls, name):
+    '''
+    Returns the class in ``cls``'s MRO that defines the attribute ``name``.
+    '''
+    return next(klass for klass in cls.__mro__ if name in vars(klass))
+
+
 class Field:
     '''
     Field represents a user input on a parent :class:`ConditionSet`. The user
@@ -53,6 +63,66 @@ class Field:
     def is_active(self, value, actual_value):
         return value == actual_value
 
+    def prepare(self, value):
+        '''
+        Converts a stored condition value into the form expected by
+        :meth:`matches`. Called once per condition when a switch is compiled,
+        so any parsing belongs here rather than in :meth:`is_active`.
+        '''
+        return value
+
+    def matches(self, prepared_value, actual_value):
+        '''
+        Same as :meth:`is_active`, but takes a value returned by
+        :meth:`prepare`.
+        '''
+        return self.is_active(prepared_value, actual_value)
+
+    def compile(self, conditions):
+        '''
+        Compiles a switch's ``[status, value]`` pairs for this Field into a
+        matcher; see :class:`FieldMatcher`. Fields that only compare values
+        for equality get an :class:`EqualityMatcher`, and Fields whose
+        :meth:`is_active` isn't what :meth:`prepare` and :meth:`matches` do
+        an :class:`IsActiveMatcher`.
+        '''
+        if self.is_equality():
+            return EqualityMatcher(self, conditions)
+        if not self.compiles_is_active():
+            return IsActiveMatcher(self, conditions)
+        return FieldMatcher(self, conditions)
+
+    def compiles_is_active(self):
+        '''
+        Returns whether :meth:`prepare` and :meth:`matches` do the same as
+        :meth:`is_active`: they're :class:`Field`'s own (which just call it),
+        or :meth:`is_active` isn't overridden by a subclass of the class that
+        replaced them (e.g. a :class:`Regex` subclass that only overrides
+        :meth:`is_active`).
+        '''
+        cls = type(self)
+        owners = {_defined_in(cls, 'prepare'), _defined_in(cls, 'matches')}
+        owners.discard(Field)
+        if not owners:
+            return True
+        # The most derived of the classes that replaced them.
+        owner = min(owners, key=cls.__mro__.index)
+        is_active = _defined_in(cls, 'is_active')
+        return is_active is owner or not issubclass(is_active, owner)
+
+    def is_equality(self):
+        '''
+        Returns whether a condition value matches exactly when it is equal to
+        the actual value (and the actual value matches itself), i.e. the
+        Field doesn't override :meth:`is_active`, :meth:`prepare` or
+        :meth:`matches` with anything but the equality checks of
+        :class:`Field` and :class:`Choice`.
+        '''
+        cls = type(self)
+        return (cls.is_active in (Field.is_active, Choice.is_active)
+                and cls.prepare is Field.prepare
+                and cls.matches is Field.matches)
+
     def validate(self, data):
         value = data.get(self.name)
         if value:
@@ -113,6 +183,24 @@ class Range(Field):
     def is_active(self, value, actual_value):
         return actual_value >= value[0] and actual_value <= value[1]
 
+    def range_value(self, actual_value):
+        '''
+        Returns the value compared against the range for an actual value.
+        '''
+        return actual_value
+
+    def compile(self, conditions):
+        cls = type(self)
+        if (cls.is_active in (Range.is_active, Percent.is_active)
+                and cls.matches in (Field.matches, Percent.matches)):
+            return RangeMatcher(self, conditions)
+        return super().compile(conditions)
+
+    def prepare(self, value):
+        if isinstance(value, str):
+            value = value.split('-')
+        return list(map(int, value))
+
     def validate(self, data):
         min_limit = data.get(self.name + '[min]')
         max_limit = data.get(self.name + '[max]')
@@ -153,9 +241,14 @@ class Percent(Range):
     default_help_text = 'Enter two ranges, e.g. 0-50 is lower 50%.'
 
     def is_active(self, value, actual_value):
-        value = list(map(int, value.split('-')))
-        mod = actual_value % 100
-        return super().is_active(value, mod)
+        return self.matches(self.prepare(value), actual_value)
+
+    def matches(self, prepared_value, actual_value):
+        return super().is_active(prepared_value,
+                                 self.range_value(actual_value))
+
+    def range_value(self, actual_value):
+        return actual_value % 100
 
     def display(self, value):
         value = value.split('-')
@@ -189,14 +282,25 @@ class Regex(String):
     regular expression used to look for matches in the actual value. Much more
     flexible than the :class:`String` field's equality comparison.
     '''
-    regex_cache = {}
+    #: Compiled regular expressions, shared by every Regex field.
+    regex_cache = LRUCache(maxsize=1024)
 
     def is_active(self, value, actual_value):
-        try:
-            regex = self.regex_cache[value]
-        except KeyError:
+        return self.matches(self.prepare(value), actual_value)
+
+    def prepare(self, value):
+        regex = self.regex_cache.get(value)
+        if regex is None:
             regex = self.regex_cache[value] = re.compile(value)
-        return bool(regex.search(actual_value))
+        return regex
+
+    def matches(self, prepared_value, actual_value):
+        return bool(prepared_value.search(actual_value))
+
+    def compile(self, conditions):
+        if not self.compiles_is_active():
+            return super().compile(conditions)
+        return RegexMatcher(self, conditions)
 
     def render(self, value):
         html = ('/<input type="text" value="%s" name="%s" '
@@ -209,25 +313,56 @@ class AbstractDate(Field):
     Implements a date field, but without specifying how the comparison happens,
     e.g., should the actual date fall before or after the specified date? The
     comparison is left to concrete classes for implementation.
+
+    Values may also be datetimes in ISO 8601 format (e.g.
+    ``2024-06-01T09:00`` or ``2024-06-01T09:00+02:00``), which are compared
+    against the actual datetime rather than its date. Naive dates and
+    datetimes are in ``timezone`` (a :class:`datetime.tzinfo` or the name of
+    one, e.g. ``'Europe/Paris'``), or UTC if it isn't given.
     '''
     DATE_FORMAT = "%Y-%m-%d"
     PRETTY_DATE_FORMAT = "%d %b %Y"
+    PRETTY_DATETIME_FORMAT = "%d %b %Y %H:%M"
+
+    def __init__(self, *args, timezone=None, **kwargs):
+        if isinstance(timezone, str):
+            timezone = zoneinfo.ZoneInfo(timezone)
+        self.timezone = timezone
+        super().__init__(*args, **kwargs)
 
     def str_to_date(self, value):
         return datetime.datetime.strptime(value, self.DATE_FORMAT).date()
 
+    def str_to_datetime(self, value):
+        '''
+        Returns a date for a value in ``DATE_FORMAT``, or else a datetime.
+        '''
+        try:
+            return self.str_to_date(value)
+        except ValueError:
+            if value.endswith('Z'):
+                value = value[:-1] + '+00:00'
+            return datetime.datetime.fromisoformat(value)
+
     def display(self, value):
-        date = self.str_to_date(value)
+        date = self.str_to_datetime(value)
+        if isinstance(date, datetime.datetime):
+            pretty = date.strftime(self.PRETTY_DATETIME_FORMAT)
+            if date.tzinfo is not None:
+                pretty = f"{pretty} {date.tzname()}"
+            return f"{self.label}: {pretty}"
         return f"{self.label}: {date.strftime(self.PRETTY_DATE_FORMAT)}"
 
     def clean(self, value):
         try:
-            date = self.str_to_date(value)
+            date = self.str_to_datetime(value)
         except ValueError as e:
             msg = ("Date must be a valid date in the format YYYY-MM-DD.\n(%s)"
                    % e.args[0])
             raise Invalid(msg)
 
+        if isinstance(date, datetime.datetime):
+            return date.isoformat()
         return date.strftime(self.DATE_FORMAT)
 
     def render(self, value=None):
@@ -237,14 +372,42 @@ class AbstractDate(Field):
         return f'<input type="text" value="{value}" name="{self.name}"/>'
 
     def is_active(self, value, actual_value):
+        return self.matches(self.prepare(value), actual_value)
+
+    def prepare(self, value):
+        return self.str_to_datetime(value)
+
+    def matches(self, prepared_value, actual_value):
         assert isinstance(actual_value, datetime.date)
-        if isinstance(actual_value, datetime.datetime):
+        if isinstance(prepared_value, datetime.datetime):
+            prepared_value = self.to_aware(prepared_value)
+            actual_value = self.to_aware(actual_value)
+        elif isinstance(actual_value, datetime.datetime):
             # datetime.datetime cannot be compared to datetime.date with > and
             # < operators.
+            if actual_value.tzinfo is not None and self.timezone is not None:
+                actual_value = actual_value.astimezone(self.timezone)
             actual_value = actual_value.date()
 
-        condition_date = self.str_to_date(value)
-        return self.date_is_active(condition_date, actual_value)
+        return self.date_is_active(prepared_value, actual_value)
+
+    def to_aware(self, value):
+        '''
+        Returns a date or datetime as an aware datetime; dates start at
+        midnight.
+        '''
+        if not isinstance(value, datetime.datetime):
+            value = datetime.datetime.combine(value, datetime.time())
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=self.timezone or datetime.timezone.utc)
+        return value
+
+    def transition(self, prepared_value):
+        '''
+        Returns the (aware) datetime at which comparing the current time
+        against a prepared value can change result.
+        '''
+        return self.to_aware(prepared_value)
 
     def date_is_active(self, condition_date, value):
         raise NotImplementedError
@@ -268,6 +431,252 @@ class OnOrAfterDate(AbstractDate):
         return value >= after_this_date
 
 
+class FieldMatcher:
+    '''
+    A :class:`Field`'s conditions for a single switch, compiled ahead of time
+    by :meth:`Field.compile`. Each condition value is run through
+    :meth:`Field.prepare` once and filed under exclude or include, so checking
+    an actual value only has to compare it.
+    '''
+    def __init__(self, field, conditions):
+        self.field = field
+        self.include = []
+        self.exclude = []
+        for status, value in conditions:
+            prepared = field.prepare(value)
+            if status == EXCLUDE:
+                self.exclude.append(prepared)
+            else:
+                self.include.append(prepared)
+
+    def is_active(self, actual_value):
+        '''
+        Returns ``False`` if any exclude condition matches the actual value,
+        ``True`` if any include condition matches, and ``None`` otherwise.
+        '''
+        matches = self.field.matches
+        for value in self.exclude:
+            if matches(value, actual_value):
+                return False
+        for value in self.include:
+            if matches(value, actual_value):
+                return True
+        return None
+
+
+class IsActiveMatcher:
+    '''
+    The matcher for a Field that overrides :meth:`Field.is_active` without
+    :meth:`Field.prepare` and :meth:`Field.matches` (see
+    :meth:`Field.compiles_is_active`): the condition values are kept as
+    they are stored and checked with the Field's own :meth:`Field.is_active`.
+    '''
+    def __init__(self, field, conditions):
+        self.field = field
+        self.include = []
+        self.exclude = []
+        for status, value in conditions:
+            if status == EXCLUDE:
+                self.exclude.append(value)
+            else:
+                self.include.append(value)
+
+    def is_active(self, actual_value):
+        is_active = self.field.is_active
+        for value in self.exclude:
+            if is_active(value, actual_value):
+                return False
+        for value in self.include:
+            if is_active(value, actual_value):
+                return True
+        return None
+
+
+class IntervalIndex:
+    '''
+    A set of inclusive ``(start, end)`` intervals, merged into a sorted list
+    of non-overlapping ones so that checking whether a value is in any of
+    them is a binary search. If ``step`` is given (e.g. 1 for integers),
+    intervals that are only that far apart are merged too.
+    '''
+    def __init__(self, intervals=(), step=None):
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(intervals):
+            if start > end:
+                continue
+            if self.ends and start <= (self.ends[-1] if step is None
+                                       else self.ends[-1] + step):
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __contains__(self, value):
+        i = bisect.bisect_right(self.starts, value) - 1
+        return i >= 0 and value <= self.ends[i]
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class RangeMatcher(FieldMatcher):
+    '''
+    A :class:`FieldMatcher` for :class:`Range` and :class:`Percent`
+    conditions, which looks the actual value up in an :class:`IntervalIndex`
+    of the included and of the excluded ranges.
+    '''
+    def __init__(self, field, conditions):
+        super().__init__(field, conditions)
+        self.include_index = IntervalIndex(self.include)
+        self.exclude_index = IntervalIndex(self.exclude)
+
+    def is_active(self, actual_value):
+        value = self.field.range_value(actual_value)
+        if value in self.exclude_index:
+            return False
+        if value in self.include_index:
+            return True
+        return None
+
+
+class TimeWindowMatcher:
+    '''
+    Wraps the matcher of a date Field whose actual value is the current time
+    (see :class:`TimeConditionSet`). The condition values split time into
+    windows, and the result can only change from one window to the next, so
+    it's worked out once and then returned as it is until the current
+    window's next transition.
+    '''
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.field = field = matcher.field
+        self.transitions = sorted({field.transition(value) for value
+                                   in matcher.include + matcher.exclude})
+        # (start, end, result) for the window last checked; None for no
+        # start (or end). Replaced in a single assignment.
+        self.current = None
+
+    def is_active(self, actual_value):
+        current = self.current
+        if current is not None:
+            start, end, result = current
+            try:
+                if ((start is None or start <= actual_value)
+                        and (end is None or actual_value < end)):
+                    return result
+            except TypeError:
+                # A naive datetime, or a date.
+                pass
+        transitions = self.transitions
+        i = bisect.bisect_right(transitions,
+                                self.field.to_aware(actual_value))
+        result = self.matcher.is_active(actual_value)
+        self.current = (transitions[i - 1] if i else None,
+                        transitions[i] if i < len(transitions) else None,
+                        result)
+        return result
+
+
+class EqualityMatcher(FieldMatcher):
+    '''
+    A :class:`FieldMatcher` for Fields whose conditions match by equality
+    (see :meth:`Field.is_equality`). The condition values are also indexed in
+    sets, so checking an actual value takes the same time however many
+    values the switch lists. Unhashable values can't be indexed and are
+    compared one by one.
+    '''
+    def __init__(self, field, conditions):
+        super().__init__(field, conditions)
+        self.include_set, self.include_unhashable = self._index(self.include)
+        self.exclude_set, self.exclude_unhashable = self._index(self.exclude)
+
+    @staticmethod
+    def _index(values):
+        indexed = set()
+        unhashable = []
+        for value in values:
+            try:
+                indexed.add(value)
+            except TypeError:
+                unhashable.append(value)
+        return indexed, unhashable
+
+    def is_active(self, actual_value):
+        try:
+            excluded = actual_value in self.exclude_set
+            included = actual_value in self.include_set
+        except TypeError:
+            return super().is_active(actual_value)
+        if excluded or included:
+            # Equal to a condition value, so that condition matches if the
+            # actual value matches itself (e.g. it's one of a Choice's
+            # choices).
+            if not self.field.matches(actual_value, actual_value):
+                excluded = included = False
+            elif excluded:
+                return False
+        matches = self.field.matches
+        for value in self.exclude_unhashable:
+            if matches(value, actual_value):
+                return False
+        if included:
+            return True
+        for value in self.include_unhashable:
+            if matches(value, actual_value):
+                return True
+        return None
+
+
+class RegexMatcher(FieldMatcher):
+    '''
+    A :class:`FieldMatcher` for :class:`Regex` conditions, which joins the
+    include patterns, and the exclude patterns, into a single alternation so
+    each check scans the actual value once per status rather than once per
+    pattern.
+
+    Patterns that can't be safely joined (ones with backreferences, named
+    groups or global flags, which are relative to the whole expression) are
+    searched for one by one.
+    '''
+    _backreference = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+    def __init__(self, field, conditions):
+        super().__init__(field, conditions)
+        self.include, self.include_regex = self._combine(self.include)
+        self.exclude, self.exclude_regex = self._combine(self.exclude)
+
+    @classmethod
+    def _combine(cls, regexes):
+        default_flags = re.compile('').flags
+        combinable, separate = [], []
+        for regex in regexes:
+            if (isinstance(regex.pattern, str) and not regex.groupindex
+                    and regex.flags == default_flags
+                    and not cls._backreference.search(regex.pattern)):
+                combinable.append(regex)
+            else:
+                separate.append(regex)
+        if len(combinable) < 2:
+            return regexes, None
+        try:
+            combined = re.compile('|'.join(f'(?:{regex.pattern})'
+                                           for regex in combinable))
+        except re.error:
+            return regexes, None
+        return separate, combined
+
+    def is_active(self, actual_value):
+        if (self.exclude_regex is not None
+                and self.exclude_regex.search(actual_value)):
+            return False
+        result = super().is_active(actual_value)
+        if (result is None and self.include_regex is not None
+                and self.include_regex.search(actual_value)):
+            return True
+        return result
+
+
 class ConditionSetBase(type):
     def __new__(cls, name, bases, attrs):
         attrs['fields'] = {}
@@ -291,6 +700,13 @@ class ConditionSetBase(type):
 
 
 class ConditionSet(metaclass=ConditionSetBase):
+    #: Whether values returned by :meth:`get_field_value` may be reused for
+    #: the same instance across switches and, when the operator has a
+    #: ``field_value_cache``, for the rest of the request. Set to ``False``
+    #: if the value can change between calls (e.g. it is random or
+    #: time-based).
+    cache_field_values = True
+
     def __repr__(self):  # pragma: nocover
         return f'<{self.__class__.__name__}>'
 
@@ -366,6 +782,55 @@ class ConditionSet(metaclass=ConditionSetBase):
                         return_value = True
         return return_value
 
+    def compile(self, condition):
+        """
+        Given the condition active for a switch, returns a list of
+        ``(field_name, matcher)`` pairs for the fields this ConditionSet
+        knows about. The result is what :meth:`has_active_compiled` expects.
+        """
+        compiled = []
+        for name, field_conditions in condition.items():
+            field = self.fields.get(name)
+            if field:
+                compiled.append((name, field.compile(field_conditions)))
+        return compiled
+
+    def has_active_compiled(self, compiled, instances, evaluation=None):
+        """
+        Same as :meth:`has_active_condition`, but for a condition returned by
+        :meth:`compile`. ``instances`` must already end with the ``None``
+        used for the non-instance default. Field values are read through
+        ``evaluation`` (a :class:`switchboard.plans.Evaluation`) if given.
+        """
+        return_value = None
+        for instance in instances:
+            if not self.can_execute(instance):
+                continue
+            result = self.is_active_compiled(instance, compiled, evaluation)
+            if result is False:
+                return False
+            elif result is True:
+                return_value = True
+        return return_value
+
+    def is_active_compiled(self, instance, compiled, evaluation=None):
+        """
+        Same as :meth:`is_active`, but for a condition returned by
+        :meth:`compile`.
+        """
+        return_value = None
+        for name, matcher in compiled:
+            if evaluation is None:
+                value = self.get_field_value(instance, name)
+            else:
+                value = evaluation.get_field_value(self, instance, name)
+            result = matcher.is_active(value)
+            if result is False:
+                return False
+            elif result is True:
+                return_value = True
+        return return_value
+
     def get_group_label(self):  # pragma: nocover
         """
         Returns a string representing a human readable version
@@ -408,3 +873,33 @@ class RequestConditionSet(ConditionSet):
         return (hasattr(instance, 'environ') and
                 hasattr(instance, 'headers') and
                 hasattr(instance, 'method'))
+
+
+class TimeConditionSet(ConditionSet):
+    '''
+    A base class for condition sets whose date fields (e.g.
+    :class:`OnOrAfterDate` for a launch, :class:`BeforeDate` for a sunset)
+    are compared against the current time. Their conditions are compiled
+    into :class:`TimeWindowMatcher` instances, so the result is only worked
+    out again once the next date in the conditions has passed.
+    '''
+    cache_field_values = False
+
+    def can_execute(self, instance):
+        return instance is None
+
+    def now(self):
+        '''
+        Returns the current time, as an aware datetime.
+        '''
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def get_field_value(self, instance, field_name):
+        return self.now()
+
+    def compile(self, condition):
+        compiled = super().compile(condition)
+        return [(name, TimeWindowMatcher(matcher)
+                 if isinstance(self.fields[name], AbstractDate)
+                 and isinstance(matcher, FieldMatcher) else matcher)
+                for name, matcher in compiled]
@@ -7,10 +7,15 @@ switchboard.helpers
 """
 
 import logging
-from collections import defaultdict
+import threading
+from collections import OrderedDict, defaultdict
 from copy import deepcopy
 from datetime import datetime, timezone
 
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from pymongo.results import BulkWriteResult
+
 log = logging.getLogger(__name__)
 
 
@@ -22,11 +27,27 @@ class MockCollection:
     def __init__(self, name=''):
         self._data = []
         self.name = name
+        self.indexes = {}
         self.database = defaultdict(lambda: MockCollection(), name=self)
 
+    _operators = {
+        '$gt': lambda value, arg: value > arg,
+        '$gte': lambda value, arg: value >= arg,
+        '$lt': lambda value, arg: value < arg,
+        '$lte': lambda value, arg: value <= arg,
+        '$in': lambda value, arg: value in arg,
+    }
+
     def _matches(self, spec, document):
         for k, v in spec.items():
-            if k not in document or document[k] != v:
+            if k not in document:
+                return False
+            if isinstance(v, dict) and v and all(o in self._operators
+                                                  for o in v):
+                if not all(self._operators[o](document[k], arg)
+                           for o, arg in v.items()):
+                    return False
+            elif document[k] != v:
                 return False
         return True
 
@@ -39,28 +60,54 @@ class MockCollection:
         if not spec:
             # Return a copy of the list so that updating the returned list does
             # not automatically update the datastore.
-            return deepcopy(self._data)
+            return self._sort(deepcopy(self._data), sort)
         for d in self._data:
             if self._matches(spec, d):
                 results.append(d)
-        return results or None
+        return self._sort(results, sort) or None
+
+    def distinct(self, key, spec=None):
+        values = []
+        for d in self.find(spec) or []:
+            if key in d and d[key] not in values:
+                values.append(d[key])
+        return values
+
+    def _sort(self, results, sort):
+        # Sorts are stable, so sorting by the last key first gives the same
+        # order as sorting by all of them.
+        for field, direction in reversed(sort or ()):
+            results.sort(key=lambda d: d.get(field), reverse=direction < 0)
+        return results
 
     def _update_partial(self, old, new):
         for k, v in new.items():
-            old[k] = v
+            # Dotted keys set embedded fields.
+            *path, k = k.split('.')
+            target = old
+            for part in path:
+                target = target.setdefault(part, {})
+            target[k] = v
 
     def update_one(self, spec, update, upsert=False):
         current = self.find_one(spec)
         if not current:
             if upsert:
-                update = update.get('$set', update)
-                spec.update(update)
+                document = dict(update.get('$setOnInsert', {}))
+                if '$set' in update:
+                    document.update(update['$set'])
+                elif '$setOnInsert' not in update:
+                    document.update(update)
+                spec.update(document)
                 return self.insert_one(spec)
         else:
             for k, v in update.items():
                 if k == '$set':
                     self._update_partial(current, v)
-                else:
+                elif k == '$unset':
+                    for field in v:
+                        current.pop(field, None)
+                elif k != '$setOnInsert':
                     current[k] = v
 
         return {
@@ -70,27 +117,238 @@ class MockCollection:
             'updatedExisting': True
         }
 
+    def find_one_and_update(self, spec, update, upsert=False,
+                            return_document=False):
+        # return_document is ReturnDocument.BEFORE (False) or AFTER (True).
+        before = deepcopy(self.find_one(spec))
+        result = self.update_one(dict(spec), update, upsert=upsert)
+        if not return_document:
+            return before
+        if before:
+            _id = before['_id']
+        elif upsert:
+            _id = result
+        else:
+            return None
+        return deepcopy(self.find_one({'_id': _id}))
+
+    def find_one_and_delete(self, spec):
+        document = self.find_one(spec)
+        if document:
+            self._data.remove(document)
+        return document
+
+    def bulk_write(self, requests, ordered=True):
+        # Only BulkInsert and BulkUpdate requests are supported.
+        upserted = []
+        for index, request in enumerate(requests):
+            if isinstance(request, BulkUpdate):
+                existed = self.find_one(request.filter) is not None
+                result = self.update_one(dict(request.filter), request.update,
+                                         upsert=request.upsert)
+                if not existed and request.upsert:
+                    upserted.append(dict(index=index, _id=result))
+            else:
+                self.insert_one(request.document)
+        return BulkWriteResult(dict(upserted=upserted), True)
+
     def delete_one(self, spec):
         doc = self.find_one(spec)
         if doc:
             self._data.remove(doc)
             return {'err': None, 'n': 1, 'ok': 1.0}
 
+    def create_index(self, keys, unique=False, **kwargs):
+        name = kwargs.get('name') or '_'.join(f'{k}_{d}' for k, d in keys)
+        self.indexes[name] = dict(key=list(keys), unique=unique, **kwargs)
+        return name
+
+    def _check_unique(self, document):
+        for index in self.indexes.values():
+            if not index['unique']:
+                continue
+            fields = [field for field, _ in index['key']]
+            values = [document.get(field) for field in fields]
+            if any(d is not document and
+                   [d.get(field) for field in fields] == values
+                   for d in self._data):
+                raise DuplicateKeyError(f'duplicate key: {values}')
+
     def insert_one(self, document):
         _id = document.get('_id')
         if not _id:
             _id = str(len(self._data))
             document['_id'] = _id
+        self._check_unique(document)
 
         self._data.append(document)
         return _id
 
+    def insert_many(self, documents, ordered=True):
+        return [self.insert_one(document) for document in documents]
+
     def drop(self):
         self._data = []
+        self.indexes = {}
 
     def count(self):
         return len(self._data)
 
 
+class BulkInsert(InsertOne):
+    """
+    An ``InsertOne`` request that keeps its document where
+    :meth:`MockCollection.bulk_write` can read it.
+    """
+    def __init__(self, document):
+        super().__init__(document)
+        self.document = document
+
+
+class BulkUpdate(UpdateOne):
+    """
+    An ``UpdateOne`` request that keeps its arguments where
+    :meth:`MockCollection.bulk_write` can read them.
+    """
+    def __init__(self, filter, update, upsert=False):
+        super().__init__(filter, update, upsert=upsert)
+        self.filter = filter
+        self.update = update
+        self.upsert = upsert
+
+
+class LRUCache:
+    """
+    A thread-safe dict-like cache holding at most ``maxsize`` items; adding
+    another evicts the least recently used one.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_missing = object()
+
+
+class IdentityKey:
+    """
+    Stands in for an unhashable object in a dict key, comparing equal only to
+    keys for the same object. The object is kept alive for as long as the key
+    is, so its id can't be reused by another object in the meantime.
+    """
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __hash__(self):
+        return id(self.obj)
+
+    def __eq__(self, other):
+        return isinstance(other, IdentityKey) and other.obj is self.obj
+
+
+def default_identity(obj):
+    """
+    Returns ``obj`` if it's hashable, or else an :class:`IdentityKey` for it.
+    """
+    try:
+        hash(obj)
+    except TypeError:
+        return IdentityKey(obj)
+    return obj
+
+
+class ResultCache(LRUCache):
+    """
+    A bounded cache of ``is_active`` results, to use as a manager's
+    ``result_cache`` (e.g. for the duration of a request; see
+    :class:`~switchboard.middleware.SwitchboardMiddleware`).
+
+    Results are keyed by the arguments they were checked with. Instances are
+    keyed by ``identity(instance)``, which defaults to
+    :func:`default_identity`, so they don't have to be hashable; pass e.g.
+    ``lambda obj: getattr(obj, 'id', obj)`` to share results between
+    instances of the same record. Hits, misses and evictions are counted.
+    """
+    def __init__(self, maxsize=1024, identity=None):
+        super().__init__(maxsize)
+        self.identity = identity or default_identity
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, cache_key):
+        args, kwargs = cache_key
+        identity = self.identity
+        return tuple(identity(arg) for arg in args), kwargs
+
+    def get(self, key, default=None):
+        try:
+            key = self._key(key)
+            value = super().get(key, _missing)
+        except TypeError:
+            value = _missing
+        if value is _missing:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        try:
+            key = self._key(key)
+            hash(key)
+        except TypeError:
+            return
+        super().__setitem__(key, value)
+
+    def __contains__(self, key):
+        try:
+            return self._key(key) in self._data
+        except TypeError:
+            return False
+
+    def clear(self):
+        super().clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
 def utcnow():
     return datetime.now(timezone.utc).replace(tzinfo=None)
@@ -6,7 +6,12 @@ switchboard.manager
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
+import copy
 import logging
+import threading
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
 
 import pymongo
 from pymongo.mongo_client import MongoClient
@@ -18,7 +23,10 @@ from .models import (
     DISABLED, SELECTIVE, GLOBAL, INHERIT,
     INCLUDE, EXCLUDE,
 )
-from .proxy import SwitchProxy
+from .plans import ChainPlan, Evaluation, SwitchPlan
+from .proxy import BatchSwitchProxy, SwitchProxy
+from .serialization import get_codec
+from .snapshots import get_snapshot_file
 from .settings import settings, Settings
 
 log = logging.getLogger(__name__)
@@ -27,6 +35,52 @@ log = logging.getLogger(__name__)
 # populated on Switchboard startup (i.e., operator.register()).
 registry = {}
 registry_by_namespace = {}
+# Bumped on every (un)registration so that compiled switch plans, which hold
+# references to condition sets, are rebuilt.
+registry_version = 0
+
+# Request-scoped state (the context and the result and field value caches) by
+# SwitchManager instance. It is kept in context variables rather than on the
+# manager, which is a threading.local, so that concurrent asyncio tasks on one
+# thread don't see each other's requests, while work handed off to another
+# thread with the context copied (e.g. asyncio.to_thread) still does.
+_context_vars = weakref.WeakKeyDictionary()
+_context_vars_lock = threading.Lock()
+
+
+def _get_context_vars(manager):
+    with _context_vars_lock:
+        try:
+            return _context_vars[manager]
+        except KeyError:
+            context_vars = _context_vars[manager] = {
+                name: ContextVar('switchboard.' + name)
+                for name in ('context', 'result_cache', 'field_value_cache')
+            }
+            return context_vars
+
+
+def _context_property(name, default=None, doc=None):
+    """
+    A SwitchManager attribute stored in a context variable. ``default`` is
+    called to make the value of a context that hasn't set one; it is stored,
+    so that changes to mutable defaults stick.
+    """
+    def fget(self):
+        var = self._context_vars[name]
+        try:
+            return var.get()
+        except LookupError:
+            if default is None:
+                return None
+            value = default()
+            var.set(value)
+            return value
+
+    def fset(self, value):
+        self._context_vars[name].set(value)
+
+    return property(fget, fset, doc=doc)
 
 
 def nested_config(config):
@@ -47,7 +101,24 @@ def configure(config={}, nested=False, cache=None, allow_no_mongo=False):
     # Re-read settings to make sure we have everything
     Settings.init(cache=cache, **config)
 
+    refresh_interval = getattr(settings, 'SWITCHBOARD_REFRESH_INTERVAL', None)
+    watch_changes = getattr(settings, 'SWITCHBOARD_WATCH_CHANGES', False)
+    snapshot_path = getattr(settings, 'SWITCHBOARD_SNAPSHOT_PATH', None)
+    ensure_indexes = getattr(settings, 'SWITCHBOARD_ENSURE_INDEXES', True)
+    if refresh_interval or watch_changes or snapshot_path:
+        # The refresher and watcher publish to the snapshot shared by all
+        # threads, and the snapshot file is written from it.
+        settings.SWITCHBOARD_SHARED_CACHE = True
+
     operator.cache = cache
+    operator.shared = getattr(settings, 'SWITCHBOARD_SHARED_CACHE', False)
+    operator.delta_sync = getattr(settings, 'SWITCHBOARD_DELTA_SYNC', False)
+    operator.async_auto_create = getattr(
+        settings, 'SWITCHBOARD_ASYNC_AUTO_CREATE', False)
+    operator.codec = get_codec(
+        getattr(settings, 'SWITCHBOARD_CACHE_CODEC', None), Switch)
+    operator.snapshot_file = (get_snapshot_file(snapshot_path)
+                              if snapshot_path else None)
 
     # Establish the connection to Mongo
     mongo_timeout = getattr(settings, 'SWITCHBOARD_MONGO_TIMEOUT', None)
@@ -70,11 +141,25 @@ def configure(config={}, nested=False, cache=None, allow_no_mongo=False):
     except Exception:
         if allow_no_mongo:
             log.exception('Unable to connect to the datastore, will use in-memory switch collection')
+            # There's nothing to watch, or to index.
+            watch_changes = False
+            ensure_indexes = False
         else:
             raise
+    if ensure_indexes:
+        try:
+            Switch.ensure_indexes()
+        except Exception:
+            # e.g. existing duplicate keys; switchboard works without them.
+            log.exception('Unable to create the switch indexes')
     # Register the builtins
     __import__('switchboard.builtins')
 
+    if refresh_interval:
+        operator.start_refresher(int(refresh_interval))
+    if watch_changes:
+        operator.start_watcher()
+
 
 class SwitchManager(MongoModelDict):
     DISABLED = DISABLED
@@ -93,12 +178,58 @@ class SwitchManager(MongoModelDict):
             new_args.append(a)
         kwargs['key'] = 'key'
         kwargs['value'] = 'value'
-        self.result_cache = None
-        self.context = {}
+        # Not reset here: __init__ runs again for each new thread, which
+        # would otherwise clobber the state of the context it runs in.
+        self._context_vars = _get_context_vars(self)
+        self._plans = {}
+        self._chains = {}
+        self._plans_source = None
+        self._plans_version = None
         MongoModel.post_save.connect(self.version_switch)
-        MongoModel.post_delete.connect(self.version_switch)
+        MongoModel.post_delete.connect(self.version_deleted_switch)
+        MongoModel.post_save_many.connect(self.version_switches)
         super().__init__(*new_args, **kwargs)
 
+    context = _context_property('context', dict, doc="""
+        Objects that condition sets can read values from, in addition to the
+        ones passed to ``is_active`` (e.g. the current request or user).
+        """)
+    result_cache = _context_property('result_cache', doc="""
+        The cache of ``is_active`` results, if any (see
+        :meth:`with_result_cache`).
+        """)
+    field_value_cache = _context_property('field_value_cache', doc="""
+        The cache of values read off instances by condition sets, if any.
+        """)
+
+    @contextmanager
+    def batch(self):
+        """
+        Collects changes to many switches and saves them together when the
+        block ends: one bulk write, one update of the cache and one insert of
+        their versions. Nothing is saved if the block raises.
+
+        >>> with operator.batch() as batch: #doctest: +SKIP
+        >>>     batch['my_switch'].status = operator.GLOBAL #doctest: +SKIP
+        >>>     batch['other'].add_condition(cs_id, 'percent', '0-50') #doctest: +SKIP
+        """
+        batch = SwitchBatch(self)
+        yield batch
+        batch.commit()
+
+    def bulk_update(self, changes):
+        """
+        Sets fields (e.g. ``status``, ``label`` or ``description``) on many
+        switches, given as a dict of keys to dicts of fields, and saves them
+        as a :meth:`batch`. Returns the saved switches.
+        """
+        with self.batch() as batch:
+            batch.load(changes)
+            for key, fields in changes.items():
+                for field, value in fields.items():
+                    setattr(batch[key], field, value)
+        return batch.saved
+
     def __str__(self):
         return "<{}: {} ({})>".format(self.__class__.__name__,
                                   getattr(self, 'model', ''),
@@ -109,13 +240,81 @@ class SwitchManager(MongoModelDict):
         Returns a SwitchProxy, rather than a Switch. It allows us to
         easily extend the Switches method and automatically include our
         manager instance.
+
+        If the cache only holds the fields needed to check switches, the
+        whole switch is read from the database, so that it can be displayed
+        and saved.
         """
-        return SwitchProxy(self, super().__getitem__(key))
+        switch = super().__getitem__(key)
+        if self.codec is not None and self.codec.partial:
+            switch = self.model.get(key=key) or switch
+        return SwitchProxy(self, switch)
+
+    def get_plan(self, key, data=None):
+        """
+        Returns the compiled :class:`~switchboard.plans.SwitchPlan` for a
+        switch, raising ``KeyError`` the same way item access does (but see
+        :meth:`~switchboard.base.MongoModelDict.lookup` for
+        ``async_auto_create``). A plan is compiled on first use and reused
+        until the local cache is reloaded. ``data`` is the populated local
+        cache, if the caller already has it.
+        """
+        if data is None:
+            data = self._populate()
+        switch = self.lookup(key, data)
+        self._check_plans(data)
+        plan = self._plans.get(key)
+        if plan is None or plan.switch is not switch:
+            plan = SwitchPlan(switch, registry_by_namespace)
+            self._plans[key] = plan
+        return plan
+
+    def get_chain(self, key, evaluation=None, data=None):
+        """
+        Returns the :class:`~switchboard.plans.ChainPlan` for a switch and
+        its parents. Unlike :meth:`get_plan`, the switch doesn't have to
+        exist. A chain is built on first use, from the parent's chain, and
+        reused until the local cache is reloaded; chains are also kept in
+        ``evaluation``, if given, for the keys checked with it. The local
+        cache is populated once, and the whole chain built from that data.
+        """
+        if data is None:
+            data = self._populate()
+        self._check_plans(data)
+        chains = self._chains
+        chain = chains.get(key)
+        if chain is None and evaluation is not None:
+            chain = evaluation.chains.get(key)
+        if chain is None:
+            parent, sep, _ = key.rpartition(':')
+            parent_chain = (self.get_chain(parent, evaluation, data)
+                            if sep else None)
+            try:
+                plan = self.get_plan(key, data)
+            except KeyError:
+                plan = None
+            chain = ChainPlan(parent_chain, plan)
+            # Unless the cache was reloaded while the chain was built.
+            if self._chains is chains:
+                chains[key] = chain
+            if evaluation is not None:
+                evaluation.chains[key] = chain
+        return chain
+
+    def _check_plans(self, data):
+        if (self._plans_source is not data
+                or self._plans_version != registry_version):
+            self._plans = {}
+            self._chains = {}
+            self._plans_source = data
+            self._plans_version = registry_version
 
     def with_result_cache(func):
         """
         Decorator specifically for is_active.  If self.result_cache is set to a {}
-        the is_active results will be cached for each set of params.
+        (or a :class:`~switchboard.helpers.ResultCache`, which is bounded and
+        doesn't need the instances to be hashable) the is_active results will
+        be cached for each set of params.
         """
         def inner(self, *args, **kwargs):
             dic = self.result_cache
@@ -148,59 +347,102 @@ class SwitchManager(MongoModelDict):
         try:
             default = kwargs.pop('default', False)
 
-            # Check all parents for a disabled state
-            parts = key.split(':')
-            if len(parts) > 1:
-                child_kwargs = kwargs.copy()
-                child_kwargs['default'] = None
-                result = self.is_active(':'.join(parts[:-1]), *instances,
-                                        **child_kwargs)
+            if 'is_active' in self.__dict__ and ':' in key:
+                # is_active has been replaced on this instance (e.g. by
+                # testutils.switches), so parents go through it.
+                return self._is_active_with_parents(key, instances, kwargs,
+                                                    default)
 
-                if result is False:
-                    return result
-                elif result is True:
-                    default = result
+            evaluation = self.evaluation(instances)
+            return_value = self.get_chain(key, evaluation).is_active(
+                evaluation, default)
+        except:
+            log.exception('Error checking if switch "%s" is active', key)
+            return_value = False
 
-            try:
-                switch = self[key]
-            except KeyError:
-                # switch is not defined, defer to parent
-                return default
+        return return_value
+
+    def _is_active_with_parents(self, key, instances, kwargs, default):
+        parent = key.rpartition(':')[0]
+        child_kwargs = kwargs.copy()
+        child_kwargs['default'] = None
+        result = self.is_active(parent, *instances, **child_kwargs)
 
-            if switch.status == GLOBAL:
-                return True
-            elif switch.status == DISABLED:
-                return False
-            elif switch.status == INHERIT:
-                return default
+        if result is False:
+            return result
+        elif result is True:
+            default = result
 
-            conditions = switch.value
-            # If no conditions are set, we inherit from parents
-            if not conditions:
-                return default
+        try:
+            plan = self.get_plan(key)
+        except KeyError:
+            # switch is not defined, defer to parent
+            return default
 
-            instances = list(instances) if instances else []
-            instances.extend(list(self.context.values()))
+        return plan.is_active(self.evaluation(instances), default)
 
-            # check each switch to see if it can execute
-            return_value = False
+    def is_active_many(self, keys, *instances, **kwargs):
+        """
+        Checks several switches against the same ``instances`` and returns a
+        dict mapping each key to the result ``is_active`` would give. The
+        context, parent switch results and values read off the instances are
+        shared by all of the keys, so each extra switch only costs its own
+        condition check.
+
+        >>> operator.is_active_many(['foo', 'bar'], request) #doctest: +SKIP
+        {'foo': True, 'bar': False}
+        """
+        # Mirrors the keys written by with_result_cache, so the two share
+        # cached results.
+        cache_kwargs = tuple(sorted(kwargs.items())) if kwargs else ()
+        default = kwargs.pop('default', False)
+        dic = self.result_cache
+        evaluation = self.evaluation(instances)
+        results = {}
+        for key in keys:
+            cache_key = None
+            if dic is not None:
+                cache_key = ((key,) + instances, cache_kwargs)
+                try:
+                    result = dic.get(cache_key)
+                except TypeError:  # not hashable
+                    cache_key = None
+                else:
+                    if result is not None:
+                        results[key] = result
+                        continue
+            result = self._evaluate(key, evaluation, default)
+            if cache_key is not None:
+                dic[cache_key] = result
+            results[key] = result
+        return results
 
-            for namespace, condition in conditions.items():
-                condition_set = registry_by_namespace.get(namespace)
-                if not condition_set:
-                    continue
-                result = condition_set.has_active_condition(condition,
-                                                            instances)
-                if result is False:
-                    return False
-                elif result is True:
-                    return_value = True
+    def evaluation(self, instances):
+        """
+        Returns an :class:`~switchboard.plans.Evaluation` for ``instances``
+        plus the objects in the operator's context.
+        """
+        instances = list(instances) if instances else []
+        instances.extend(self.context.values())
+        instances.append(None)
+        return Evaluation(instances, self.field_value_cache)
+
+    def _evaluate(self, key, evaluation, default):
+        """
+        Same as ``is_active``, except that parent chains and the results
+        for switches with conditions are shared through ``evaluation``.
+        """
+        try:
+            return self.get_chain(key, evaluation).is_active(evaluation,
+                                                             default)
         except:
             log.exception('Error checking if switch "%s" is active', key)
-            return_value = False
+            return False
 
-        # there were no matching conditions, so it must not be enabled
-        return return_value
+    def _cleanup(self, *args, **kwargs):
+        super()._cleanup(*args, **kwargs)
+        # Field values are only valid for the request that read them.
+        self.field_value_cache = None
 
     def register(self, condition_set):
         """
@@ -210,10 +452,12 @@ class SwitchManager(MongoModelDict):
         >>> operator.register(condition_set) #doctest: +SKIP
         """
 
+        global registry_version
         if callable(condition_set):
             condition_set = condition_set()
         registry[condition_set.get_id()] = condition_set
         registry_by_namespace[condition_set.get_namespace()] = condition_set
+        registry_version += 1
 
     def unregister(self, condition_set):
         """
@@ -221,10 +465,12 @@ class SwitchManager(MongoModelDict):
 
         >>> operator.unregister(condition_set) #doctest: +SKIP
         """
+        global registry_version
         if callable(condition_set):
             condition_set = condition_set()
         registry.pop(condition_set.get_id(), None)
         registry_by_namespace.pop(condition_set.get_namespace(), None)
+        registry_version += 1
 
     def get_condition_set_by_id(self, switch_id):
         """
@@ -253,12 +499,48 @@ class SwitchManager(MongoModelDict):
             for field in condition_set.fields.values():
                 yield condition_set.get_id(), group, field
 
-    def version_switch(self, switch):
+    def version_switch(self, switch, deleted=False):
         '''
         Save changes made to a switch. Triggered by create and update events
         on a switch model. The changes are saved as diffs and reassembled to
         create a switch history. Allows changes to switches to be audited.
+
+        With the ``SWITCHBOARD_ASYNC_VERSIONS`` setting, the changes are saved
+        in the background instead (see
+        :meth:`~switchboard.models.VersioningMongoModel.queue_version`).
+        '''
+        username = self._get_username()
+        try:
+            if getattr(settings, 'SWITCHBOARD_ASYNC_VERSIONS', False):
+                switch.queue_version(deleted=deleted, username=username)
+            else:
+                switch.save_version(username=username)
+        except Exception:
+            log.warning('Unable to save the switch version', exc_info=True)
+
+    def version_switches(self, switches):
+        '''
+        Save changes made to a list of switches at once. Triggered by
+        :meth:`~switchboard.models.MongoModel.save_many`.
         '''
+        username = self._get_username()
+        try:
+            if getattr(settings, 'SWITCHBOARD_ASYNC_VERSIONS', False):
+                for switch in switches:
+                    switch.queue_version(username=username)
+            elif switches:
+                type(switches[0]).save_versions(switches, username=username)
+        except Exception:
+            log.warning('Unable to save the switch versions', exc_info=True)
+
+    def version_deleted_switch(self, switch):
+        '''
+        Save the deletion of a switch. Triggered by delete events on a switch
+        model.
+        '''
+        self.version_switch(switch, deleted=True)
+
+    def _get_username(self):
         # Try to get the username from both User objects and user dicts.
         user = self.context.get('user', {})
         username = ''
@@ -279,10 +561,48 @@ class SwitchManager(MongoModelDict):
                 # not a dict, ok
                 pass
 
-        try:
-            switch.save_version(username=username)
-        except Exception:
-            log.warning('Unable to save the switch version', exc_info=True)
+        return username
+
+
+class SwitchBatch:
+    """
+    Changes to many switches, saved together (see
+    :meth:`SwitchManager.batch`). Item access returns a proxy for the switch
+    with the key, read from the database the first time (or a new one, if
+    there is no such switch yet). Only the switches changed since they were
+    read are saved.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self.switches = {}
+        self.loaded = {}
+        self.saved = []
+
+    def __getitem__(self, key):
+        if key not in self.switches:
+            self.load([key])
+        return BatchSwitchProxy(self.manager, self.switches[key])
+
+    def load(self, keys):
+        """
+        Reads the switches with the given keys that aren't in the batch yet,
+        with a single query.
+        """
+        model = self.manager.model
+        keys = [k for k in keys if k not in self.switches]
+        if not keys:
+            return
+        found = {s.key: s for s in model.find(key={'$in': keys})}
+        for key in keys:
+            switch = self.switches[key] = found.get(key) or model(key=key)
+            self.loaded[key] = copy.deepcopy(switch.to_bson())
+
+    def commit(self):
+        switches = [switch for key, switch in self.switches.items()
+                    if switch.to_bson() != self.loaded[key]]
+        self.switches, self.loaded = {}, {}
+        self.saved = self.manager.model.save_many(switches)
+        return self.saved
 
 
 auto_create = getattr(settings, 'SWITCHBOARD_AUTO_CREATE', True)
@@ -6,27 +6,61 @@ switchboard.middleware
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
+import inspect
+from collections.abc import Mapping
+from functools import cached_property
+
 from webob import Request
+from switchboard.helpers import ResultCache
+from switchboard.settings import settings
 from switchboard.signals import request_finished
 from switchboard import operator
 
 
 class SwitchboardMiddleware:
+    '''
+    Sets up Switchboard for each request: the request is added to the
+    operator's context, and ``is_active`` results and the values read by
+    condition sets are cached until the request is finished.
 
-    def __init__(self, app):
+    At most ``result_cache_size`` results are kept per request (the
+    ``SWITCHBOARD_RESULT_CACHE_SIZE`` setting, 1024 by default; 0 turns the
+    result cache off), with instances keyed by ``identity`` (see
+    :class:`~switchboard.helpers.ResultCache`).
+    '''
+    def __init__(self, app, result_cache_size=None, identity=None):
         self.app = app
+        if result_cache_size is None:
+            result_cache_size = getattr(
+                settings, 'SWITCHBOARD_RESULT_CACHE_SIZE', 1024)
+        self.result_cache_size = int(result_cache_size)
+        self.identity = identity
 
     def __call__(self, environ, start_response):
         req = resp = None
         try:
             req = Request(environ)
-            operator.context['request'] = req
+            # A new dict, rather than adding to the current one, which may
+            # be shared with other requests served from the same context.
+            operator.context = dict(operator.context, request=req)
+            operator.field_value_cache = {}
+            operator.result_cache = self.new_result_cache()
             self.pre_request(req)
             resp = req.get_response(self.app)
             return resp(environ, start_response)
         finally:
             self.post_request(req, resp)
             self.request_finished(req)
+            operator.result_cache = None
+
+    def new_result_cache(self):
+        '''
+        Returns the result cache for a request, or ``None`` to not cache
+        results.
+        '''
+        if not self.result_cache_size:
+            return None
+        return ResultCache(self.result_cache_size, self.identity)
 
     def pre_request(self, req):  # pragma: nocover
         '''
@@ -47,3 +81,154 @@ class SwitchboardMiddleware:
         if req:
             # Notify Switchboard that the request is finished
             request_finished.send(req)
+
+
+class ASGIHeaders(Mapping):
+    '''
+    The headers of an ASGI request, looked up case-insensitively. Repeated
+    headers are joined with commas.
+    '''
+    def __init__(self, raw_headers):
+        self._headers = {}
+        for name, value in raw_headers:
+            name = name.decode('latin-1').lower()
+            value = value.decode('latin-1')
+            if name in self._headers:
+                value = self._headers[name] + ',' + value
+            self._headers[name] = value
+
+    def __getitem__(self, name):
+        return self._headers[name.lower()]
+
+    def __contains__(self, name):
+        return isinstance(name, str) and name.lower() in self._headers
+
+    def __iter__(self):
+        return iter(self._headers)
+
+    def __len__(self):
+        return len(self._headers)
+
+
+class ASGIRequest:
+    '''
+    A lightweight, read-only request for an ASGI connection scope, with the
+    attributes :class:`~switchboard.conditions.RequestConditionSet` and the
+    builtin condition sets use. Each one is only worked out the first time
+    it's read, so requests that never check a switch cost next to nothing.
+    '''
+    def __init__(self, scope):
+        self.scope = scope
+
+    @property
+    def method(self):
+        return self.scope.get('method', 'GET')
+
+    @property
+    def scheme(self):
+        return self.scope.get('scheme', 'http')
+
+    @cached_property
+    def path(self):
+        return self.scope.get('root_path', '') + self.scope.get('path', '')
+
+    @cached_property
+    def query_string(self):
+        return self.scope.get('query_string', b'').decode('latin-1')
+
+    @cached_property
+    def headers(self):
+        return ASGIHeaders(self.scope.get('headers', ()))
+
+    @cached_property
+    def host(self):
+        host = self.headers.get('host')
+        if host is None and self.scope.get('server'):
+            # A list rather than a tuple from some servers; no port for a
+            # unix socket.
+            host, port = self.scope['server']
+            if port is not None:
+                host = '%s:%s' % (host, port)
+        return host
+
+    @cached_property
+    def remote_addr(self):
+        client = self.scope.get('client')
+        return client[0] if client else None
+
+    @cached_property
+    def referrer(self):
+        return self.headers.get('referer')
+
+    @cached_property
+    def environ(self):
+        '''
+        A WSGI environ for the request, for condition sets that read it
+        directly. There is no ``wsgi.input``: the body isn't read.
+        '''
+        server_name, server_port = self.scope.get('server') or ('', None)
+        environ = {
+            'REQUEST_METHOD': self.method,
+            'SCRIPT_NAME': self.scope.get('root_path', ''),
+            # Bytes as latin-1, like WSGI servers do.
+            'PATH_INFO': self.scope.get('path', '').encode().decode('latin-1'),
+            'QUERY_STRING': self.query_string,
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port or ''),
+            'SERVER_PROTOCOL': 'HTTP/' + self.scope.get('http_version', '1.1'),
+            'wsgi.url_scheme': self.scheme,
+        }
+        if self.remote_addr is not None:
+            environ['REMOTE_ADDR'] = self.remote_addr
+        for name, value in self.headers.items():
+            name = name.upper().replace('-', '_')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            environ[name] = value
+        return environ
+
+
+class SwitchboardASGIMiddleware(SwitchboardMiddleware):
+    '''
+    The ASGI counterpart of :class:`SwitchboardMiddleware`. Each HTTP or
+    websocket connection gets an :class:`ASGIRequest` in the operator's
+    context; as that is kept in context variables, connections served
+    concurrently on one event loop don't see each other's.
+
+    ``pre_request`` and ``post_request`` may also be coroutine functions.
+    ``post_request`` is passed the ``http.response.start`` message sent by
+    the app, if any, as the response.
+    '''
+    request_class = ASGIRequest
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket'):
+            await self.app(scope, receive, send)
+            return
+
+        req = self.request_class(scope)
+        resp = None
+
+        async def send_wrapper(message):
+            nonlocal resp
+            if message['type'] == 'http.response.start':
+                resp = message
+            await send(message)
+
+        operator.context = dict(operator.context, request=req)
+        operator.field_value_cache = {}
+        operator.result_cache = self.new_result_cache()
+        try:
+            await self._maybe_await(self.pre_request(req))
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            try:
+                await self._maybe_await(self.post_request(req, resp))
+            finally:
+                self.request_finished(req)
+                operator.result_cache = None
+
+    @staticmethod
+    async def _maybe_await(result):
+        if inspect.isawaitable(result):
+            await result
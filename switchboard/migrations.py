@@ -0,0 +1,74 @@
+"""
+switchboard.migrations
+~~~~~~~~~~~~~~~~
+
+Data migrations for existing deployments, run with::
+
+    python -m switchboard.migrations <migration> [--mongo-host ...]
+
+:copyright: (c) 2015 Kyle Adams.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import argparse
+import logging
+import sys
+
+from .manager import configure
+from .models import Switch
+
+log = logging.getLogger(__name__)
+
+
+def checkpoint_versions():
+    """
+    Backfills checkpoints for switch histories saved before they were
+    introduced (see :meth:`~switchboard.models.VersioningMongoModel.checkpoint_versions`).
+    """
+    count = Switch.checkpoint_versions()
+    log.info('Added checkpoints to %s switch histories', count)
+    return count
+
+
+def ensure_indexes():
+    """
+    Creates the indexes for the switches and their versions (see
+    :meth:`~switchboard.models.MongoModel.ensure_indexes`).
+    """
+    names = Switch.ensure_indexes()
+    log.info('Ensured indexes: %s', ', '.join(names))
+    return len(names)
+
+
+MIGRATIONS = {
+    'checkpoint_versions': checkpoint_versions,
+    'ensure_indexes': ensure_indexes,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m switchboard.migrations',
+        description='Runs a Switchboard data migration.')
+    parser.add_argument('migration', choices=sorted(MIGRATIONS))
+    parser.add_argument('--mongo-host', default='localhost')
+    parser.add_argument('--mongo-port', type=int, default=27017)
+    parser.add_argument('--mongo-db', default='switchboard')
+    parser.add_argument('--mongo-collection', default='switches')
+    args = parser.parse_args(argv)
+    configure(dict(
+        mongo_host=args.mongo_host,
+        mongo_port=args.mongo_port,
+        mongo_db=args.mongo_db,
+        mongo_collection=args.mongo_collection,
+        # Left to the migration, so that errors aren't just logged.
+        ensure_indexes=False,
+    ))
+    result = MIGRATIONS[args.migration]()
+    print(f'{args.migration}: {result}')
+    return 0
+
+
+if __name__ == '__main__':  # pragma: nocover
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
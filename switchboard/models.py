@@ -6,14 +6,20 @@ switchboard.models
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
+import atexit
+import copy
 import logging
+import os
+import queue
+import threading
 
 from blinker import signal
-from pymongo import DESCENDING
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from pymongo.results import InsertOneResult
 
 from .settings import settings
-from .helpers import MockCollection, utcnow
+from .helpers import BulkInsert, BulkUpdate, MockCollection, utcnow
 
 log = logging.getLogger(__name__)
 
@@ -35,6 +41,18 @@ class MongoModel:
     post_save = signal('post_save')
     pre_delete = signal('pre_delete')
     post_delete = signal('post_delete')
+    #: Sent once by save_many, with the list of saved instances, instead of
+    #: pre_save and post_save for each.
+    post_save_many = signal('post_save_many')
+
+    # Models that track changes stamp date_modified on every write and leave a
+    # tombstone behind for every delete, so that other processes can fetch
+    # just what changed (see changed_since).
+    track_changes = False
+
+    #: The indexes the model's queries need, as (keys, options) pairs for
+    #: create_index. Created by ensure_indexes.
+    indexes = []
 
     def __init__(self, *args, **kwargs):
         self.__dict__.update(kwargs)
@@ -45,27 +63,65 @@ class MongoModel:
         return self.__dict__.copy()
 
     def save(self):
+        if self.track_changes:
+            self.date_modified = utcnow()
+
+        document = self.to_bson()
         if hasattr(self, '_id'):
-            previous = self.get(_id=self._id)
+            _id = document.pop('_id', self._id)
+            self._send_before(self.pre_save, {'_id': _id})
+            # A single round trip (unless something listens to pre_save).
+            self.c.update_one({'_id': _id}, {'$set': document}, upsert=True)
         else:
-            previous = None
-        self.pre_save.send(previous)
-
-        if not previous:
-            result = self.c.insert_one(self.to_bson())
+            self.pre_save.send(None)
+            result = self.c.insert_one(document)
             # When pymongo's implementation of insert_one is used, it returns an InsertOneResult
             # instead of a plain _id, so we need to check the type to return the proper value
             _id = result.inserted_id if type(result) is InsertOneResult else result
-        else:
-            document = self.to_bson()
-            _id = document['_id']
-            self.c.update_one({'_id': _id}, {'$set': document})
 
         if not hasattr(self, '_id'):
             self._id = _id
         self.post_save.send(self)
         return _id
 
+    @classmethod
+    def _send_before(cls, signal, spec):
+        '''
+        Sends a pre_* ``signal`` with the document matching ``spec`` as it is
+        before the write, if anything listens to it; otherwise there's no
+        need to read it.
+        '''
+        if signal.receivers:
+            signal.send(cls.get(**spec))
+
+    @classmethod
+    def save_many(cls, instances):
+        '''
+        Saves a list of instances with a single bulk write, then sends
+        ``post_save_many`` once for all of them. Returns the instances.
+        '''
+        if not instances:
+            return []
+        now = utcnow()
+        requests = []
+        inserted = []
+        for instance in instances:
+            if cls.track_changes:
+                instance.date_modified = now
+            document = instance.to_bson()
+            if '_id' in document:
+                requests.append(BulkUpdate({'_id': document['_id']},
+                                           {'$set': document}, upsert=True))
+            else:
+                requests.append(BulkInsert(document))
+                inserted.append((instance, document))
+        cls.c.bulk_write(requests, ordered=True)
+        for instance, document in inserted:
+            # Set on the inserted document by the write.
+            instance._id = document['_id']
+        cls.post_save_many.send(instances)
+        return instances
+
     def delete(self):
         return self.remove(key=self.key)
 
@@ -92,22 +148,65 @@ class MongoModel:
         result = cls.c.find_one(kwargs)
         if not result:
             created = True
+            lookup = dict(kwargs)
             result = kwargs
             result.update(defaults)
             # Do an upsert here instead of a straight create to avoid a race
             # condition with another instance creating the same record at
             # nearly the same time.
-            cls.update(result, {'$set': result}, upsert=True)
-            result = cls.c.find_one(kwargs)
-            instance = cls(**result)
+            try:
+                instance = cls.find_and_update(result, {'$set': result},
+                                               upsert=True)
+            except DuplicateKeyError:
+                # Lost the race (with different defaults, which the upsert
+                # doesn't match); a unique index (see ensure_indexes) keeps
+                # there from being two.
+                created = False
+                instance = cls.get(**lookup)
         else:
             created = False
             instance = cls(**result)
         return instance, created
 
+    @classmethod
+    def create_missing(cls, field, documents):
+        '''
+        Inserts the documents whose ``field`` value isn't in the collection
+        yet, with a single bulk upsert, and returns instances for all of them
+        as they are stored. Unlike :meth:`create`, no signals are sent; the
+        instances actually inserted are passed to :meth:`_created_missing`.
+        '''
+        if not documents:
+            return []
+        requests = [BulkUpdate({field: document[field]},
+                               {'$setOnInsert': document}, upsert=True)
+                    for document in documents]
+        try:
+            result = cls.c.bulk_write(requests, ordered=False)
+            upserted = result.upserted_ids.values()
+        except BulkWriteError as e:
+            # Documents created by someone else in the meantime are read back
+            # below along with the others.
+            errors = e.details.get('writeErrors', [])
+            if any(error.get('code') != 11000 for error in errors):
+                raise
+            upserted = [u['_id'] for u in e.details.get('upserted', [])]
+        values = [document[field] for document in documents]
+        instances = [cls(**d)
+                     for d in cls.c.find({field: {'$in': values}}) or []]
+        upserted = set(upserted)
+        cls._created_missing([i for i in instances if i._id in upserted])
+        return instances
+
+    @classmethod
+    def _created_missing(cls, instances):
+        '''
+        Called with the instances :meth:`create_missing` inserted.
+        '''
+
     @classmethod
     def find(cls, **kwargs):
-        return [cls(**s) for s in cls.c.find(kwargs)]
+        return [cls(**s) for s in cls.c.find(kwargs) or []]
 
     @classmethod
     def update(cls, spec, document, upsert=False):
@@ -115,23 +214,116 @@ class MongoModel:
         Mimics a subset of PyMongo's Collection.update functionality. The spec
         is used to search for the document to update, document contains the
         values to be updated, and upsert specifies whether to do an insert if
-        the original document is not found.
+        the original document is not found. Returns the result of the
+        collection's ``update_one``; see :meth:`find_and_update` for the
+        updated instance instead.
         '''
-        previous = cls.get(**spec)
-        cls.pre_save.send(previous)
+        document = cls._stamp_update(document)
+        cls._send_before(cls.pre_save, spec)
         result = cls.c.update_one(spec, document, upsert=upsert)
         current = cls.get(**spec)
         cls.post_save.send(current)
         return result
 
+    @classmethod
+    def find_and_update(cls, spec, document, upsert=False):
+        '''
+        Same as :meth:`update`, but returns the updated instance (or ``None``
+        if there was nothing to update), which the update itself hands back:
+        a single round trip, unless something listens to pre_save.
+        '''
+        document = cls._stamp_update(document)
+        cls._send_before(cls.pre_save, spec)
+        current = cls.c.find_one_and_update(
+            spec, document, upsert=upsert,
+            return_document=ReturnDocument.AFTER)
+        current = cls(**current) if current else None
+        cls.post_save.send(current)
+        return current
+
+    @classmethod
+    def _stamp_update(cls, document):
+        if cls.track_changes and '$set' in document:
+            document = dict(document)
+            document['$set'] = dict(document['$set'], date_modified=utcnow())
+        return document
+
     @classmethod
     def remove(cls, **kwargs):
+        '''
+        Deletes the document matching ``kwargs`` and returns the result of the
+        collection's ``delete_one``; see :meth:`find_and_remove` for the
+        deleted instance instead.
+        '''
         instance = cls.get(**kwargs)
         cls.pre_delete.send(instance)
         result = cls.c.delete_one(kwargs)
-        cls.post_delete.send(instance)
+        cls._removed(instance)
         return result
 
+    @classmethod
+    def find_and_remove(cls, **kwargs):
+        '''
+        Same as :meth:`remove`, but returns the deleted instance (or ``None``
+        if there was no such document), which the delete itself hands back:
+        a single round trip, unless something listens to pre_delete.
+        '''
+        cls._send_before(cls.pre_delete, kwargs)
+        document = cls.c.find_one_and_delete(kwargs)
+        instance = cls(**document) if document else None
+        cls._removed(instance)
+        return instance
+
+    @classmethod
+    def _removed(cls, instance):
+        if cls.track_changes and instance is not None:
+            tombstone = instance.to_bson()
+            tombstone['deleted_id'] = tombstone.pop('_id', None)
+            tombstone['date_modified'] = utcnow()
+            cls._tombstone_collection().insert_one(tombstone)
+        cls.post_delete.send(instance)
+
+    @classmethod
+    def _tombstone_collection(cls):
+        return cls.c.database[cls.c.name + '.tombstones']
+
+    @classmethod
+    def _index_collections(cls):
+        '''
+        Returns the model's collections paired with the indexes each needs.
+        '''
+        collections = [(cls.c, list(cls.indexes))]
+        if cls.track_changes:
+            # For changed_since.
+            by_date = ([('date_modified', ASCENDING)], {})
+            collections[0][1].append(by_date)
+            collections.append((cls._tombstone_collection(), [by_date]))
+        return collections
+
+    @classmethod
+    def ensure_indexes(cls):
+        '''
+        Creates the indexes the model needs, if they don't exist yet, and
+        returns their names. Safe to call any number of times.
+        '''
+        names = []
+        for collection, indexes in cls._index_collections():
+            for keys, options in indexes:
+                names.append(collection.create_index(keys, **options))
+        return names
+
+    @classmethod
+    def changed_since(cls, since):
+        '''
+        Returns a tuple of (changed, deleted): the documents saved after the
+        ``since`` datetime, and tombstones (the deleted documents, minus their
+        ``_id``) for the ones deleted after it. Requires ``track_changes``.
+        '''
+        spec = {'date_modified': {'$gt': since}}
+        changed = [cls(**d) for d in cls.c.find(spec) or []]
+        deleted = list(cls._tombstone_collection().find(spec) or [])
+        return changed, deleted
+
     @classmethod
     def all(cls):
         return [cls(**s) for s in cls.c.find()]
@@ -142,6 +334,21 @@ class MongoModel:
 
 
 class VersioningMongoModel(MongoModel):
+    #: Every this many versions, the full state of the model is stored along
+    #: with the delta (a checkpoint), so that working out the previous version
+    #: only needs the versions since the latest checkpoint.
+    checkpoint_interval = 50
+    #: Newest first; ``_id`` breaks ties between versions saved at the same
+    #: time (ObjectIds increase).
+    version_sort = [('timestamp', DESCENDING), ('_id', DESCENDING)]
+    #: The index for reading a model's versions in version_sort order.
+    version_indexes = [
+        ([('switch_id', ASCENDING)] + version_sort, {}),
+    ]
+    #: How many versions queued by queue_version are saved at a time, and how
+    #: many can be waiting before queueing another blocks.
+    version_batch_size = 100
+    version_backlog = 10000
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -150,16 +357,27 @@ class VersioningMongoModel(MongoModel):
     def _versioned_collection(cls):
         return cls.c.database[cls.c.name + '.versions']
 
-    def _diff(self):
+    @classmethod
+    def _index_collections(cls):
+        return super()._index_collections() + [
+            (cls._versioned_collection(), cls.version_indexes)]
+
+    def _current_state(self):
         # Need to verify that the data contained in self is actually still in
         # the collection
         if hasattr(self, '_id'):
             curr = self.get(_id=self._id)
-            curr = curr.to_bson() if curr else None
-        else:
-            curr = None
+            return curr.to_bson() if curr else None
+        return None
+
+    def _diff(self):
+        curr = self._current_state()
         prev = self.previous_version()
         prev = prev.to_bson() if prev else None
+        return self._delta(prev, curr)
+
+    @staticmethod
+    def _delta(prev, curr):
         # Both models are present so something's changed between them
         if prev and curr:
             current_fields = list(curr.keys())
@@ -194,16 +412,86 @@ class VersioningMongoModel(MongoModel):
         return delta
 
     def save_version(self, **kwargs):
-        delta = self._diff()
-        # if nothing changed, don't save anything
-        if delta and (delta['added'] or delta['deleted'] or delta['changed']):
+        change = (self._id, self._current_state(), utcnow(), kwargs)
+        for doc in self.version_documents([change]):
+            self._versioned_collection().insert_one(doc)
+
+    @classmethod
+    def version_documents(cls, changes):
+        '''
+        Returns the version documents to save for a list of changes, in the
+        order they were made, given as (_id, state, timestamp, kwargs) tuples;
+        ``state`` is the document after the change, or ``None`` once deleted.
+        Each model's history is only read once, however many of its changes
+        there are.
+        '''
+        docs = []
+        histories = {}
+        for _id, curr, timestamp, kwargs in changes:
+            if _id not in histories:
+                histories[_id] = cls(_id=_id)._previous_state()
+            prev, since_checkpoint = histories[_id]
+            delta = cls._delta(prev or None, curr)
+            # if nothing changed, don't save anything
+            if not (delta['added'] or delta['deleted'] or delta['changed']):
+                continue
             doc = dict(
-                switch_id=self._id,
-                timestamp=utcnow(),
+                switch_id=_id,
+                timestamp=timestamp,
                 delta=delta,
                 **kwargs
             )
-            self._versioned_collection().insert_one(doc)
+            since_checkpoint += 1
+            if since_checkpoint >= cls.checkpoint_interval:
+                doc['checkpoint'] = curr or {}
+                since_checkpoint = 0
+            histories[_id] = (curr or {}, since_checkpoint)
+            docs.append(doc)
+        return docs
+
+    @classmethod
+    def version_writer(cls):
+        '''
+        Returns the :class:`VersionWriter` for the model, starting it if
+        needed. It is shared by all threads.
+        '''
+        with _version_writers_lock:
+            writer = _version_writers.get(cls)
+            if writer is None or not writer.is_alive():
+                writer = _version_writers[cls] = VersionWriter(
+                    cls, cls.version_batch_size, cls.version_backlog)
+                writer.start()
+            return writer
+
+    @classmethod
+    def save_versions(cls, instances, **kwargs):
+        '''
+        Saves the versions for a list of instances that have just been saved
+        (e.g. by :meth:`save_many`) with a single ``insert_many``.
+        '''
+        now = utcnow()
+        changes = [(i._id, copy.deepcopy(i.to_bson()), now, kwargs)
+                   for i in instances]
+        docs = cls.version_documents(changes)
+        if docs:
+            cls._versioned_collection().insert_many(docs, ordered=True)
+
+    @classmethod
+    def _created_missing(cls, instances):
+        # No post_save is sent for them, so their versions aren't otherwise
+        # saved.
+        for instance in instances:
+            instance.queue_version()
+
+    def queue_version(self, deleted=False, **kwargs):
+        '''
+        Like :meth:`save_version`, but the version is saved by the model's
+        :meth:`version_writer` in the background. The current state is taken
+        from this instance (which must have just been saved, or ``deleted``)
+        rather than read back from the database.
+        '''
+        state = None if deleted else copy.deepcopy(self.to_bson())
+        self.version_writer().add(self._id, state, **kwargs)
 
     def _unpack_delta(self, version):
         '''
@@ -216,30 +504,171 @@ class VersioningMongoModel(MongoModel):
         changed = delta.get('changed', {})
         return delta, added, deleted, changed
 
+    def _apply_delta(self, state, version):
+        delta, added, deleted, changed = self._unpack_delta(version)
+        state.update(added)
+        for k in deleted.keys():
+            if k in state:
+                del state[k]
+        for k, v in changed.items():
+            old, new = v
+            state[k] = new
+
+    def _previous_state(self):
+        '''
+        Returns a tuple of (state, count): the state of the model as of its
+        latest version, and how many versions were saved since the latest
+        checkpoint.
+        '''
+        vc = self._versioned_collection()
+        versions = vc.find(dict(switch_id=self._id), sort=self.version_sort)
+        previous = dict()
+        since_checkpoint = []
+        # Walk back from the latest version to the latest checkpoint, which
+        # holds the full state as of that version, then replay the deltas
+        # saved after it. Histories from before checkpoints were introduced
+        # are replayed from the start.
+        for v in versions or ():
+            if 'checkpoint' in v:
+                previous = dict(v['checkpoint'])
+                break
+            since_checkpoint.append(v)
+        for v in reversed(since_checkpoint):
+            self._apply_delta(previous, v)
+        return previous, len(since_checkpoint)
+
     def previous_version(self):
         if not hasattr(self, '_id'):
             return self.__class__()
-        vc = self._versioned_collection()
-        versions = vc.find(dict(switch_id=self._id))
-        previous = dict()
-        # build up the previous state based on all past deltas
-        if versions:
-            # Before sorting, ensure we're working with a list and not a cursor
-            # or other iterable.
-            versions = list(versions)
-            versions.sort(key=lambda x: x['timestamp'])
-            for v in versions:
-                delta, added, deleted, changed = self._unpack_delta(v)
-                previous.update(added)
-                for k in deleted.keys():
-                    if k in previous:
-                        del previous[k]
-                for k, v in changed.items():
-                    old, new = v
-                    previous[k] = new
+        previous, _ = self._previous_state()
         previous = self.__class__(**previous) if previous else None
         return previous
 
+    @classmethod
+    def checkpoint_versions(cls):
+        '''
+        Adds a checkpoint to the latest version of every history that doesn't
+        end with one, replaying the history in full. Versions saved before
+        checkpoints were introduced get one within ``checkpoint_interval``
+        saves anyway; this spares the first of those saves the replay. Returns
+        the number of checkpoints added.
+        '''
+        vc = cls._versioned_collection()
+        added = 0
+        for switch_id in vc.distinct('switch_id'):
+            latest = vc.find(dict(switch_id=switch_id),
+                             sort=cls.version_sort)[0]
+            if 'checkpoint' in latest:
+                continue
+            state = cls(_id=switch_id)._previous_state()[0]
+            vc.update_one({'_id': latest['_id']},
+                          {'$set': {'checkpoint': state}})
+            added += 1
+        return added
+
+
+# Queued by VersionWriter.stop(), after the versions still waiting.
+_stop_writing = object()
+
+
+class VersionWriter(threading.Thread):
+    """
+    Daemon thread that saves the versions of a
+    :class:`VersioningMongoModel` queued by
+    :meth:`~VersioningMongoModel.queue_version`, up to ``batch_size`` at a
+    time with a single ``insert_many``. Once ``max_backlog`` versions are
+    waiting, queueing another blocks until there's room. The versions still
+    queued are saved when the process exits.
+    """
+    def __init__(self, model, batch_size=100, max_backlog=10000):
+        super().__init__(name='switchboard-version-writer', daemon=True)
+        self.model = model
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_backlog)
+        self.stopped = threading.Event()
+
+    def add(self, _id, state, **kwargs):
+        self.queue.put((_id, state, utcnow(), kwargs))
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while (len(batch) < self.batch_size
+                   and batch[-1] is not _stop_writing):
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            changes = [c for c in batch if c is not _stop_writing]
+            try:
+                self.write(changes)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if len(changes) < len(batch):
+                return
+
+    def write(self, changes):
+        if not changes:
+            return
+        try:
+            docs = self.model.version_documents(changes)
+            if docs:
+                self.model._versioned_collection().insert_many(
+                    docs, ordered=True)
+        except Exception:
+            log.exception('Unable to save %s versions', len(changes))
+
+    def flush(self):
+        """
+        Waits for the versions queued so far to be saved.
+        """
+        if self.is_alive():
+            self.queue.join()
+
+    def stop(self):
+        """
+        Saves the versions still queued, then stops the thread.
+        """
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        if self.is_alive():
+            self.queue.put(_stop_writing)
+            if self is not threading.current_thread():
+                self.join()
+
+
+# Version writers by model class, shared by all threads.
+_version_writers = {}
+_version_writers_lock = threading.Lock()
+
+
+def stop_version_writers():
+    """
+    Saves the versions still queued and stops all of the version writers.
+    """
+    with _version_writers_lock:
+        writers = list(_version_writers.values())
+        _version_writers.clear()
+    for writer in writers:
+        writer.stop()
+
+
+atexit.register(stop_version_writers)
+
+
+def _after_fork():
+    # The writer threads don't survive a fork; the versions queued before it
+    # are saved by the parent.
+    global _version_writers_lock
+    _version_writers_lock = threading.Lock()
+    _version_writers.clear()
+
+
+if hasattr(os, 'register_at_fork'):  # pragma: nocover
+    os.register_at_fork(after_in_child=_after_fork)
+
 
 class Switch(VersioningMongoModel):
     """
@@ -269,6 +698,13 @@ class Switch(VersioningMongoModel):
         DISABLED: 'Disabled for everyone',
     }
 
+    track_changes = True
+    # Keys are unique, which also settles races to create the same switch.
+    indexes = [([('key', ASCENDING)], {'unique': True})]
+    # All that's needed to check a switch, for caches that only store some
+    # fields (see switchboard.serialization.CompactCodec).
+    cache_fields = ('_id', 'key', 'status', 'value')
+
     def __init__(self, *args, **kwargs):
         if (
             kwargs and
@@ -477,7 +913,10 @@ class Switch(VersioningMongoModel):
         Return a display-friendly list of all versions.
         '''
         vc = self._versioned_collection()
-        return list(vc.find(
+        versions = list(vc.find(
             dict(switch_id=self._id),
-            sort=[('timestamp', DESCENDING)],
-        ))
+            sort=self.version_sort,
+        ) or [])
+        # Checkpoints are only there to speed up saves.
+        return [{k: v for k, v in version.items() if k != 'checkpoint'}
+                for version in versions]
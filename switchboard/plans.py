@@ -0,0 +1,191 @@
+"""
+switchboard.plans
+~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2015 Kyle Adams.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from .conditions import ConditionSet
+from .models import DISABLED, GLOBAL, INHERIT
+
+
+def _checks_raw_conditions(condition_set):
+    """
+    Returns ``True`` if ``condition_set`` overrides
+    :meth:`ConditionSet.is_active` or :meth:`ConditionSet.has_active_condition`
+    (but not the compiled versions), so checking a compiled condition would
+    bypass its own logic.
+    """
+    if not isinstance(condition_set, ConditionSet):
+        return False
+    cls = type(condition_set)
+    if (cls.has_active_compiled is not ConditionSet.has_active_compiled
+            or cls.is_active_compiled is not ConditionSet.is_active_compiled):
+        return False
+    return (cls.is_active is not ConditionSet.is_active
+            or cls.has_active_condition is not ConditionSet.has_active_condition)
+
+
+class SwitchPlan:
+    """
+    A switch compiled for evaluation. The switch's conditions are resolved
+    against the registered condition sets and each condition value is parsed
+    once (see :meth:`ConditionSet.compile`), so checking the switch does no
+    registry lookups or string parsing.
+
+    Condition sets that override :meth:`ConditionSet.is_active` or
+    :meth:`ConditionSet.has_active_condition` keep the raw condition and are
+    checked through ``has_active_condition`` instead.
+
+    Plans are built from the manager's local cache and discarded whenever the
+    cache is reloaded or a condition set is (un)registered.
+    """
+    def __init__(self, switch, condition_sets):
+        self.switch = switch
+        self.status = switch.status
+        conditions = switch.value or {}
+        # Any conditions at all, even for unregistered condition sets, stop
+        # the switch from inheriting its parent's result.
+        self.has_conditions = bool(conditions)
+        self.conditions = []
+        self.raw_conditions = []
+        for namespace, condition in conditions.items():
+            condition_set = condition_sets.get(namespace)
+            if not condition_set:
+                continue
+            if _checks_raw_conditions(condition_set):
+                self.raw_conditions.append((condition_set, condition))
+            else:
+                compiled = condition_set.compile(condition)
+                self.conditions.append((condition_set, compiled))
+
+    def is_active(self, evaluation, default):
+        """
+        Returns whether the switch is active for an :class:`Evaluation`,
+        falling back to ``default`` (the parent's result) when the switch
+        inherits.
+        """
+        if self.status == GLOBAL:
+            return True
+        elif self.status == DISABLED:
+            return False
+        elif self.status == INHERIT:
+            return default
+
+        # If no conditions are set, we inherit from parents
+        if not self.has_conditions:
+            return default
+
+        return_value = False
+        for condition_set, compiled in self.conditions:
+            result = condition_set.has_active_compiled(
+                compiled, evaluation.instances, evaluation)
+            if result is False:
+                return False
+            elif result is True:
+                return_value = True
+        for condition_set, condition in self.raw_conditions:
+            # has_active_condition adds the trailing None itself.
+            result = condition_set.has_active_condition(
+                condition, evaluation.instances[:-1])
+            if result is False:
+                return False
+            elif result is True:
+                return_value = True
+
+        # there were no matching conditions, so it must not be enabled
+        return return_value
+
+
+class ChainPlan:
+    """
+    A switch together with its parents (e.g. ``foo`` and ``foo:bar`` for
+    ``foo:bar:baz``), resolved ahead of time so that checking a key with
+    parents costs one lookup rather than one per parent.
+
+    Statuses that don't depend on the instances are folded down the chain
+    when it's built: any ``DISABLED`` switch disables the whole chain, and a
+    ``GLOBAL`` one makes it active unless a switch with conditions says
+    otherwise. Only switches with conditions are left to check.
+
+    Chains are built from the manager's local cache and discarded along with
+    the plans.
+    """
+    def __init__(self, parent, plan):
+        self.disabled = parent.disabled if parent else False
+        self.enabled = parent.enabled if parent else False
+        self.selective = list(parent.selective) if parent else []
+        if plan is not None:
+            if plan.status == DISABLED:
+                self.disabled = True
+            elif plan.status == GLOBAL:
+                self.enabled = True
+            elif plan.status != INHERIT and plan.has_conditions:
+                self.selective.append(plan)
+        if self.disabled:
+            self.enabled = False
+            self.selective = []
+
+    def is_active(self, evaluation, default):
+        """
+        Returns whether the switch is active for an :class:`Evaluation`,
+        falling back to ``default`` if neither the switch nor its parents
+        decide. The results of switches with conditions are kept in
+        ``evaluation.results`` so other keys with the same parents reuse them.
+        """
+        if self.disabled:
+            return False
+        return_value = True if self.enabled else default
+        results = evaluation.results
+        for plan in self.selective:
+            try:
+                result = results[plan]
+            except KeyError:
+                result = results[plan] = plan.is_active(evaluation, None)
+            if result is False:
+                return False
+            elif result is True:
+                return_value = True
+        return return_value
+
+
+class Evaluation:
+    """
+    State shared by every switch checked against the same instances: the
+    instances themselves (including the manager's context objects and the
+    trailing ``None``), the parent chains of the keys checked, results for
+    switches with conditions, and the values read off the instances by
+    condition sets.
+
+    ``field_values`` may be a dict that outlives the evaluation (e.g. one
+    kept for the duration of a request), in which case field values are
+    shared with every other evaluation using the same dict.
+    """
+    def __init__(self, instances, field_values=None):
+        self.instances = instances
+        self.results = {}
+        self.chains = {}
+        self.field_values = {} if field_values is None else field_values
+
+    def get_field_value(self, condition_set, instance, field_name):
+        """
+        Returns ``condition_set.get_field_value(instance, field_name)``,
+        calling it at most once per instance for as long as ``field_values``
+        is kept, unless the condition set opts out of caching.
+        """
+        if not condition_set.cache_field_values:
+            return condition_set.get_field_value(instance, field_name)
+        key = (condition_set, id(instance), field_name)
+        try:
+            cached_instance, value = self.field_values[key]
+        except KeyError:
+            pass
+        else:
+            # The id of a discarded instance can be reused by a new object,
+            # so make sure this really is the instance the value came from.
+            if cached_instance is instance:
+                return value
+        value = condition_set.get_field_value(instance, field_name)
+        self.field_values[key] = (instance, value)
+        return value
@@ -35,3 +35,22 @@ class SwitchProxy:
     def get_active_conditions(self, *args, **kwargs):
         return self._switch.get_active_conditions(self._manager, *args,
                                                   **kwargs)
+
+
+class BatchSwitchProxy(SwitchProxy):
+    """
+    A SwitchProxy for a switch in a batch (see
+    :meth:`~switchboard.manager.SwitchManager.batch`): changes to its
+    conditions are saved with the batch rather than straight away.
+    """
+    def add_condition(self, *args, **kwargs):
+        kwargs['commit'] = False
+        return super().add_condition(*args, **kwargs)
+
+    def remove_condition(self, *args, **kwargs):
+        kwargs['commit'] = False
+        return super().remove_condition(*args, **kwargs)
+
+    def clear_conditions(self, *args, **kwargs):
+        kwargs['commit'] = False
+        return super().clear_conditions(*args, **kwargs)
@@ -0,0 +1,124 @@
+"""
+switchboard.serialization
+~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2015 Kyle Adams.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import pickle
+
+from bson import ObjectId
+
+
+class Codec:
+    """
+    Converts the data of a :class:`~switchboard.base.CachedDict` to and from
+    the bytes stored in the cache backend. Each value is encoded on its own
+    so that it can be decoded lazily, the first time it's used.
+    """
+    #: Whether decoded values leave out some of the fields of the original.
+    partial = False
+
+    def encode_item(self, value):
+        raise NotImplementedError  # pragma: nocover
+
+    def decode_item(self, payload):
+        raise NotImplementedError  # pragma: nocover
+
+    def may_have_id(self, payload, _id):
+        """
+        Returns whether the value encoded in ``payload`` could have the given
+        ``_id``, without decoding it; ``False`` only if it can't.
+        """
+        return True
+
+    def encode(self, items, generation=None, versions=None, synced_at=None):
+        """
+        Returns the bytes for a dict of encoded values, along with the
+        metadata of the data they came from.
+        """
+        raise NotImplementedError  # pragma: nocover
+
+    def decode(self, payload):
+        """
+        Returns a tuple of (items, generation, versions, synced_at), or
+        ``None`` if ``payload`` wasn't encoded by this codec (e.g. by another
+        version of it).
+        """
+        raise NotImplementedError  # pragma: nocover
+
+
+class CompactCodec(Codec):
+    """
+    Stores only the fields of each model instance needed to check it (the
+    model's ``cache_fields``, or all of them if it doesn't declare any or
+    ``fields`` is empty) as plain tuples, rather than pickling whole
+    instances.
+
+    The payload starts with a magic number and a schema version, followed by
+    a pickle of the metadata and the encoded values. Payloads from other
+    schema versions, or for other fields, are ignored.
+    """
+    magic = b'SBC'
+    version = 1
+
+    def __init__(self, model, fields=None):
+        self.model = model
+        if fields is None:
+            fields = getattr(model, 'cache_fields', None)
+        self.fields = tuple(fields) if fields else None
+        self.partial = self.fields is not None
+        self.header = self.magic + bytes([self.version])
+
+    def encode_item(self, value):
+        if self.fields is None:
+            values = value.to_bson()
+        else:
+            values = tuple(getattr(value, field, None)
+                           for field in self.fields)
+        return pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+
+    def decode_item(self, payload):
+        values = pickle.loads(payload)
+        if self.fields is not None:
+            values = {field: value
+                      for field, value in zip(self.fields, values)
+                      if value is not None}
+        return self.model(**values)
+
+    def may_have_id(self, payload, _id):
+        if self.fields is not None and '_id' not in self.fields:
+            return False
+        # Pickles hold strings (as UTF-8) and ObjectIds' bytes as they are.
+        if isinstance(_id, str):
+            needle = _id.encode('utf-8', 'surrogatepass')
+        elif isinstance(_id, ObjectId):
+            needle = _id.binary
+        else:
+            return True
+        return needle in bytes(payload)
+
+    def encode(self, items, generation=None, versions=None, synced_at=None):
+        body = (self.fields, generation, versions, synced_at, items)
+        return self.header + pickle.dumps(body, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, payload):
+        if not payload.startswith(self.header):
+            return None
+        fields, generation, versions, synced_at, items = pickle.loads(
+            payload[len(self.header):])
+        if fields != self.fields:
+            return None
+        return items, generation, versions, synced_at
+
+
+def get_codec(codec, model):
+    """
+    Returns the codec to use for ``model``'s cache data given the
+    ``SWITCHBOARD_CACHE_CODEC`` setting: ``None``, ``'compact'`` or a
+    :class:`Codec` instance.
+    """
+    if codec == 'compact':
+        return CompactCodec(model)
+    return codec or None
@@ -0,0 +1,322 @@
+"""
+switchboard.snapshots
+~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2015 Kyle Adams.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: nocover
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+# The file at the snapshot path: a magic number, the current version and the
+# time the writer last wrote or confirmed it.
+HEADER = struct.Struct('<4s4xQd')
+HEADER_MAGIC = b'SBSH'
+# The start of each version's data file: a magic number and the length of the
+# pickled index that follows it. The encoded values come after the index.
+INDEX = struct.Struct('<4s4xQ')
+DATA_MAGIC = b'SBSD'
+
+
+class SnapshotFile:
+    """
+    A snapshot of a :class:`~switchboard.base.CachedDict`'s data in a file,
+    shared by all of the processes on a host (e.g. the workers of a pre-fork
+    server) so that they don't each load it from the cache backend or the
+    database.
+
+    The file at ``path`` only holds a header with the current version. The
+    data for each version is written to ``<path>.<version>`` and atomically
+    renamed into place before the header is updated. Readers map both
+    read-only, so checking for a new version is just a memory read, the data
+    is in memory once per host and values are decoded lazily, straight from
+    the mapping.
+
+    One process at a time is elected to write the snapshot, by holding an
+    exclusive lock on ``<path>.lock``; when it exits, another takes over.
+    While the writer keeps the data current it stamps the header (see
+    :meth:`touch`), so readers can tell when it has stopped (see
+    :meth:`age`).
+    """
+    #: Seconds between attempts to open the header before one is written.
+    retry_interval = 1
+    #: Seconds between the writer's stamps of an unchanged snapshot.
+    touch_interval = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.is_writer = False
+        # The data last written by this process, to avoid writing it again.
+        self.written = None
+        self._lock_fd = None
+        self._version = 0
+        self._touched_at = 0
+        self._header = None
+        self._opened_at = 0
+        self._loaded = (0, None)
+
+    def version(self):
+        """
+        Returns the current version, or 0 if no snapshot has been written.
+        """
+        header = self._get_header()
+        if header is None:
+            return 0
+        magic, version, _ = HEADER.unpack_from(header)
+        return version if magic == HEADER_MAGIC else 0
+
+    def age(self):
+        """
+        Returns how many seconds ago the snapshot was last written or
+        confirmed current by the writer, or ``None`` if there's no snapshot.
+        """
+        header = self._get_header()
+        if header is None:
+            return None
+        magic, version, written_at = HEADER.unpack_from(header)
+        if magic != HEADER_MAGIC or not version:
+            return None
+        return time.time() - written_at
+
+    def touch(self):
+        """
+        Marks the snapshot the writer last wrote as still current, at most
+        once per ``touch_interval``.
+        """
+        if (not self.is_writer or not self._version
+                or time.time() - self._touched_at < self.touch_interval):
+            return
+        with self.lock:
+            if self.is_writer and self._read_version() == self._version:
+                self._write_version(self._version)
+
+    def _get_header(self):
+        if self._header is None:
+            now = time.time()
+            if now - self._opened_at < self.retry_interval:
+                return None
+            self._opened_at = now
+            try:
+                with open(self.path, 'rb') as f:
+                    self._header = mmap.mmap(f.fileno(), HEADER.size,
+                                             access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return None
+        return self._header
+
+    def read(self, codec, wrap):
+        """
+        Returns a tuple of (version, data) for the current version, or
+        ``(0, None)`` if there's no usable snapshot. ``wrap`` is called with
+        ``(items, generation, versions, synced_at)``, where items are encoded
+        with ``codec``, to build the data; the result is shared by every
+        reader until the version changes.
+        """
+        version = self.version()
+        if not version:
+            return 0, None
+        loaded = self._loaded
+        if loaded[0] == version:
+            return loaded
+        with self.lock:
+            if self._loaded[0] != version:
+                try:
+                    decoded = self._load(version, codec)
+                except (OSError, ValueError, pickle.UnpicklingError):
+                    log.exception('Unable to read snapshot version %s',
+                                  version)
+                    decoded = None
+                if decoded is None:
+                    return 0, None
+                self._loaded = (version, wrap(*decoded))
+            return self._loaded
+
+    def _load(self, version, codec):
+        with open(f'{self.path}.{version}', 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = INDEX.unpack_from(mapping)
+        if magic != DATA_MAGIC:
+            return None
+        start = INDEX.size + length
+        signature, generation, versions, synced_at, offsets = pickle.loads(
+            mapping[INDEX.size:start])
+        # Written with a different codec (or version of one).
+        if codec.decode(signature) is None:
+            return None
+        view = memoryview(mapping)
+        items = {key: view[start + offset:start + offset + size]
+                 for key, (offset, size) in offsets.items()}
+        return items, generation, versions, synced_at
+
+    def write(self, codec, items, generation=None, versions=None,
+              synced_at=None):
+        """
+        Writes a new version of the snapshot from a dict of values encoded
+        with ``codec`` and returns it. Processes that aren't the elected
+        writer (e.g. the master of a pre-fork server) hold the lock just while
+        writing, and leave it to the writer if there is one (returning
+        ``None``).
+        """
+        with self.lock:
+            if self.is_writer:
+                return self._write(codec, items, generation, versions,
+                                   synced_at)
+            try:
+                fd = self._lock()
+            except OSError:
+                return None
+            try:
+                return self._write(codec, items, generation, versions,
+                                   synced_at)
+            finally:
+                os.close(fd)
+
+    def _write(self, codec, items, generation, versions, synced_at):
+        offsets = {}
+        position = 0
+        for key, payload in items.items():
+            offsets[key] = (position, len(payload))
+            position += len(payload)
+        index = pickle.dumps(
+            (codec.encode({}), generation, versions, synced_at, offsets),
+            pickle.HIGHEST_PROTOCOL)
+
+        version = self._read_version() + 1
+        path = f'{self.path}.{version}'
+        with open(path + '.tmp', 'wb') as f:
+            f.write(INDEX.pack(DATA_MAGIC, len(index)))
+            f.write(index)
+            for payload in items.values():
+                f.write(payload)
+        os.replace(path + '.tmp', path)
+        self._write_version(version)
+
+        # Readers that saw the previous version may still be opening it.
+        try:
+            os.remove(f'{self.path}.{version - 2}')
+        except OSError:
+            pass
+        return version
+
+    def _read_version(self):
+        try:
+            with open(self.path, 'rb') as f:
+                magic, version, _ = HEADER.unpack(f.read(HEADER.size))
+        except (OSError, struct.error):
+            return 0
+        return version if magic == HEADER_MAGIC else 0
+
+    def _write_version(self, version):
+        self._version = version
+        self._touched_at = now = time.time()
+        header = HEADER.pack(HEADER_MAGIC, version, now)
+        try:
+            fd = os.open(self.path, os.O_WRONLY)
+        except FileNotFoundError:
+            # Readers must never map a partly written header.
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(header)
+            os.replace(self.path + '.tmp', self.path)
+            return
+        try:
+            # Small enough to land in one go; readers see old or new.
+            os.pwrite(fd, header, 0)
+        finally:
+            os.close(fd)
+
+    def _lock(self):
+        if fcntl is None:  # pragma: nocover
+            raise OSError('Snapshot files require fcntl.flock')
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            raise
+        return fd
+
+    def acquire(self):
+        """
+        Tries to become the writer, without waiting. Returns whether this
+        process is the writer.
+        """
+        with self.lock:
+            if not self.is_writer:
+                try:
+                    self._lock_fd = self._lock()
+                except OSError:
+                    return False
+                self.is_writer = True
+                self.written = None
+            return True
+
+    def release(self):
+        """
+        Stops being the writer, letting another process take over.
+        """
+        with self.lock:
+            if self.is_writer:
+                os.close(self._lock_fd)
+                self._lock_fd = None
+                self.is_writer = False
+
+    def _after_fork(self):
+        # The lock belongs to the parent; closing our copy of its file
+        # descriptor doesn't release it.
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+        self._lock_fd = None
+        self.is_writer = False
+        self.written = None
+        self._version = 0
+        self.lock = threading.Lock()
+
+
+_files = {}
+_files_lock = threading.Lock()
+
+
+def get_snapshot_file(path):
+    """
+    Returns the :class:`SnapshotFile` for ``path``, shared by every thread.
+    """
+    with _files_lock:
+        try:
+            return _files[path]
+        except KeyError:
+            return _files.setdefault(path, SnapshotFile(path))
+
+
+def _before_fork():
+    """
+    A forked child shares the writer's lock with its parent, and the lock
+    is held for as long as either keeps it open, so a parent that became the
+    writer (e.g. the master of a pre-fork server that checked a switch)
+    would stop its workers from ever taking over. Give up the role first;
+    the parent takes part in the next election like any other process.
+    """
+    for snapshot_file in list(_files.values()):
+        snapshot_file.release()
+
+
+def _after_fork():
+    for snapshot_file in list(_files.values()):
+        snapshot_file._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):  # pragma: nocover
+    os.register_at_fork(before=_before_fork, after_in_child=_after_fork)
@@ -6,16 +6,28 @@ switchboard.tests.test_base
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
+import os
 import time
 import threading
+from datetime import timedelta
 
 import pytest
 import pytest as pytest
 from unittest.mock import Mock, patch
 from blinker import Signal
 
-from ..base import MongoModelDict, CachedDict
-from ..models import VersioningMongoModel
+from ..base import (
+    MongoModelDict,
+    CachedDict,
+    CacheData,
+    Encoded,
+    NoValue,
+    Refresher,
+    Watcher,
+)
+from ..models import Switch, VersioningMongoModel
+from ..serialization import CompactCodec
+from ..snapshots import SnapshotFile
 from ..signals import request_finished
 
 
@@ -154,6 +166,666 @@ class TestMongoModelDict:
         assert request_finished.has_receivers_for(Signal.ANY)
 
 
+class DictCache(dict):
+    """
+    A cache backend that keeps values in a dict.
+    """
+    def set(self, key, value):
+        self[key] = value
+
+    def add(self, key, value, timeout=0):
+        return self.setdefault(key, value) is value
+
+    def delete(self, key):
+        self.pop(key, None)
+
+    def __bool__(self):
+        # An empty cache is still a cache.
+        return True
+
+
+class TestCachePatching:
+    def setup_method(self):
+        self.cache = Mock(wraps=DictCache())
+        self.mydict = MongoModelDict(MockModel, key='key', value='value',
+                                     auto_create=True)
+        self.mydict.cache = self.cache
+        # Stands in for another process, which doesn't see our signals.
+        self.other = MongoModelDict(MockModel, key='key', value='value')
+        self.other.cache = self.cache
+        MockModel.post_save.disconnect(self.other._post_save)
+        MockModel.post_delete.disconnect(self.other._post_delete)
+        self.mydict['hello'] = MockModel(key='hello', value='foo')
+        self.mydict['world'] = MockModel(key='world', value='foo')
+
+    def teardown_method(self):
+        MockModel.c.drop()
+
+    def test_save_patches_key(self):
+        generation, versions = self.mydict._cache.get_versions()
+        self.cache.reset_mock()
+        with patch.object(MockModel, 'all') as all:
+            self.mydict['hello'] = 'bar'
+            assert not all.called
+        assert self.mydict._cache['hello'].value == 'bar'
+        assert self.mydict._cache.generation == generation
+        blob = self.cache.get(self.mydict.cache_key)
+        assert blob['hello'].value == 'bar'
+        assert blob['world'].value == 'foo'
+        remote = self.cache.get(self.mydict.versions_cache_key)
+        assert remote[0] == generation
+        assert remote[1]['hello'] > versions.get('hello', 0)
+        assert remote[1]['world'] == versions['world']
+
+    def test_delete_patches_key(self):
+        version = self.mydict._cache.versions.get('hello', 0)
+        self.cache.reset_mock()
+        with patch.object(MockModel, 'all') as all:
+            del self.mydict['hello']
+            assert not all.called
+        assert 'hello' not in self.mydict._cache
+        assert 'hello' not in self.cache.get(self.mydict.cache_key)
+        versions = self.cache.get(self.mydict.versions_cache_key)[1]
+        assert versions['hello'] > version
+
+    def test_save_many_patches_keys(self):
+        MockModel.post_save_many.disconnect(self.other._post_save_many)
+        hello = MockModel.get(key='hello')
+        hello.value = 'bar'
+        new = MockModel(key='new', value='baz')
+        self.cache.reset_mock()
+        with patch.object(MockModel, 'all') as all:
+            MockModel.save_many([hello, new])
+            assert not all.called
+        assert self.mydict._cache['hello'].value == 'bar'
+        assert self.mydict._cache['new'].value == 'baz'
+        sets = [c.args[0] for c in self.cache.set.call_args_list]
+        assert sets.count(self.mydict.cache_key) == 1
+        assert self.other['new'].value == 'baz'
+
+    def test_patch_many(self):
+        generation = self.mydict._cache.generation
+        self.cache.reset_mock()
+        patched = self.mydict.patch_many({
+            'hello': MockModel(key='hello', value='bar'),
+            'world': NoValue,
+        })
+        assert patched
+        assert self.mydict._cache.generation == generation
+        assert self.mydict._cache['hello'].value == 'bar'
+        assert 'world' not in self.mydict._cache
+        blob = self.cache.get(self.mydict.cache_key)
+        assert blob['hello'].value == 'bar'
+        assert 'world' not in blob
+        sets = [c.args[0] for c in self.cache.set.call_args_list]
+        assert sets.count(self.mydict.cache_key) == 1
+
+    def test_interleaved_patches_are_not_lost(self):
+        inside, proceed = threading.Event(), threading.Event()
+        set_global_data = MongoModelDict._set_global_data
+
+        def paused(mydict, data):
+            if not inside.is_set():
+                inside.set()
+                proceed.wait(5)
+            set_global_data(mydict, data)
+
+        def patch_hello():
+            self.mydict.cache = self.cache
+            self.mydict.patch('hello', MockModel(key='hello', value='bar'))
+
+        MockModel.c.update_one({'key': 'hello'}, {'$set': {'value': 'bar'}})
+        MockModel.c.update_one({'key': 'world'}, {'$set': {'value': 'baz'}})
+        with patch.object(MongoModelDict, '_set_global_data', paused):
+            writer = threading.Thread(target=patch_hello)
+            writer.start()
+            assert inside.wait(5)
+            # Another process patching while the first one is mid-patch
+            # would lose one of the changes, so it reloads in full instead.
+            assert not self.other.patch(
+                'world', MockModel(key='world', value='baz'))
+            proceed.set()
+            self.other._populate(reset=True)
+            writer.join()
+        blob = self.cache.get(self.mydict.cache_key)
+        assert blob['hello'].value == 'bar'
+        assert blob['world'].value == 'baz'
+        assert self.cache.get(self.mydict.lock_cache_key) is None
+
+    def test_patch_without_atomic_add_reloads(self):
+        self.mydict.cache = Mock(wraps=self.cache, spec=['get', 'set'])
+        assert not self.mydict.patch(
+            'hello', MockModel(key='hello', value='bar'))
+        assert not self.mydict.cache.set.called
+
+    def test_local_patch_leaves_cache_backend(self):
+        self.cache.reset_mock()
+        assert self.mydict.patch('hello', MockModel(key='hello', value='bar'),
+                                 local=True)
+        assert self.mydict._cache['hello'].value == 'bar'
+        assert not self.cache.set.called
+
+    def test_cached_value_is_a_copy(self):
+        instance = MockModel.get(key='hello')
+        instance.value = 'bar'
+        instance.save()
+        instance.value = 'unsaved'
+        assert self.mydict._cache['hello'].value == 'bar'
+
+    def test_other_process_fetches_changed_keys(self):
+        assert self.other['world'].value == 'foo'
+        self.mydict['hello'] = 'bar'
+        del self.mydict['world']
+        self.other._last_updated = 1
+        with patch.object(MockModel, 'all') as all:
+            assert self.other['hello'].value == 'bar'
+            assert not all.called
+        assert 'world' not in self.other._cache
+        assert self.other._cache.versions == self.mydict._cache.versions
+        assert self.other._cache.generation == self.mydict._cache.generation
+
+    def test_new_generation_reloads(self):
+        self.other['hello']
+        self.mydict._populate(reset=True)
+        self.other._last_updated = 1
+        self.cache.reset_mock()
+        self.other['hello']
+        self.cache.get.assert_any_call(self.other.cache_key)
+        assert self.other._cache.generation == self.mydict._cache.generation
+
+    def test_too_many_changes_reload(self):
+        self.other['hello']
+        self.other.max_changes = 0
+        self.mydict['hello'] = 'bar'
+        self.other._last_updated = 1
+        self.cache.reset_mock()
+        assert self.other['hello'].value == 'bar'
+        self.cache.get.assert_any_call(self.other.cache_key)
+
+    def test_unversioned_cache_resets(self):
+        self.cache.set(self.mydict.versions_cache_key, None)
+        with patch.object(MockModel, 'all', return_value=[]) as all:
+            self.mydict['hello'] = 'bar'
+            assert all.called
+
+    def test_without_cache(self):
+        mydict = MongoModelDict(MockModel, key='key', value='value',
+                                shared=True)
+        mydict.cache = None
+        mydict._populate()
+        generation = mydict._cache.generation
+        MockModel.get(key='hello').delete()
+        assert 'hello' not in mydict._cache
+        assert mydict._cache.get_versions() == (generation, dict(hello=1))
+        assert mydict._snapshot().state[0] is mydict._cache
+
+    def test_cache_data_pickles(self):
+        import pickle
+        data = CacheData(dict(a=1), 'gen', dict(a=2))
+        data = pickle.loads(pickle.dumps(data))
+        assert data == dict(a=1)
+        assert data.get_versions() == ('gen', dict(a=2))
+
+
+class TestDeltaSync:
+    def setup_method(self):
+        self.mydict = MongoModelDict(Switch, key='key', value='value',
+                                     delta_sync=True)
+        self.mydict.cache = None
+        Switch.create(key='hello')
+        Switch.create(key='world')
+        self.mydict._populate()
+        # Stands in for changes made by another process.
+        Switch.post_save.disconnect(self.mydict._post_save)
+        Switch.post_delete.disconnect(self.mydict._post_delete)
+
+    def teardown_method(self):
+        Switch.c.drop()
+        Switch._tombstone_collection().drop()
+
+    def test_merges_changes(self):
+        Switch.update(dict(key='hello'), {'$set': dict(label='changed')})
+        Switch.create(key='new')
+        Switch.remove(key='world')
+        with patch.object(Switch, 'all') as all:
+            assert self.mydict['hello'].label == 'changed'
+            assert not all.called
+        assert sorted(self.mydict._cache) == ['hello', 'new']
+
+    def test_recreated_key_is_kept(self):
+        Switch.remove(key='world')
+        Switch.create(key='world', label='again')
+        assert self.mydict['world'].label == 'again'
+
+    def test_advances_high_water_mark(self):
+        synced_at = self.mydict._cache.synced_at
+        self.mydict._populate()
+        assert self.mydict._cache.synced_at > synced_at
+
+    @patch('switchboard.models.Switch.changed_since')
+    def test_looks_back_for_clock_skew(self, changed_since):
+        changed_since.return_value = ([], [])
+        synced_at = self.mydict._cache.synced_at
+        self.mydict._populate()
+        since = changed_since.call_args[0][0]
+        assert since == synced_at - timedelta(seconds=60)
+
+    @patch('switchboard.models.Switch.changed_since')
+    def test_failure_reloads(self, changed_since):
+        changed_since.side_effect = Exception('Boom!')
+        generation = self.mydict._cache.generation
+        self.mydict._populate()
+        assert self.mydict._cache.generation != generation
+        assert sorted(self.mydict._cache) == ['hello', 'world']
+
+    def test_with_cache(self):
+        cache = Mock(wraps=DictCache())
+        mydict = MongoModelDict(Switch, key='key', value='value',
+                                delta_sync=True)
+        mydict.cache = cache
+        mydict._populate()
+        Switch.post_save.disconnect(mydict._post_save)
+        Switch.create(key='new')
+        cache.set(mydict.last_updated_cache_key, int(time.time()))
+        mydict._last_updated = 1
+        cache.reset_mock()
+        assert 'new' in mydict._populate()
+        for call in cache.get.call_args_list:
+            assert call[0][0] != mydict.cache_key
+
+
+class FakeChangeStream:
+    """
+    Hands out the given changes, then waits for more like a change stream.
+    """
+    def __init__(self, changes=(), alive=True):
+        self.changes = list(changes)
+        self.alive = alive
+        self.resume_token = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def try_next(self):
+        if self.changes:
+            change = self.changes.pop(0)
+            self.resume_token = change.get('_id')
+            return change
+        time.sleep(0.001)
+        return None
+
+    def close(self):
+        self.alive = False
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+class TestWatcher:
+    def setup_method(self):
+        MockModel.create(key='hello', value='foo')
+        self.mydict = MongoModelDict(MockModel, key='key', value='value',
+                                     shared=True)
+        self.mydict.cache = None
+        self.mydict._populate()
+        self.hello_id = self.mydict._cache['hello']._id
+
+    def teardown_method(self):
+        self.mydict.stop_watcher()
+        MockModel.c.drop()
+
+    def data(self):
+        return self.mydict._snapshot().state[0]
+
+    def change(self, operation, **document):
+        change = dict(operationType=operation,
+                      documentKey=dict(_id=document['_id']))
+        if operation != 'delete':
+            change['fullDocument'] = document
+        return change
+
+    def test_requires_shared_cache(self):
+        mydict = CachedDict(shared=False)
+        with pytest.raises(ValueError):
+            mydict.start_watcher()
+
+    def test_apply_insert(self):
+        with patch.object(MockModel, 'all') as all:
+            self.mydict._apply_change(
+                self.change('insert', _id='new', key='new', value='bar'))
+            assert not all.called
+        assert self.data()['new'].value == 'bar'
+        assert self.data()['hello'].value == 'foo'
+
+    def test_apply_update(self):
+        self.mydict._apply_change(
+            self.change('update', _id=self.hello_id, key='hello', value='bar'))
+        assert self.data()['hello'].value == 'bar'
+
+    def test_apply_key_change(self):
+        self.mydict._apply_change(
+            self.change('update', _id=self.hello_id, key='renamed',
+                        value='foo'))
+        assert sorted(self.data()) == ['renamed']
+
+    def test_apply_update_of_deleted_document(self):
+        change = self.change('update', _id=self.hello_id, key='hello')
+        change['fullDocument'] = None
+        self.mydict._apply_change(change)
+        assert self.data()['hello'].value == 'foo'
+
+    def test_apply_delete(self):
+        self.mydict._apply_change(self.change('delete', _id=self.hello_id))
+        assert 'hello' not in self.data()
+
+    def test_apply_drop(self):
+        with patch.object(MongoModelDict, '_populate') as _populate:
+            self.mydict._apply_change(dict(operationType='drop'))
+            _populate.assert_called_once_with(reset=True)
+
+    def test_does_not_touch_global_cache(self):
+        cache = Mock()
+        self.mydict.cache = cache
+        self.mydict._apply_change(
+            self.change('insert', _id='new', key='new', value='bar'))
+        assert not cache.set.called
+
+    def test_apply_change_does_not_write_cache_backend(self):
+        # With a loaded cache backend, patches would otherwise succeed and
+        # be written back, bumping versions in every process.
+        self.mydict.cache = Mock(wraps=DictCache())
+        self.mydict._populate(reset=True)
+        versions = self.mydict.cache.get(self.mydict.versions_cache_key)
+        self.mydict.cache.reset_mock()
+        self.mydict._apply_change(
+            self.change('insert', _id='new', key='new', value='bar'))
+        self.mydict._apply_change(
+            self.change('update', _id=self.hello_id, key='hello', value='baz'))
+        self.mydict._apply_change(self.change('delete', _id='new'))
+        assert not self.mydict.cache.set.called
+        assert self.mydict.cache.get(
+            self.mydict.versions_cache_key) == versions
+        assert self.data()['hello'].value == 'baz'
+
+    def test_watches_changes(self):
+        stream = FakeChangeStream([
+            self.change('insert', _id='new', key='new', value='bar'),
+        ])
+        with patch.object(MongoModelDict, '_watch', return_value=stream):
+            self.mydict.start_watcher()
+            snapshot = self.mydict._snapshot()
+            assert wait_for(lambda: 'new' in (self.data() or {}))
+            assert snapshot.is_refreshed_in_background()
+            watcher = snapshot.watcher
+            self.mydict.stop_watcher()
+            assert not watcher.is_alive()
+            assert not snapshot.is_refreshed_in_background()
+
+    def test_falls_back_to_polling(self):
+        calls = []
+
+        def _watch(resume_token=None):
+            calls.append(resume_token)
+            raise Exception('Boom!')
+
+        with patch.object(MongoModelDict, '_watch', side_effect=_watch):
+            self.mydict.start_watcher(retry_interval=0.01)
+            assert wait_for(lambda: len(calls) > 1)
+            # Requests keep polling while the stream can't be opened.
+            snapshot = self.mydict._snapshot()
+            assert snapshot.watcher.is_alive()
+            assert not snapshot.is_refreshed_in_background()
+
+    def test_resumes_after_drop(self):
+        changes = [
+            dict(self.change('insert', _id='new', key='new', value='bar'),
+                 _id='token'),
+        ]
+        calls = []
+
+        def _watch(resume_token=None):
+            calls.append(resume_token)
+            if len(calls) == 1:
+                return FakeChangeStream(changes, alive=True)
+            return FakeChangeStream()
+
+        with patch.object(MongoModelDict, '_watch', side_effect=_watch):
+            watcher = Watcher(self.mydict, 0.01)
+            self.mydict._snapshot().watcher = watcher
+            watcher.start()
+            assert wait_for(lambda: 'new' in (self.data() or {}))
+            # Drop the stream; the watcher reopens it where it left off.
+            watcher.stream.alive = False
+            assert wait_for(lambda: len(calls) > 1)
+            watcher.stop()
+        assert calls[:2] == [None, 'token']
+
+
+@pytest.mark.skipif(not os.environ.get('SWITCHBOARD_TEST_MONGO_URI'),
+                    reason='Set SWITCHBOARD_TEST_MONGO_URI to the URI of a '
+                           'replica set to test change streams.')
+class TestWatcherIntegration:
+    def setup_method(self):
+        from pymongo import MongoClient
+        self.client = MongoClient(os.environ['SWITCHBOARD_TEST_MONGO_URI'])
+        self.collection = self.client.switchboard_test.test_watcher
+        self.collection.drop()
+        self.original = Switch.c
+        Switch.c = self.collection
+        self.mydict = MongoModelDict(Switch, key='key', value='value',
+                                     shared=True)
+        self.mydict.cache = None
+        # Stands in for another process, which doesn't see our signals.
+        Switch.post_save.disconnect(self.mydict._post_save)
+        Switch.post_delete.disconnect(self.mydict._post_delete)
+        self.mydict.start_watcher(retry_interval=1)
+        assert wait_for(lambda: self.mydict._snapshot().watcher.watching)
+
+    def teardown_method(self):
+        self.mydict.stop_watcher()
+        Switch.c = self.original
+        self.collection.drop()
+        self.client.close()
+
+    def data(self):
+        return self.mydict._snapshot().state[0]
+
+    def test_propagates_changes(self):
+        Switch.create(key='hello', label='one')
+        assert wait_for(lambda: 'hello' in self.data(), timeout=1)
+        Switch.update(dict(key='hello'), {'$set': dict(label='two')})
+        assert wait_for(lambda: self.data()['hello'].label == 'two',
+                        timeout=1)
+        Switch.remove(key='hello')
+        assert wait_for(lambda: 'hello' not in self.data(), timeout=1)
+
+
+class TestCodec:
+    def setup_method(self):
+        self.cache = DictCache()
+        Switch.create(key='hello')
+        Switch.create(key='world')
+        self.mydict = self.create_dict()
+        self.mydict._populate()
+
+    def teardown_method(self):
+        Switch.c.drop()
+        Switch._tombstone_collection().drop()
+
+    def create_dict(self):
+        mydict = MongoModelDict(Switch, key='key', value='value',
+                                codec='compact')
+        mydict.cache = self.cache
+        return mydict
+
+    def test_stores_encoded_data(self):
+        assert isinstance(self.mydict.codec, CompactCodec)
+        assert isinstance(self.cache[self.mydict.cache_key], bytes)
+
+    def test_decodes_lazily(self):
+        other = self.create_dict()
+        with patch.object(Switch, 'all') as all:
+            data = other._populate()
+            assert not all.called
+        assert type(dict.__getitem__(data, 'hello')) is Encoded
+        assert other['hello'].key == 'hello'
+        assert type(dict.__getitem__(data, 'hello')) is Switch
+        assert type(dict.__getitem__(data, 'world')) is Encoded
+        assert sorted(s.key for s in data.values()) == ['hello', 'world']
+
+    def test_keeps_metadata(self):
+        other = self.create_dict()
+        data = other._populate()
+        assert data.generation == self.mydict._cache.generation
+        assert data.synced_at == self.mydict._cache.synced_at
+
+    def test_chunks_large_data(self):
+        self.mydict.chunk_size = 100
+        self.mydict._populate(reset=True)
+        header = self.cache[self.mydict.cache_key]
+        assert header[0] == 'chunks'
+        assert header[2] > 1
+        other = self.create_dict()
+        assert sorted(other._populate()) == ['hello', 'world']
+
+    def test_missing_chunk_reloads(self):
+        self.mydict.chunk_size = 100
+        self.mydict._populate(reset=True)
+        _, token, count = self.cache[self.mydict.cache_key]
+        del self.cache[f'{self.mydict.cache_key}:{token}:{count - 1}']
+        other = self.create_dict()
+        with patch.object(Switch, 'all', return_value=[]) as all:
+            other._populate()
+            assert all.called
+
+    def test_patch_reuses_encoded_values(self):
+        with patch.object(CompactCodec, 'encode_item',
+                          wraps=self.mydict.codec.encode_item) as encode_item:
+            Switch.update(dict(key='hello'), {'$set': dict(label='new')})
+            encoded = {call[0][0].key for call in encode_item.call_args_list}
+            assert encoded == {'hello'}
+        other = self.create_dict()
+        assert other._populate()['hello'].key == 'hello'
+
+    def test_foreign_data_ignored(self):
+        self.cache[self.mydict.cache_key] = b'something else'
+        other = self.create_dict()
+        with patch.object(Switch, 'all', return_value=[]) as all:
+            other._populate()
+            assert all.called
+
+    def test_apply_change_decodes_only_matches(self):
+        Switch(_id='gone-switch', key='gone').save()
+        other = self.create_dict()
+        data = other._populate()
+        other._apply_change(dict(operationType='delete',
+                                 documentKey=dict(_id='gone-switch')))
+        assert sorted(other._cache) == ['hello', 'world']
+        assert type(dict.__getitem__(data, 'hello')) is Encoded
+        assert type(dict.__getitem__(data, 'world')) is Encoded
+
+
+class TestSnapshotFileIntegration:
+    def setup_method(self):
+        Switch.create(key='hello', label='Hello')
+        Switch.create(key='world')
+
+    def teardown_method(self):
+        Switch.c.drop()
+        Switch._tombstone_collection().drop()
+
+    def create_dict(self, tmp_path):
+        # Separate SnapshotFile objects stand in for separate processes.
+        snapshot_file = SnapshotFile(str(tmp_path / 'switches'))
+        snapshot_file.retry_interval = 0
+        mydict = MongoModelDict(Switch, key='key', value='value',
+                                snapshot_file=snapshot_file)
+        mydict.cache = None
+        return mydict
+
+    def test_writer_elected(self, tmp_path):
+        writer = self.create_dict(tmp_path)
+        reader = self.create_dict(tmp_path)
+        writer._populate()
+        assert writer.snapshot_file.is_writer
+        assert writer.snapshot_file.version() == 1
+        with patch.object(Switch, 'all') as all:
+            data = reader._populate()
+            assert not all.called
+        assert not reader.snapshot_file.is_writer
+        assert sorted(data) == ['hello', 'world']
+        # Snapshots keep whole switches unless a partial codec is used.
+        assert reader['hello'].label == 'Hello'
+
+    def test_readers_follow_versions(self, tmp_path):
+        writer = self.create_dict(tmp_path)
+        reader = self.create_dict(tmp_path)
+        writer._populate()
+        first = reader._populate()
+        assert reader._populate() is first
+        Switch.post_save.disconnect(reader._post_save)
+        Switch.create(key='new')
+        writer._populate()
+        assert writer.snapshot_file.version() == 2
+        assert 'new' in reader._populate()
+
+    def test_writer_skips_unchanged_data(self, tmp_path):
+        writer = self.create_dict(tmp_path)
+        writer.shared = True
+        writer._populate()
+        writer._populate()
+        assert writer.snapshot_file.version() == 1
+
+    def test_readers_load_when_writer_is_idle(self, tmp_path):
+        writer = self.create_dict(tmp_path)
+        reader = self.create_dict(tmp_path)
+        writer._populate()
+        reader._populate()
+        Switch.post_save.disconnect(reader._post_save)
+        Switch.create(key='new')
+        assert 'new' not in reader._populate()
+        later = time.time() + reader.timeout + 1
+        with patch.object(time, 'time', return_value=later):
+            assert 'new' in reader._populate()
+        assert not reader.snapshot_file.is_writer
+        # Back to the snapshot once the writer keeps it current again.
+        writer._populate(reset=True)
+        assert 'new' in reader._populate()
+        assert reader._file_version == writer.snapshot_file.version()
+
+    def test_reader_takes_over(self, tmp_path):
+        writer = self.create_dict(tmp_path)
+        reader = self.create_dict(tmp_path)
+        writer._populate()
+        reader._populate()
+        writer.snapshot_file.release()
+        reader._last_updated = None
+        reader._populate()
+        assert reader.snapshot_file.is_writer
+        assert reader.snapshot_file.version() == 2
+
+    def test_publish_without_election(self, tmp_path):
+        master = self.create_dict(tmp_path)
+        master.publish_snapshot_file()
+        assert not master.snapshot_file.is_writer
+        assert master.snapshot_file.version() == 1
+        worker = self.create_dict(tmp_path)
+        with patch.object(Switch, 'all') as all:
+            worker.snapshot_file.is_writer = False
+            worker._last_updated = int(time.time())
+            assert sorted(worker._populate()) == ['hello', 'world']
+            assert not all.called
+
+
 class TestCacheIntegration:
     def setup_method(self):
         self.cache = Mock()
@@ -168,10 +840,13 @@ class TestCacheIntegration:
     def test_model_creation(self):
         instance = MockModel(key='hello', value='foo')
         self.mydict['hello'] = instance
-        assert self.cache.get.call_count == 0
-        assert self.cache.set.call_count == 2
+        # The global cache has nothing to patch, so everything is reloaded.
+        assert self.cache.get.call_count == 2
+        assert self.cache.set.call_count == 3
         self.cache.set.assert_any_call(self.mydict.cache_key,
                                        dict(hello=instance))
+        self.cache.set.assert_any_call(self.mydict.versions_cache_key,
+                                       self.mydict._cache.get_versions())
         last_updated_key = self.mydict.last_updated_cache_key
         self.cache.set.assert_any_call(last_updated_key,
                                        self.mydict._last_updated)
@@ -181,8 +856,8 @@ class TestCacheIntegration:
         self.cache.reset_mock()
         instance = MockModel(key='hello', value='bar')
         self.mydict['hello'] = instance
-        assert self.cache.get.call_count == 0
-        assert self.cache.set.call_count == 2
+        assert self.cache.get.call_count == 2
+        assert self.cache.set.call_count == 3
         self.cache.set.assert_any_call(self.mydict.cache_key,
                                        dict(hello=instance))
         last_updated_key = self.mydict.last_updated_cache_key
@@ -193,8 +868,8 @@ class TestCacheIntegration:
         self.mydict['hello'] = MockModel(key='hello', value='foo')
         self.cache.reset_mock()
         del self.mydict['hello']
-        assert self.cache.get.call_count == 0
-        assert self.cache.set.call_count == 2
+        assert self.cache.get.call_count == 2
+        assert self.cache.set.call_count == 3
         self.cache.set.assert_any_call(self.mydict.cache_key, {})
         last_updated_key = self.mydict.last_updated_cache_key
         self.cache.set.assert_any_call(last_updated_key,
@@ -393,3 +1068,167 @@ class TestCacheConcurrency:
         t1.join()
         if self.exc:
             raise self.exc
+
+
+class TestSharedCache:
+
+    def setup_method(self):
+        self.mydict = CachedDict(shared=True)
+        self.mydict.cache = None
+        self.exc = None
+
+    def run_in_thread(self, func):
+        def target():
+            try:
+                func()
+            except Exception as e:
+                self.exc = e
+        t = threading.Thread(target=target)
+        t.start()
+        t.join()
+        if self.exc:
+            raise self.exc
+
+    @patch('switchboard.base.CachedDict.get_cache_data')
+    def test_threads_share_data(self, get_cache_data):
+        get_cache_data.return_value = dict(key='test')
+        data = self.mydict._populate()
+        seen = []
+        self.run_in_thread(lambda: seen.append(self.mydict._populate()))
+        assert seen[0] is data
+        assert get_cache_data.call_count == 1
+
+    @patch('switchboard.base.CachedDict.get_cache_data')
+    def test_expired_snapshot_is_replaced(self, get_cache_data):
+        get_cache_data.side_effect = [dict(key='old'), dict(key='new')]
+        old = self.mydict._populate()
+        snapshot = self.mydict._snapshot()
+        snapshot.state = (old, time.time() - self.mydict.timeout - 1)
+        seen = []
+        self.run_in_thread(lambda: seen.append(self.mydict._populate()))
+        assert seen[0] == dict(key='new')
+        assert snapshot.state[0] is seen[0]
+        # The original thread picks up the new data without reloading.
+        assert self.mydict._populate() is seen[0]
+        assert get_cache_data.call_count == 2
+
+    @patch('switchboard.base.CachedDict.get_cache_data')
+    def test_stale_data_served_during_refresh(self, get_cache_data):
+        get_cache_data.return_value = dict(key='test')
+        data = self.mydict._populate()
+        snapshot = self.mydict._snapshot()
+        snapshot.state = (data, time.time() - self.mydict.timeout - 1)
+        with snapshot.lock:
+            seen = []
+            self.run_in_thread(lambda: seen.append(self.mydict._populate()))
+        assert seen[0] is data
+        assert get_cache_data.call_count == 1
+
+    @patch('switchboard.base.CachedDict.get_cache_data')
+    def test_reset_is_published(self, get_cache_data):
+        get_cache_data.side_effect = [dict(key='old'), dict(key='new')]
+        self.mydict._populate()
+        seen = []
+        self.run_in_thread(
+            lambda: seen.append(self.mydict._populate(reset=True)))
+        assert self.mydict._populate() is seen[0]
+        assert seen[0] == dict(key='new')
+
+    @patch('switchboard.base.CachedDict.get_cache_data')
+    def test_clear_cache(self, get_cache_data):
+        get_cache_data.return_value = dict(key='test')
+        self.mydict._populate()
+        self.run_in_thread(self.mydict.clear_cache)
+        assert self.mydict._snapshot().state == (None, None)
+
+    def test_snapshot_per_instance(self):
+        other = CachedDict(shared=True)
+        assert other._snapshot() is not self.mydict._snapshot()
+        assert self.mydict._snapshot() is self.mydict._snapshot()
+
+
+class TestRefresher:
+
+    def setup_method(self):
+        self.cache = Mock()
+        self.mydict = CachedDict(shared=True)
+        self.mydict.cache = self.cache
+
+    def teardown_method(self):
+        self.mydict.stop_refresher()
+
+    def test_requires_shared_cache(self):
+        mydict = CachedDict(shared=False)
+        with pytest.raises(ValueError):
+            mydict.start_refresher()
+
+    @patch('switchboard.base.CachedDict.get_cache_data')
+    @patch('switchboard.base.Refresher.start', Mock())
+    def test_start_primes_cache(self, get_cache_data):
+        get_cache_data.return_value = dict(key='test')
+        self.mydict.start_refresher(5)
+        snapshot = self.mydict._snapshot()
+        assert snapshot.state[0] == dict(key='test')
+        assert snapshot.refresher.interval == 5
+
+    @patch('switchboard.base.CachedDict.get_cache_data')
+    def test_refresh_ignores_timeout(self, get_cache_data):
+        get_cache_data.return_value = dict(key='old')
+        self.mydict._populate()
+        last_updated = self.mydict._last_updated
+        self.cache.reset_mock()
+        self.cache.get.side_effect = lambda key: {
+            self.mydict.last_updated_cache_key: last_updated + 1,
+            self.mydict.cache_key: dict(key='new'),
+        }[key]
+        self.mydict.refresh()
+        assert self.mydict._snapshot().state[0] == dict(key='new')
+
+    @patch('switchboard.base.CachedDict._refresh')
+    def test_requests_do_not_refresh(self, _refresh):
+        snapshot = self.mydict._snapshot()
+        data = dict(key='test')
+        snapshot.state = (data, time.time() - self.mydict.timeout - 1)
+        snapshot.refresher = Mock()
+        snapshot.refresher.is_alive.return_value = True
+        assert self.mydict._populate() is data
+        assert not _refresh.called
+        # A dead refresher (e.g. after a fork) doesn't count.
+        snapshot.refresher.is_alive.return_value = False
+        self.mydict._populate()
+        assert _refresh.called
+
+    @patch('switchboard.base.CachedDict.refresh')
+    def test_thread_refreshes_until_stopped(self, refresh):
+        called = threading.Event()
+        refresh.side_effect = lambda: called.set()
+        refresher = Refresher(self.mydict, 0.01)
+        refresher.start()
+        assert called.wait(5)
+        refresher.stop()
+        assert not refresher.is_alive()
+
+    @patch('switchboard.base.CachedDict.refresh')
+    def test_thread_survives_errors(self, refresh):
+        calls = []
+
+        def fail():
+            calls.append(1)
+            raise Exception('Boom!')
+        refresh.side_effect = fail
+        refresher = Refresher(self.mydict, 0.01)
+        refresher.start()
+        deadline = time.time() + 5
+        while len(calls) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        refresher.stop()
+        assert len(calls) >= 2
+
+    @patch('switchboard.base.CachedDict.get_cache_data', Mock())
+    def test_stop_refresher(self):
+        self.mydict.start_refresher(60)
+        refresher = self.mydict._snapshot().refresher
+        assert refresher.is_alive()
+        self.mydict.stop_refresher()
+        assert not refresher.is_alive()
+        assert self.mydict._snapshot().refresher is None
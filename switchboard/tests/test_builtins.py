@@ -6,7 +6,9 @@ switchboard.tests.test_builtins
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
+import ipaddress
 import socket
+from unittest.mock import patch
 
 import pytest
 from webob import Request
@@ -16,8 +18,13 @@ from ..builtins import (
     HostConditionSet,
     IPAddress,
     IPAddressConditionSet,
+    IPNetwork,
+    NetworkIndex,
+    NetworkMatcher,
     QueryStringConditionSet,
+    parse_address,
 )
+from ..models import INCLUDE, EXCLUDE
 from ..conditions import Invalid
 from ..models import Switch, SELECTIVE
 from ..settings import settings
@@ -42,6 +49,79 @@ class TestIPAddress:
             self.ip.clean('foobar')
 
 
+class TestParseAddress:
+    def test_parse(self):
+        assert parse_address('10.0.0.1') == ipaddress.ip_address('10.0.0.1')
+        assert parse_address('2001:db8::1') == ipaddress.ip_address('2001:db8::1')
+
+    def test_ipv4_mapped(self):
+        assert parse_address('::ffff:10.0.0.1') == ipaddress.ip_address('10.0.0.1')
+
+    def test_invalid(self):
+        assert parse_address('foobar') is None
+
+
+class TestNetworkIndex:
+    def setup_method(self):
+        self.index = NetworkIndex([
+            '10.0.0.0/8', '10.1.0.0/16', '192.168.0.1', '192.168.0.2/31',
+            '2001:db8::/32',
+        ])
+
+    def test_contains(self):
+        assert parse_address('10.200.0.1') in self.index
+        assert parse_address('192.168.0.1') in self.index
+        assert parse_address('192.168.0.3') in self.index
+        assert parse_address('2001:db8:1::1') in self.index
+
+    def test_not_contains(self):
+        assert parse_address('11.0.0.0') not in self.index
+        assert parse_address('192.168.0.4') not in self.index
+        assert parse_address('192.168.0.0') not in self.index
+        assert parse_address('2001:db9::1') not in self.index
+        assert None not in self.index
+
+    def test_merges_intervals(self):
+        assert len(self.index.tables[4]) == 2
+        assert len(self.index.tables[6]) == 1
+
+    def test_empty(self):
+        assert parse_address('10.0.0.1') not in NetworkIndex()
+
+
+class TestIPNetwork:
+    def setup_method(self):
+        self.field = IPNetwork()
+
+    def test_clean(self):
+        assert self.field.clean('10.0.0.0/8') == '10.0.0.0/8'
+        assert self.field.clean('2001:db8::/32') == '2001:db8::/32'
+        assert self.field.clean('10.0.0.1') == '10.0.0.1'
+        with pytest.raises(Invalid):
+            self.field.clean('10.0.0.0/33')
+
+    def test_is_active(self):
+        assert self.field.is_active('10.0.0.0/8', '10.1.2.3')
+        assert not self.field.is_active('10.0.0.0/8', '11.1.2.3')
+        assert not self.field.is_active('10.0.0.0/8', '2001:db8::1')
+        assert not self.field.is_active('10.0.0.0/8', 'foobar')
+
+    def test_compile(self):
+        matcher = self.field.compile([[INCLUDE, '10.0.0.0/8'],
+                                      [EXCLUDE, '10.1.0.0/16']])
+        assert isinstance(matcher, NetworkMatcher)
+        assert matcher.is_active(parse_address('10.2.0.1')) is True
+        assert matcher.is_active(parse_address('10.1.0.1')) is False
+        assert matcher.is_active(parse_address('11.0.0.1')) is None
+        assert matcher.is_active(None) is None
+
+    def test_compiled_string_address(self):
+        matcher = self.field.compile([[INCLUDE, '10.0.0.0/8']])
+        assert matcher.is_active('10.1.2.3') is True
+        assert matcher.is_active('11.1.2.3') is None
+        assert matcher.is_active('foobar') is None
+
+
 class TestIPAddressConditionSet:
     def setup_method(self):
         self.cs = 'switchboard.builtins.IPAddressConditionSet'
@@ -78,6 +158,19 @@ class TestIPAddressConditionSet:
         )
         assert self.operator.is_active('test', req_ipv6)
 
+    def test_percent_field_value(self):
+        cs = IPAddressConditionSet()
+        req = Request.blank('', environ=dict(REMOTE_ADDR='10.0.0.7'))
+        with patch('switchboard.builtins.parse_address',
+                   wraps=parse_address) as parse:
+            assert cs.get_field_value(req, 'percent') == int(
+                ipaddress.ip_address('10.0.0.7'))
+        parse.assert_called_once_with('10.0.0.7')
+        # Mapped addresses keep the bucket of the whole IPv6 address.
+        req = Request.blank('', environ=dict(REMOTE_ADDR='::ffff:10.0.0.7'))
+        assert cs.get_field_value(req, 'percent') == int(
+            ipaddress.ip_address('::ffff:10.0.0.7'))
+
     def test_percent(self):
         switch = Switch.create(
             key='test',
@@ -114,6 +207,47 @@ class TestIPAddressConditionSet:
         )
         assert self.operator.is_active('test', req)
 
+    def test_internal_networks(self):
+        switch = Switch.create(key='test', status=SELECTIVE)
+        switch = self.operator['test']
+        switch.add_condition(
+            condition_set=self.cs,
+            field_name='internal_ip',
+            condition='',
+        )
+        settings.SWITCHBOARD_INTERNAL_IPS = '10.0.0.0/8, 2001:db8::/32'
+        req = Request.blank('', environ=dict(REMOTE_ADDR='10.1.2.3'))
+        assert self.operator.is_active('test', req)
+        req = Request.blank('', environ=dict(REMOTE_ADDR=self.ipv6))
+        assert self.operator.is_active('test', req)
+        req = Request.blank('', environ=dict(REMOTE_ADDR=self.ip))
+        assert not self.operator.is_active('test', req)
+
+        # Replacing the setting rebuilds the index.
+        settings.SWITCHBOARD_INTERNAL_IPS = ['192.168.0.0/24']
+        assert self.operator.is_active('test', req)
+
+    def test_ip_network(self):
+        switch = Switch.create(key='test', status=SELECTIVE)
+        switch = self.operator['test']
+        switch.add_condition(
+            condition_set=self.cs,
+            field_name='ip_network',
+            condition='192.168.0.0/16',
+        )
+        switch.add_condition(
+            condition_set=self.cs,
+            field_name='ip_network',
+            condition='192.168.1.0/24',
+            exclude=True,
+        )
+        req = Request.blank('', environ=dict(REMOTE_ADDR=self.ip))
+        assert self.operator.is_active('test', req)
+        req = Request.blank('', environ=dict(REMOTE_ADDR='192.168.1.1'))
+        assert not self.operator.is_active('test', req)
+        req = Request.blank('', environ=dict(REMOTE_ADDR=self.ipv6))
+        assert not self.operator.is_active('test', req)
+
 
 class TestHostConditionSet:
     def setup_method(self):
@@ -7,6 +7,7 @@ switchboard.tests.test_conditions
 """
 
 import datetime
+import re
 
 from unittest.mock import Mock, patch
 import pytest
@@ -18,14 +19,22 @@ from ..conditions import (
     Boolean,
     Choice,
     ConditionSet,
+    EqualityMatcher,
     Field,
+    FieldMatcher,
+    IntervalIndex,
     Invalid,
+    IsActiveMatcher,
     ModelConditionSet,
     OnOrAfterDate,
     Percent,
     Range,
+    RangeMatcher,
     Regex,
+    RegexMatcher,
     RequestConditionSet,
+    TimeConditionSet,
+    TimeWindowMatcher,
     titlize,
 )
 from ..models import INCLUDE, EXCLUDE
@@ -64,6 +73,98 @@ class TestField:
         assert (self.field.render('bar') ==
                       '<input type="text" value="bar" name="foo"/>')
 
+    def test_compile(self):
+        matcher = self.field.compile([[INCLUDE, 'foo'], [EXCLUDE, 'bar']])
+        assert isinstance(matcher, FieldMatcher)
+        assert matcher.include == ['foo']
+        assert matcher.exclude == ['bar']
+
+
+class TestFieldMatcher:
+    def test_include(self):
+        matcher = FieldMatcher(Field(), [[INCLUDE, 'foo']])
+        assert matcher.is_active('foo') is True
+        assert matcher.is_active('bar') is None
+
+    def test_exclude_wins(self):
+        field = Percent()
+        matcher = FieldMatcher(field, [[INCLUDE, '0-50'], [EXCLUDE, '10-20']])
+        assert matcher.is_active(5) is True
+        assert matcher.is_active(15) is False
+        assert matcher.is_active(75) is None
+
+    def test_values_are_prepared(self):
+        field = Mock()
+        field.prepare.side_effect = lambda v: v.upper()
+        matcher = FieldMatcher(field, [[INCLUDE, 'foo'], [EXCLUDE, 'bar']])
+        assert matcher.include == ['FOO']
+        assert matcher.exclude == ['BAR']
+
+
+class TestIntervalIndex:
+    def test_contains(self):
+        index = IntervalIndex([(10, 20), (0, 5), (15, 30), (40, 40)])
+        assert index.starts == [0, 10, 40]
+        assert index.ends == [5, 30, 40]
+        for value in (0, 5, 10, 25, 30, 40):
+            assert value in index
+        for value in (-1, 6, 31, 39, 41, 5.5):
+            assert value not in index
+
+    def test_step(self):
+        index = IntervalIndex([(0, 5), (6, 10), (12, 20)], step=1)
+        assert index.starts == [0, 12]
+
+    def test_empty(self):
+        index = IntervalIndex()
+        assert 0 not in index
+        assert len(index) == 0
+
+
+class TestEqualityMatcher:
+    def test_compiled_for_equality_fields(self):
+        assert isinstance(Field().compile([]), EqualityMatcher)
+        assert isinstance(Choice(['foo']).compile([]), EqualityMatcher)
+        assert not isinstance(Regex().compile([]), EqualityMatcher)
+        assert not isinstance(Boolean().compile([]), EqualityMatcher)
+        assert not isinstance(Percent().compile([]), EqualityMatcher)
+
+    def test_overridden_is_active(self):
+        class Insensitive(Field):
+            def is_active(self, value, actual_value):
+                return value.lower() == actual_value.lower()
+
+        assert not isinstance(Insensitive().compile([]), EqualityMatcher)
+
+    def test_lookup(self):
+        values = [[INCLUDE, str(i)] for i in range(1000)]
+        matcher = EqualityMatcher(Field(), values + [[EXCLUDE, '5']])
+        assert matcher.include_set == {str(i) for i in range(1000)}
+        assert matcher.is_active('10') is True
+        assert matcher.is_active('5') is False
+        assert matcher.is_active('1000') is None
+
+    def test_does_not_call_matches_per_value(self):
+        field = Field()
+        matcher = EqualityMatcher(field, [[INCLUDE, 'foo'], [INCLUDE, 'bar']])
+        with patch.object(field, 'matches', wraps=field.matches) as matches:
+            assert matcher.is_active('bar') is True
+        assert matches.call_count == 1
+
+    def test_choice_must_be_a_choice(self):
+        matcher = EqualityMatcher(Choice(['foo']),
+                                  [[INCLUDE, 'foo'], [INCLUDE, 'bar']])
+        assert matcher.is_active('foo') is True
+        assert matcher.is_active('bar') is None
+
+    def test_unhashable_values(self):
+        matcher = EqualityMatcher(Field(), [[INCLUDE, ['foo']],
+                                            [EXCLUDE, 'bar']])
+        assert matcher.include_unhashable == [['foo']]
+        assert matcher.is_active(['foo']) is True
+        assert matcher.is_active(['bar']) is None
+        assert matcher.is_active('bar') is False
+
 
 class TestBoolean:
     def setup_method(self):
@@ -142,6 +243,33 @@ class TestRange:
         )
         assert self.field.render([0, 50]) == html
 
+    def test_prepare(self):
+        assert self.field.prepare('0-50') == [0, 50]
+        assert self.field.prepare(['0', '50']) == [0, 50]
+
+    def test_compiled_stored_value(self):
+        matcher = self.field.compile([[INCLUDE, '10-20']])
+        assert matcher.is_active(15)
+        assert matcher.is_active(21) is None
+
+    def test_compile(self):
+        matcher = self.field.compile([
+            [INCLUDE, '0-10'], [INCLUDE, '5-20'], [INCLUDE, '100-200'],
+            [EXCLUDE, '150-160'],
+        ])
+        assert isinstance(matcher, RangeMatcher)
+        assert len(matcher.include_index) == 2
+        assert matcher.is_active(15) is True
+        assert matcher.is_active(155) is False
+        assert matcher.is_active(50) is None
+
+    def test_compile_overridden(self):
+        class Open(Range):
+            def is_active(self, value, actual_value):
+                return value[0] < actual_value < value[1]
+
+        assert not isinstance(Open().compile([]), RangeMatcher)
+
 
 class TestPercent:
     def setup_method(self):
@@ -155,9 +283,23 @@ class TestPercent:
         assert not self.field.is_active('0-50', -1)
         assert not self.field.is_active('0-50', 51)
 
+    def test_matches(self):
+        prepared = self.field.prepare('0-50')
+        assert self.field.matches(prepared, 125)
+        assert not self.field.matches(prepared, 175)
+
     def test_display(self):
         assert self.field.display('0-50') == 'Foo: 50% (0-50)'
 
+    def test_compile(self):
+        matcher = self.field.compile([
+            [INCLUDE, '0-10'], [INCLUDE, '40-60'], [EXCLUDE, '45-50'],
+        ])
+        assert isinstance(matcher, RangeMatcher)
+        assert matcher.is_active(105) is True
+        assert matcher.is_active(147) is False
+        assert matcher.is_active(30) is None
+
     def test_clean_valid_percentile(self):
         assert self.field.clean(['0', '50']) == '0-50'
 
@@ -190,6 +332,95 @@ class TestRegex:
                 + 'placeholder="regular expression"/>/')
         assert self.field.render('^abc') == html
 
+    def test_prepare_is_cached(self):
+        assert self.field.prepare('^abc') is self.field.prepare('^abc')
+        assert '^abc' in Regex.regex_cache
+
+
+class TestRegexMatcher:
+    def setup_method(self):
+        self.field = Regex()
+
+    def test_combines_patterns(self):
+        matcher = self.field.compile([
+            [INCLUDE, '^abc'], [INCLUDE, 'xyz$'], [INCLUDE, '(foo|bar)'],
+            [EXCLUDE, 'bad'], [EXCLUDE, 'worse'],
+        ])
+        assert isinstance(matcher, RegexMatcher)
+        assert matcher.include == []
+        assert matcher.exclude == []
+        assert matcher.is_active('abcdef') is True
+        assert matcher.is_active('uvwxyz') is True
+        assert matcher.is_active('a bar b') is True
+        assert matcher.is_active('abc worse') is False
+        assert matcher.is_active('defabc') is None
+
+    def test_single_pattern(self):
+        matcher = self.field.compile([[INCLUDE, '^abc']])
+        assert matcher.include_regex is None
+        assert matcher.is_active('abcdef') is True
+
+    def test_separate_patterns(self):
+        matcher = self.field.compile([
+            [INCLUDE, r'(a)\1'], [INCLUDE, '(?i)^abc'], [INCLUDE, '(?P<x>z)'],
+            [INCLUDE, 'def'], [INCLUDE, 'ghi'],
+        ])
+        assert [r.pattern for r in matcher.include] == [
+            r'(a)\1', '(?i)^abc', '(?P<x>z)']
+        assert matcher.include_regex.pattern == '(?:def)|(?:ghi)'
+        assert matcher.is_active('xaax') is True
+        assert matcher.is_active('ABCD') is True
+        assert matcher.is_active('xaxbx') is None
+
+    def test_separate_exclude_wins(self):
+        matcher = self.field.compile([
+            [INCLUDE, 'abc'], [INCLUDE, 'def'], [EXCLUDE, r'(b)\1'],
+        ])
+        assert matcher.is_active('abc') is True
+        assert matcher.is_active('abbc') is False
+
+
+    def test_overridden_is_active(self):
+        class Insensitive(Regex):
+            def is_active(self, value, actual_value):
+                return bool(re.search(value, actual_value, re.IGNORECASE))
+
+        field = Insensitive()
+        assert field.is_active('^abc', 'ABCD') is True
+        matcher = field.compile([[INCLUDE, '^abc'], [INCLUDE, 'def']])
+        assert isinstance(matcher, IsActiveMatcher)
+        assert matcher.is_active('ABCD') is True
+        assert matcher.is_active('xyz') is None
+
+
+class TestIsActiveMatcher:
+    def test_overridden_percent(self):
+        class Lower(Percent):
+            def is_active(self, value, actual_value):
+                return actual_value < int(value.split('-')[1])
+
+        matcher = Lower().compile([[INCLUDE, '0-50'], [EXCLUDE, '0-10']])
+        assert isinstance(matcher, IsActiveMatcher)
+        assert matcher.include == ['0-50']
+        assert matcher.is_active(5) is False
+        assert matcher.is_active(20) is True
+        assert matcher.is_active(200) is None
+
+    def test_overridden_date_is_not_windowed(self):
+        class Sunset(BeforeDate):
+            def is_active(self, value, actual_value):
+                return True
+
+        class Times(TimeConditionSet):
+            sunset = Sunset()
+
+        compiled = Times().compile(dict(sunset=[[INCLUDE, '2100-01-01']]))
+        assert isinstance(compiled[0][1], IsActiveMatcher)
+
+    def test_consistent_overrides_stay_compiled(self):
+        assert Percent().compiles_is_active()
+        assert Boolean().compiles_is_active()
+        assert BeforeDate().compiles_is_active()
 
 class TestAbstractDate:
     def setup_method(self):
@@ -243,6 +474,140 @@ class TestAbstractDate:
         with pytest.raises(AssertionError):
             self.field.is_active('1900-01-01', 'foo')
 
+    def test_prepare(self):
+        date = datetime.date(1900, 1, 1)
+        assert self.field.prepare('1900-01-01') == date
+
+    def test_prepare_datetime(self):
+        utc = datetime.timezone.utc
+        assert (self.field.prepare('1900-01-01T10:30') ==
+                datetime.datetime(1900, 1, 1, 10, 30))
+        assert (self.field.prepare('1900-01-01T10:30Z') ==
+                datetime.datetime(1900, 1, 1, 10, 30, tzinfo=utc))
+
+    def test_clean_datetime(self):
+        assert (self.field.clean('1900-01-01 10:30+02:00') ==
+                '1900-01-01T10:30:00+02:00')
+
+    def test_display_datetime(self):
+        self.field.label = 'Foo'
+        assert (self.field.display('1900-01-01T10:30Z') ==
+                'Foo: 01 Jan 1900 10:30 UTC')
+
+
+class TestDateTimeZones:
+    def setup_method(self):
+        self.field = OnOrAfterDate(timezone='Europe/Paris')
+
+    def test_timezone_name(self):
+        assert self.field.timezone.key == 'Europe/Paris'
+
+    def test_positional_label(self):
+        field = BeforeDate('Sunset date', 'Help')
+        assert field.label == 'Sunset date'
+        assert field.help_text == 'Help'
+        assert field.timezone is None
+
+    def test_datetime_condition(self):
+        # 09:00 in Paris is 08:00 UTC in winter.
+        utc = datetime.timezone.utc
+        condition = '2024-01-10T09:00'
+        assert self.field.is_active(
+            condition, datetime.datetime(2024, 1, 10, 8, 0, tzinfo=utc))
+        assert not self.field.is_active(
+            condition, datetime.datetime(2024, 1, 10, 7, 59, tzinfo=utc))
+        # Naive actual values are in the field's time zone too.
+        assert self.field.is_active(
+            condition, datetime.datetime(2024, 1, 10, 9, 0))
+        assert not self.field.is_active(condition, datetime.date(2024, 1, 9))
+
+    def test_date_condition(self):
+        utc = datetime.timezone.utc
+        # 23:30 UTC on the 9th is already the 10th in Paris.
+        assert self.field.is_active(
+            '2024-01-10', datetime.datetime(2024, 1, 9, 23, 30, tzinfo=utc))
+        assert not OnOrAfterDate().is_active(
+            '2024-01-10', datetime.datetime(2024, 1, 9, 23, 30, tzinfo=utc))
+
+    def test_transition(self):
+        assert (self.field.transition(self.field.prepare('2024-01-10')) ==
+                datetime.datetime(2024, 1, 9, 23, 0,
+                                  tzinfo=datetime.timezone.utc))
+
+
+class TestTimeWindowMatcher:
+    def setup_method(self):
+        self.utc = datetime.timezone.utc
+        self.field = OnOrAfterDate()
+        self.matcher = TimeWindowMatcher(self.field.compile([
+            [INCLUDE, '2024-01-10'], [EXCLUDE, '2024-02-01T12:00Z'],
+        ]))
+
+    def at(self, *args):
+        return datetime.datetime(*args, tzinfo=self.utc)
+
+    def test_is_active(self):
+        assert self.matcher.is_active(self.at(2024, 1, 9)) is None
+        assert self.matcher.is_active(self.at(2024, 1, 10)) is True
+        assert self.matcher.is_active(self.at(2024, 2, 1, 12)) is False
+
+    def test_reuses_result_within_window(self):
+        inner = self.matcher.matcher
+        with patch.object(inner, 'is_active',
+                          wraps=inner.is_active) as is_active:
+            self.matcher.is_active(self.at(2024, 1, 11))
+            self.matcher.is_active(self.at(2024, 1, 20))
+            self.matcher.is_active(self.at(2024, 2, 2))
+        assert is_active.call_count == 2
+
+    def test_caches_until_next_transition(self):
+        self.matcher.is_active(self.at(2024, 1, 11))
+        assert self.matcher.current == (
+            self.at(2024, 1, 10), self.at(2024, 2, 1, 12), True)
+        with patch.object(self.field, 'to_aware') as to_aware:
+            assert self.matcher.is_active(self.at(2024, 2, 1, 11)) is True
+            assert not to_aware.called
+        assert self.matcher.is_active(self.at(2024, 3, 1)) is False
+        assert self.matcher.current == (self.at(2024, 2, 1, 12), None, False)
+
+    def test_earlier_window(self):
+        self.matcher.is_active(self.at(2024, 1, 11))
+        assert self.matcher.is_active(self.at(2024, 1, 1)) is None
+        assert self.matcher.current == (None, self.at(2024, 1, 10), None)
+
+    def test_naive_value(self):
+        self.matcher.is_active(self.at(2024, 1, 11))
+        assert self.matcher.is_active(
+            datetime.datetime(2024, 1, 1)) is None
+
+
+class TestTimeConditionSet:
+    def setup_method(self):
+        class Schedule(TimeConditionSet):
+            launch = OnOrAfterDate()
+            sunset = BeforeDate()
+
+        self.cs = Schedule()
+
+    def test_can_execute(self):
+        assert self.cs.can_execute(None)
+        assert not self.cs.can_execute(Mock())
+
+    def test_get_field_value(self):
+        now = self.cs.get_field_value(None, 'launch')
+        assert now.tzinfo is not None
+
+    def test_compile(self):
+        compiled = self.cs.compile({
+            'launch': [[INCLUDE, '2000-01-01']],
+            'sunset': [[INCLUDE, '2999-01-01']],
+        })
+        assert all(isinstance(m, TimeWindowMatcher) for _, m in compiled)
+        assert self.cs.has_active_compiled(compiled, [None]) is True
+
+        compiled = self.cs.compile({'sunset': [[INCLUDE, '2000-01-01']]})
+        assert self.cs.has_active_compiled(compiled, [None]) is None
+
 
 class TestBeforeDate:
     def setup_method(self):
@@ -390,6 +755,46 @@ class TestConditionSet:
         field.is_active.assert_called_with(field_condition, value)
 
 
+    def test_compile(self):
+        field = Mock()
+        field.compile.return_value = 'matcher'
+        self.cs.fields = {'bar': field}
+        conditions = [[INCLUDE, 'baz']]
+        compiled = self.cs.compile({'bar': conditions, 'unknown': []})
+        assert compiled == [('bar', 'matcher')]
+        field.compile.assert_called_once_with(conditions)
+
+    @patch('switchboard.conditions.ConditionSet.get_field_value')
+    def test_is_active_compiled(self, get_field_value):
+        get_field_value.return_value = 'baz'
+        self.cs.fields = {'bar': Field()}
+        compiled = self.cs.compile({'bar': [[INCLUDE, 'baz']]})
+        assert self.cs.is_active_compiled('test', compiled) is True
+        get_field_value.assert_called_with('test', 'bar')
+        compiled = self.cs.compile({'bar': [[EXCLUDE, 'baz']]})
+        assert self.cs.is_active_compiled('test', compiled) is False
+        compiled = self.cs.compile({'bar': [[INCLUDE, 'qux']]})
+        assert self.cs.is_active_compiled('test', compiled) is None
+
+    @patch('switchboard.conditions.ConditionSet.can_execute')
+    @patch('switchboard.conditions.ConditionSet.is_active_compiled')
+    def test_has_active_compiled(self, is_active_compiled, can_execute):
+        can_execute.side_effect = [True, False]
+        is_active_compiled.return_value = True
+        instances = ['foo', None]
+        assert self.cs.has_active_compiled('compiled', instances) is True
+        is_active_compiled.assert_called_once_with('foo', 'compiled', None)
+
+    def test_is_active_compiled_uses_evaluation(self):
+        evaluation = Mock()
+        evaluation.get_field_value.return_value = 'baz'
+        self.cs.fields = {'bar': Field()}
+        compiled = self.cs.compile({'bar': [[INCLUDE, 'baz']]})
+        assert self.cs.is_active_compiled('test', compiled, evaluation)
+        evaluation.get_field_value.assert_called_once_with(self.cs, 'test',
+                                                           'bar')
+
+
 class TestModelConditionSet:
     def setup_method(self):
         class OurModelConditionSet(ModelConditionSet):
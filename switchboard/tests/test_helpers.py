@@ -0,0 +1,155 @@
+"""
+switchboard.tests.test_helpers
+~~~~~~~~~~~~~~~
+
+:copyright: (c) 2015 Kyle Adams.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from unittest.mock import Mock
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from ..helpers import (
+    BulkInsert,
+    BulkUpdate,
+    IdentityKey,
+    LRUCache,
+    MockCollection,
+    ResultCache,
+    default_identity,
+)
+
+
+class TestLRUCache:
+    def setup_method(self):
+        self.cache = LRUCache(maxsize=2)
+
+    def test_get(self):
+        self.cache['a'] = 1
+        assert self.cache.get('a') == 1
+        assert self.cache['a'] == 1
+        assert self.cache.get('b') is None
+        assert self.cache.get('b', 2) == 2
+        with pytest.raises(KeyError):
+            self.cache['b']
+
+    def test_evicts_least_recently_used(self):
+        self.cache['a'] = 1
+        self.cache['b'] = 2
+        self.cache.get('a')
+        self.cache['c'] = 3
+        assert len(self.cache) == 2
+        assert 'a' in self.cache
+        assert 'b' not in self.cache
+        assert 'c' in self.cache
+
+    def test_clear(self):
+        self.cache['a'] = 1
+        self.cache.clear()
+        assert len(self.cache) == 0
+
+    def test_evictions(self):
+        for key in 'abcd':
+            self.cache[key] = 1
+        assert self.cache.evictions == 2
+
+
+class TestDefaultIdentity:
+    def test_hashable(self):
+        assert default_identity('foo') == 'foo'
+
+    def test_unhashable(self):
+        obj = {}
+        key = default_identity(obj)
+        assert isinstance(key, IdentityKey)
+        assert key == default_identity(obj)
+        assert key != default_identity({})
+        assert hash(key) == id(obj)
+
+
+class TestResultCache:
+    def setup_method(self):
+        self.cache = ResultCache(maxsize=2)
+
+    def test_counts(self):
+        self.cache[(('foo',), ())] = True
+        assert self.cache.get((('foo',), ())) is True
+        assert self.cache.get((('bar',), ())) is None
+        assert self.cache.hits == 1
+        assert self.cache.misses == 1
+
+    def test_unhashable_instances(self):
+        instance = {'id': 1}
+        self.cache[(('foo', instance), ())] = True
+        assert self.cache.get((('foo', instance), ())) is True
+        assert (('foo', instance), ()) in self.cache
+        assert self.cache.get((('foo', {'id': 1}), ())) is None
+
+    def test_identity(self):
+        cache = ResultCache(identity=lambda obj: getattr(obj, 'id', obj))
+        first, second = Mock(id=1), Mock(id=1)
+        cache[(('foo', first), ())] = True
+        assert cache.get((('foo', second), ())) is True
+
+    def test_unhashable_kwargs(self):
+        self.cache[(('foo',), (('default', []),))] = True
+        assert len(self.cache) == 0
+        assert self.cache.get((('foo',), (('default', []),))) is None
+
+    def test_bounded(self):
+        for key in 'abc':
+            self.cache[((key,), ())] = True
+        assert len(self.cache) == 2
+        assert self.cache.evictions == 1
+
+    def test_clear(self):
+        self.cache[(('foo',), ())] = True
+        self.cache.get((('foo',), ()))
+        self.cache.clear()
+        assert len(self.cache) == 0
+        assert self.cache.hits == 0
+
+
+class TestMockCollection:
+    def test_find_sort(self):
+        c = MockCollection()
+        for a, b in [(1, 2), (2, 1), (1, 1)]:
+            c.insert_one(dict(a=a, b=b))
+        results = c.find(sort=[('a', -1), ('b', 1)])
+        assert [(d['a'], d['b']) for d in results] == [(2, 1), (1, 1), (1, 2)]
+        results = c.find(dict(a=1), sort=[('b', 1)])
+        assert [d['b'] for d in results] == [1, 2]
+
+    def test_unique_index(self):
+        c = MockCollection()
+        assert c.create_index([('a', 1)], unique=True) == 'a_1'
+        c.insert_one(dict(a=1))
+        with pytest.raises(DuplicateKeyError):
+            c.insert_one(dict(a=1))
+        with pytest.raises(DuplicateKeyError):
+            c.update_one(dict(a=1, b=2), {'$set': dict(a=1, b=2)},
+                         upsert=True)
+        c.drop()
+        assert c.indexes == {}
+
+    def test_distinct(self):
+        c = MockCollection()
+        for a, b in [(1, 2), (2, 1), (1, 1)]:
+            c.insert_one(dict(a=a, b=b))
+        c.insert_one(dict(b=3))
+        assert c.distinct('a') == [1, 2]
+        assert c.distinct('a', dict(b=1)) == [2, 1]
+
+    def test_bulk_write(self):
+        c = MockCollection()
+        c.insert_one(dict(_id='a', b=1))
+        result = c.bulk_write([
+            BulkUpdate(dict(_id='a'), {'$set': dict(b=2)}, upsert=True),
+            BulkUpdate(dict(_id='c'), {'$set': dict(b=3)}, upsert=True),
+            BulkInsert(dict(_id='d', b=4)),
+        ])
+        assert result.upserted_ids == {1: 'c'}
+        assert [(d['_id'], d['b']) for d in c.find()] == [
+            ('a', 2), ('c', 3), ('d', 4)]
@@ -5,6 +5,7 @@ switchboard.tests.test_manager
 :copyright: (c) 2015 Kyle Adams.
 :license: Apache License 2.0, see LICENSE for more details.
 """
+import asyncio
 import threading
 
 import pytest
@@ -25,8 +26,10 @@ from ..models import (
     INCLUDE, EXCLUDE
 )
 from ..manager import registry, SwitchManager
-from ..helpers import MockCollection
+from ..helpers import MockCollection, ResultCache
+from .test_base import DictCache
 from ..settings import settings
+from ..signals import request_finished
 
 
 class TestAPI:
@@ -65,7 +68,7 @@ class TestAPI:
 
     def test_get_all_conditions(self):
         conditions = list(self.operator.get_all_conditions())
-        assert len(conditions) == 5
+        assert len(conditions) == 6
         for set_id, label, field in conditions:
             assert set_id in registry
 
@@ -732,6 +735,21 @@ class TestAPI:
         # Don't need to assert, just need to make sure things don't explode.
         self.operator.version_switch(switch)
 
+    def test_version_switch_async(self):
+        switch = Mock()
+        self.operator.context = dict(user=dict(username='test'))
+        settings.SWITCHBOARD_ASYNC_VERSIONS = True
+        try:
+            self.operator.version_switch(switch)
+            switch.queue_version.assert_called_with(deleted=False,
+                                                    username='test')
+            self.operator.version_deleted_switch(switch)
+            switch.queue_version.assert_called_with(deleted=True,
+                                                    username='test')
+        finally:
+            del settings.SWITCHBOARD_ASYNC_VERSIONS
+        assert not switch.save_version.called
+
     @patch('switchboard.base.MongoModelDict.__getitem__')
     def test_defaults_on_key_error(self, getitem):
         getitem.side_effect = KeyError()
@@ -740,6 +758,279 @@ class TestAPI:
         assert not operator.is_active('test', default=False)
 
 
+class TestIsActiveMany:
+    def setup_method(self):
+        self.operator = SwitchManager(auto_create=True)
+        self.operator.register(IPAddressConditionSet)
+        self.operator.register(HostConditionSet)
+        self.condition_set = 'switchboard.builtins.IPAddressConditionSet'
+
+    def teardown_method(self):
+        Switch.c.drop()
+
+    def test_matches_is_active(self):
+        Switch.create(key='on', status=GLOBAL)
+        Switch.create(key='off', status=DISABLED)
+        Switch.create(key='off:child', status=GLOBAL)
+        Switch.create(key='on:child', status=INHERIT)
+        Switch.create(key='ip', status=SELECTIVE)
+        self.operator['ip'].add_condition(
+            condition_set=self.condition_set,
+            field_name='ip_address',
+            condition='192.168.1.1',
+        )
+        req = Request.blank('/')
+        req.environ['REMOTE_ADDR'] = '192.168.1.1'
+        keys = ['on', 'off', 'off:child', 'on:child', 'ip', 'ip:missing']
+        results = self.operator.is_active_many(keys, req)
+        assert list(results) == keys
+        assert results == {k: self.operator.is_active(k, req) for k in keys}
+
+    def test_default(self):
+        self.operator.auto_create = False
+        assert self.operator.is_active_many(['missing']) == dict(missing=False)
+        results = self.operator.is_active_many(['missing'], default=True)
+        assert results == dict(missing=True)
+
+    def test_parents_are_checked_once(self):
+        Switch.create(key='parent', status=GLOBAL)
+        Switch.create(key='parent:a', status=GLOBAL)
+        Switch.create(key='parent:b', status=GLOBAL)
+        with patch.object(self.operator, 'get_plan',
+                          wraps=self.operator.get_plan) as get_plan:
+            results = self.operator.is_active_many(['parent:a', 'parent:b'])
+        assert results == {'parent:a': True, 'parent:b': True}
+        keys = [c.args[0] for c in get_plan.call_args_list]
+        assert keys.count('parent') == 1
+
+    @patch('switchboard.builtins.socket.gethostname')
+    def test_field_values_are_shared(self, gethostname):
+        gethostname.return_value = 'myhost'
+        condition_set = 'switchboard.builtins.HostConditionSet'
+        for key in ('a', 'b'):
+            Switch.create(key=key, status=SELECTIVE)
+            self.operator[key].add_condition(
+                condition_set=condition_set,
+                field_name='hostname',
+                condition='myhost',
+            )
+        results = self.operator.is_active_many(['a', 'b'])
+        assert results == dict(a=True, b=True)
+        assert gethostname.call_count == 1
+
+    def test_error_only_affects_one_key(self):
+        Switch.create(key='ok', status=GLOBAL)
+        get_plan = self.operator.get_plan
+
+        def failing_get_plan(key, data=None):
+            if key == 'broken':
+                raise Exception('Boom!')
+            return get_plan(key, data)
+
+        with patch.object(self.operator, 'get_plan', failing_get_plan):
+            results = self.operator.is_active_many(['broken', 'ok'])
+        assert results == dict(broken=False, ok=True)
+
+    @patch('switchboard.builtins.socket.gethostname')
+    def test_field_value_cache(self, gethostname):
+        gethostname.return_value = 'myhost'
+        Switch.create(key='test', status=SELECTIVE)
+        self.operator['test'].add_condition(
+            condition_set='switchboard.builtins.HostConditionSet',
+            field_name='hostname',
+            condition='myhost',
+        )
+        self.operator.field_value_cache = {}
+        assert self.operator.is_active('test')
+        assert self.operator.is_active('test')
+        assert gethostname.call_count == 1
+        # Finishing the request drops the cached values.
+        request_finished.send(Mock())
+        assert self.operator.field_value_cache is None
+        assert self.operator.is_active('test')
+        assert self.operator.is_active('test')
+        assert gethostname.call_count == 3
+
+    def test_shares_result_cache(self):
+        self.operator.result_cache = {}
+        switch = Switch.create(key='test', status=GLOBAL)
+        assert self.operator.is_active('test')
+        switch.status = DISABLED
+        switch.save()
+        assert self.operator.is_active_many(['test']) == dict(test=True)
+        self.operator.result_cache = {}
+        assert self.operator.is_active_many(['test']) == dict(test=False)
+        switch.status = GLOBAL
+        switch.save()
+        assert not self.operator.is_active('test')
+
+
+class TestAsyncAutoCreate:
+    def setup_method(self):
+        settings.SWITCHBOARD_SWITCH_DEFAULTS = {
+            'active_by_default': {'is_active': True},
+        }
+        # Set for every thread, including the one creating missing keys.
+        self.previous_cache = settings.SWITCHBOARD_CACHE
+        settings.SWITCHBOARD_CACHE = DictCache()
+        self.operator = SwitchManager(auto_create=True,
+                                      async_auto_create=True)
+        self.operator.auto_create_delay = 0
+
+    def teardown_method(self):
+        self.operator.stop_auto_creator()
+        settings.SWITCHBOARD_CACHE = self.previous_cache
+        del settings.SWITCHBOARD_SWITCH_DEFAULTS
+        Switch.c.drop()
+
+    def test_missing_key_is_not_created_in_request(self):
+        with patch.object(Switch, 'get_or_create') as get_or_create:
+            assert not self.operator.is_active('new')
+            assert self.operator.is_active('active_by_default')
+        assert not get_or_create.called
+        assert Switch.get(key='new') is None
+
+    def test_missing_keys_are_created_together(self):
+        Switch.create(key='existing', status=GLOBAL)
+        self.operator.is_active('existing')
+        auto_creator = self.operator._auto_creator()
+        auto_creator.stop()
+        with patch.object(Switch, 'create_missing',
+                          wraps=Switch.create_missing) as create_missing, \
+                patch.object(SwitchManager, 'patch_many', autospec=True,
+                             side_effect=SwitchManager.patch_many) as patch_many:
+            auto_creator = self.operator._auto_creator()
+            for key in ('a', 'b', 'a:c'):
+                self.operator.is_active(key)
+            auto_creator.stop()
+        assert create_missing.call_count == 1
+        assert patch_many.call_count == 1
+        assert Switch.get(key='a').status == DISABLED
+        assert Switch.get(key='a:c') is not None
+        blob = self.operator.cache[self.operator.cache_key]
+        assert sorted(blob) == ['a', 'a:c', 'b', 'existing']
+
+    def test_missing_key_is_cached(self):
+        data = self.operator._populate()
+        auto_creator = self.operator._auto_creator()
+        with patch.object(auto_creator, 'add') as add:
+            switch = self.operator.lookup('new')
+            assert self.operator.lookup('new') is switch
+        add.assert_called_once_with('new')
+        assert self.operator._missing[0] is data
+
+    def test_defaults_are_saved(self):
+        self.operator.is_active('active_by_default')
+        self.operator.stop_auto_creator()
+        assert Switch.get(key='active_by_default').status == GLOBAL
+        assert self.operator.is_active('active_by_default')
+
+    def test_item_access_creates_synchronously(self):
+        assert self.operator['new'].key == 'new'
+        assert Switch.get(key='new') is not None
+
+
+class TestBatch:
+    def setup_method(self):
+        self.operator = SwitchManager(auto_create=True)
+        self.condition_set = IPAddressConditionSet()
+        self.operator.register(self.condition_set)
+        Switch.create(key='a', status=DISABLED)
+        Switch.create(key='b', status=DISABLED)
+        self.operator._populate()
+
+    def teardown_method(self):
+        Switch.c.drop()
+        Switch._versioned_collection().drop()
+
+    def test_batch(self):
+        cs_id = self.condition_set.get_id()
+        with patch.object(Switch, 'save') as save, \
+                patch.object(Switch.c, 'bulk_write',
+                             wraps=Switch.c.bulk_write) as bulk_write, \
+                patch.object(SwitchManager, 'patch_many', autospec=True,
+                             side_effect=SwitchManager.patch_many) as patch_many:
+            with self.operator.batch() as batch:
+                batch['a'].status = GLOBAL
+                batch['b'].status = SELECTIVE
+                batch['b'].add_condition(cs_id, 'ip_address', '10.0.0.1')
+                batch['c'].status = GLOBAL
+        assert not save.called
+        assert bulk_write.call_count == 1
+        # Once per manager; the module's operator listens too.
+        assert [c.args[0] for c in patch_many.call_args_list].count(
+            self.operator) == 1
+        assert self.operator.is_active('a')
+        assert self.operator.is_active('c')
+        req = Request.blank('/', environ=dict(REMOTE_ADDR='10.0.0.1'))
+        assert self.operator.is_active('b', req)
+        assert not self.operator.is_active('b')
+        assert [s.key for s in batch.saved] == ['a', 'b', 'c']
+        versions = Switch._versioned_collection().find(
+            dict(switch_id=Switch.get(key='a')._id),
+            sort=Switch.version_sort)
+        assert versions[0]['delta']['changed']['status'] == (DISABLED, GLOBAL)
+
+    def test_batch_saves_changed_switches_only(self):
+        with self.operator.batch() as batch:
+            assert batch['a'].status == DISABLED
+            assert batch['new'].key == 'new'
+            batch['b'].value.setdefault('ns', {})
+        assert [s.key for s in batch.saved] == ['b']
+        assert Switch.get(key='new') is None
+        assert Switch.get(key='b').value == {'ns': {}}
+
+    def test_batch_error(self):
+        with pytest.raises(ValueError):
+            with self.operator.batch() as batch:
+                batch['a'].status = GLOBAL
+                raise ValueError
+        assert Switch.get(key='a').status == DISABLED
+        assert not self.operator.is_active('a')
+
+    def test_bulk_update(self):
+        with patch.object(Switch, 'find', wraps=Switch.find) as find:
+            saved = self.operator.bulk_update({
+                'a': dict(status=GLOBAL, label='A'),
+                'b': dict(description='B'),
+            })
+        assert find.call_count == 1
+        assert [s.key for s in saved] == ['a', 'b']
+        assert Switch.get(key='a').label == 'A'
+        assert Switch.get(key='b').description == 'B'
+        assert self.operator.is_active('a')
+        assert not self.operator.is_active('b')
+
+
+class TestCompactCache:
+    def setup_method(self):
+        self.operator = SwitchManager(auto_create=True, codec='compact')
+        self.operator.register(HostConditionSet)
+        self.operator.cache = Mock(wraps=DictCache())
+
+    def teardown_method(self):
+        Switch.c.drop()
+
+    def test_checks_partial_switches(self):
+        Switch.create(key='test', status=GLOBAL, label='Test')
+        other = SwitchManager(codec='compact')
+        other.cache = self.operator.cache
+        self.operator._populate()
+        assert other.is_active('test')
+        assert other.get_plan('test').switch.label == ''
+
+    def test_getitem_returns_full_switch(self):
+        Switch.create(key='test', status=GLOBAL, label='Test')
+        other = SwitchManager(codec='compact')
+        other.cache = self.operator.cache
+        self.operator._populate()
+        switch = other['test']
+        assert switch.label == 'Test'
+        switch.status = DISABLED
+        switch.save()
+        assert Switch.get(key='test').label == 'Test'
+
+
 class TestConfigure:
     def setup_method(self):
         self.config = dict(
@@ -778,10 +1069,84 @@ class TestConfigure:
         assert not isinstance(Switch.c, MockCollection)
 
     @patch('switchboard.manager.MongoClient')
-    def test_database_failure_permitted(self, MongoClient):
+    @patch('switchboard.manager.Switch.ensure_indexes')
+    def test_database_failure_permitted(self, ensure_indexes, MongoClient):
         MongoClient.side_effect = Exception('Boom!')
         configure(self.config, allow_no_mongo=True)
         assert isinstance(Switch.c, MockCollection)
+        assert not ensure_indexes.called
+
+    @patch('switchboard.manager.MongoClient')
+    @patch('switchboard.manager.Switch.ensure_indexes')
+    def test_ensure_indexes(self, ensure_indexes, MongoClient):
+        configure(self.config, allow_no_mongo=True)
+        assert ensure_indexes.called
+
+    @patch('switchboard.manager.MongoClient')
+    @patch('switchboard.manager.Switch.ensure_indexes')
+    def test_ensure_indexes_error(self, ensure_indexes, MongoClient):
+        ensure_indexes.side_effect = Exception('Boom!')
+        configure(self.config, allow_no_mongo=True)
+        assert not isinstance(Switch.c, MockCollection)
+
+    @patch('switchboard.manager.MongoClient')
+    @patch('switchboard.manager.Switch.ensure_indexes')
+    def test_ensure_indexes_disabled(self, ensure_indexes, MongoClient):
+        configure(dict(self.config, ensure_indexes=False),
+                  allow_no_mongo=True)
+        assert not ensure_indexes.called
+        del settings.SWITCHBOARD_ENSURE_INDEXES
+
+    @patch('switchboard.manager.MongoClient')
+    @patch('switchboard.manager.operator')
+    def test_refresh_interval(self, operator, MongoClient):
+        config = dict(self.config, refresh_interval='10')
+        try:
+            configure(config, allow_no_mongo=True)
+            assert operator.shared
+            operator.start_refresher.assert_called_once_with(10)
+        finally:
+            del settings.SWITCHBOARD_REFRESH_INTERVAL
+            settings.SWITCHBOARD_SHARED_CACHE = False
+
+    @patch('switchboard.manager.MongoClient')
+    @patch('switchboard.manager.operator')
+    def test_watch_changes(self, operator, MongoClient):
+        config = dict(self.config, watch_changes=True)
+        try:
+            configure(config, allow_no_mongo=True)
+            assert operator.shared
+            operator.start_watcher.assert_called_once_with()
+            operator.reset_mock()
+            MongoClient.side_effect = Exception('Boom!')
+            configure(config, allow_no_mongo=True)
+            assert not operator.start_watcher.called
+        finally:
+            del settings.SWITCHBOARD_WATCH_CHANGES
+            settings.SWITCHBOARD_SHARED_CACHE = False
+
+    @patch('switchboard.manager.MongoClient')
+    @patch('switchboard.manager.operator')
+    def test_cache_codec(self, operator, MongoClient):
+        config = dict(self.config, cache_codec='compact')
+        try:
+            configure(config, allow_no_mongo=True)
+            assert operator.codec.model is Switch
+        finally:
+            del settings.SWITCHBOARD_CACHE_CODEC
+
+    @patch('switchboard.manager.MongoClient')
+    @patch('switchboard.manager.operator')
+    def test_snapshot_path(self, operator, MongoClient, tmp_path):
+        path = str(tmp_path / 'switches')
+        config = dict(self.config, snapshot_path=path)
+        try:
+            configure(config, allow_no_mongo=True)
+            assert operator.shared
+            assert operator.snapshot_file.path == path
+        finally:
+            del settings.SWITCHBOARD_SNAPSHOT_PATH
+            settings.SWITCHBOARD_SHARED_CACHE = False
 
     @patch('switchboard.manager.MongoClient')
     def test_database_failure_fails(self, MongoClient):
@@ -822,6 +1187,30 @@ class TestManagerConcurrency:
         if self.exc:
             raise self.exc
 
+    def test_context_task_safety(self):
+        async def request(name):
+            self.operator.context['name'] = name
+            self.operator.result_cache = {}
+            await asyncio.sleep(0)
+            return self.operator.context['name'], self.operator.result_cache
+
+        async def main():
+            return await asyncio.gather(request('a'), request('b'))
+
+        (a, a_cache), (b, b_cache) = asyncio.run(main())
+        assert (a, b) == ('a', 'b')
+        assert a_cache is not b_cache
+        assert 'name' not in self.operator.context
+        assert self.operator.result_cache is None
+
+    def test_context_copied_to_thread(self):
+        async def request():
+            self.operator.context['name'] = 'a'
+            return await asyncio.to_thread(
+                lambda: self.operator.context.get('name'))
+
+        assert asyncio.run(request()) == 'a'
+
 
 class TestManagerResultCaching:
 
@@ -850,6 +1239,17 @@ class TestManagerResultCaching:
         switch.save()
         assert not self.operator.is_active('test')
 
+    def test_result_cache_object(self):
+        Switch.create(key='test', status=GLOBAL)
+        self.operator.result_cache = ResultCache()
+        instance = {'unhashable': True}
+        assert self.operator.is_active('test', instance)
+        assert self.operator.is_active('test', instance)
+        assert self.operator.is_active_many(['test'], instance) == dict(
+            test=True)
+        assert self.operator.result_cache.hits == 2
+        assert self.operator.result_cache.misses == 1
+
 
 class TestManagerResultCacheDecorator:
 
@@ -6,11 +6,21 @@ switchboard.tests.test_manager
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
+import asyncio
 from unittest.mock import Mock, patch
+
+import pytest
 from webob import Request
 
 from .. import operator
-from ..middleware import SwitchboardMiddleware
+from ..builtins import IPAddressConditionSet, QueryStringConditionSet
+from ..conditions import RequestConditionSet
+from ..helpers import ResultCache
+from ..middleware import (
+    ASGIRequest,
+    SwitchboardASGIMiddleware,
+    SwitchboardMiddleware,
+)
 
 
 class TestSwitchboardMiddleware:
@@ -28,12 +38,192 @@ class TestSwitchboardMiddleware:
         start_response = Mock()
         self.middleware(environ, start_response)
         assert 'request' in operator.context
+        assert operator.field_value_cache == {}
         assert pre_request.called
         assert post_request.called
         assert request_finished.called
 
+    def test_result_cache(self):
+        result_caches = []
+
+        def app(environ, start_response):
+            result_caches.append(operator.result_cache)
+            start_response('200 OK', [])
+            return [b'']
+
+        identity = Mock()
+        middleware = SwitchboardMiddleware(app, result_cache_size=10,
+                                           identity=identity)
+        Request.blank('/').get_response(middleware)
+        Request.blank('/').get_response(middleware)
+        assert isinstance(result_caches[0], ResultCache)
+        assert result_caches[0].maxsize == 10
+        assert result_caches[0].identity is identity
+        assert result_caches[0] is not result_caches[1]
+        assert operator.result_cache is None
+
+    def test_result_cache_disabled(self):
+        middleware = SwitchboardMiddleware(self.app, result_cache_size=0)
+        assert middleware.new_result_cache() is None
+
     @patch('switchboard.middleware.request_finished.send')
     def test_request_finished(self, send):
         req = Request.blank('/')
         self.middleware.request_finished(req)
         assert send.called
+
+
+class TestASGIRequest:
+    def setup_method(self):
+        self.scope = {
+            'type': 'http',
+            'method': 'POST',
+            'scheme': 'https',
+            'root_path': '/app',
+            'path': '/café',
+            'query_string': b'foo=bar',
+            'headers': [(b'Host', b'example.com'),
+                        (b'Referer', b'https://example.com/?a=b'),
+                        (b'Content-Type', b'text/plain'),
+                        (b'Accept', b'text/html'),
+                        (b'accept', b'*/*')],
+            'client': ('10.0.0.1', 1234),
+            'server': ('example.com', 443),
+        }
+        self.req = ASGIRequest(self.scope)
+
+    def test_attributes(self):
+        assert self.req.method == 'POST'
+        assert self.req.path == '/app/café'
+        assert self.req.query_string == 'foo=bar'
+        assert self.req.host == 'example.com'
+        assert self.req.remote_addr == '10.0.0.1'
+        assert self.req.referrer == 'https://example.com/?a=b'
+
+    def test_headers(self):
+        assert self.req.headers['content-type'] == 'text/plain'
+        assert self.req.headers.get('CONTENT-TYPE') == 'text/plain'
+        assert self.req.headers['Accept'] == 'text/html,*/*'
+        assert 'X-Requested-With' not in self.req.headers
+
+    def test_environ(self):
+        environ = self.req.environ
+        assert environ['REQUEST_METHOD'] == 'POST'
+        assert environ['SCRIPT_NAME'] == '/app'
+        assert environ['PATH_INFO'] == '/café'.encode().decode('latin-1')
+        assert environ['QUERY_STRING'] == 'foo=bar'
+        assert environ['REMOTE_ADDR'] == '10.0.0.1'
+        assert environ['SERVER_PORT'] == '443'
+        assert environ['CONTENT_TYPE'] == 'text/plain'
+        assert environ['HTTP_HOST'] == 'example.com'
+        assert environ['wsgi.url_scheme'] == 'https'
+
+    def test_minimal_scope(self):
+        req = ASGIRequest({'type': 'http'})
+        assert req.method == 'GET'
+        assert req.remote_addr is None
+        assert req.host is None
+        assert 'REMOTE_ADDR' not in req.environ
+
+    def test_host_from_server(self):
+        req = ASGIRequest({'type': 'http', 'server': ['example.com', 80]})
+        assert req.host == 'example.com:80'
+        req = ASGIRequest({'type': 'http', 'server': ('/tmp/app.sock', None)})
+        assert req.host == '/tmp/app.sock'
+
+    def test_condition_sets(self):
+        assert RequestConditionSet().can_execute(self.req)
+        assert IPAddressConditionSet().get_field_value(
+            self.req, 'ip_address') == '10.0.0.1'
+        assert QueryStringConditionSet().get_field_value(
+            self.req, 'regex') == 'foo=bar'
+
+
+class TestSwitchboardASGIMiddleware:
+    def setup_method(self):
+        operator.context = {}
+        self.seen = []
+
+        async def app(scope, receive, send):
+            self.seen.append((operator.context.get('request'),
+                              operator.result_cache,
+                              operator.field_value_cache))
+            await asyncio.sleep(0)
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        self.app = app
+        self.sent = []
+        self.middleware = SwitchboardASGIMiddleware(app)
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    async def receive(self):  # pragma: nocover
+        return {'type': 'http.disconnect'}
+
+    def call(self, *scopes):
+        async def main():
+            await asyncio.gather(*(
+                self.middleware(scope, self.receive, self.send)
+                for scope in scopes))
+        asyncio.run(main())
+
+    @patch('switchboard.middleware.request_finished.send')
+    def test_call(self, send):
+        self.call({'type': 'http', 'path': '/a'}, {'type': 'http', 'path': '/b'})
+        (a, a_cache, a_values), (b, b_cache, b_values) = self.seen
+        assert isinstance(a, ASGIRequest) and isinstance(b, ASGIRequest)
+        assert (a.path, b.path) == ('/a', '/b')
+        assert isinstance(a_cache, ResultCache)
+        assert a_cache is not b_cache
+        assert a_values == {} and a_values is not b_values
+        assert send.call_count == 2
+        assert len(self.sent) == 4
+        assert 'request' not in operator.context
+
+    @patch('switchboard.middleware.SwitchboardASGIMiddleware.post_request')
+    @patch('switchboard.middleware.SwitchboardASGIMiddleware.pre_request')
+    def test_extension_points(self, pre_request, post_request):
+        self.call({'type': 'http'})
+        req = pre_request.call_args[0][0]
+        assert req is self.seen[0][0]
+        post_request.assert_called_once_with(req, self.sent[0])
+
+    def test_async_extension_points(self):
+        calls = []
+
+        class Middleware(SwitchboardASGIMiddleware):
+            async def pre_request(self, req):
+                operator.context['user'] = 'alice'
+                calls.append('pre')
+
+            async def post_request(self, req, resp):
+                calls.append(resp['status'])
+
+        users = []
+
+        async def app(scope, receive, send):
+            users.append(operator.context.get('user'))
+            await send({'type': 'http.response.start', 'status': 204})
+
+        asyncio.run(Middleware(app)({'type': 'http'}, self.receive, self.send))
+        assert calls == ['pre', 204]
+        assert users == ['alice']
+
+    @patch('switchboard.middleware.request_finished.send')
+    def test_app_error(self, send):
+        async def app(scope, receive, send):
+            raise ValueError
+
+        middleware = SwitchboardASGIMiddleware(app)
+        with pytest.raises(ValueError):
+            asyncio.run(middleware({'type': 'http'}, self.receive, self.send))
+        assert send.called
+
+    @patch('switchboard.middleware.request_finished.send')
+    def test_lifespan(self, send):
+        self.call({'type': 'lifespan'})
+        assert self.seen[0][0] is None
+        assert not send.called
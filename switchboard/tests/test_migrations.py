@@ -0,0 +1,47 @@
+"""
+switchboard.tests.test_migrations
+~~~~~~~~~~~~~~~
+
+:copyright: (c) 2015 Kyle Adams.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from unittest.mock import patch
+
+import pytest
+
+from ..migrations import checkpoint_versions, ensure_indexes, main
+
+
+class TestMigrations:
+    @patch('switchboard.migrations.Switch.checkpoint_versions',
+           return_value=2)
+    def test_checkpoint_versions(self, checkpoint):
+        assert checkpoint_versions() == 2
+        assert checkpoint.called
+
+    @patch('switchboard.migrations.Switch.ensure_indexes',
+           return_value=['key_1', 'date_modified_1'])
+    def test_ensure_indexes(self, ensure):
+        assert ensure_indexes() == 2
+
+    @patch('switchboard.migrations.checkpoint_versions', return_value=2)
+    @patch('switchboard.migrations.configure')
+    def test_main(self, configure, checkpoint, capsys):
+        with patch.dict('switchboard.migrations.MIGRATIONS',
+                        checkpoint_versions=checkpoint):
+            assert main(['checkpoint_versions', '--mongo-host', 'db',
+                         '--mongo-port', '27018']) == 0
+        configure.assert_called_once_with(dict(
+            mongo_host='db',
+            mongo_port=27018,
+            mongo_db='switchboard',
+            mongo_collection='switches',
+            ensure_indexes=False,
+        ))
+        assert checkpoint.called
+        assert capsys.readouterr().out == 'checkpoint_versions: 2\n'
+
+    def test_main_unknown(self):
+        with pytest.raises(SystemExit):
+            main(['nope'])
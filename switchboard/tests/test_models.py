@@ -6,15 +6,22 @@ switchboard.tests.test_models
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
-from switchboard.helpers import utcnow
+from datetime import timedelta
+
+from switchboard.helpers import MockCollection, utcnow
 
 from unittest.mock import Mock, patch
 
+import pytest
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
 from ..builtins import IPAddressConditionSet
 from ..manager import SwitchManager
 from ..models import (
     MongoModel,
+    VersionWriter,
     VersioningMongoModel,
+    stop_version_writers,
     Switch,
     INHERIT, GLOBAL, SELECTIVE, DISABLED,
     INCLUDE, EXCLUDE,
@@ -38,16 +45,231 @@ class TestMongoModel:
         assert not update.called
         assert instance.foo == 'bar'
 
-    @patch('switchboard.models.MongoModel.update')
+    @patch('switchboard.models.MongoModel.find_and_update')
     @patch('switchboard.helpers.MockCollection.find_one')
-    def test_get_or_create_create(self, find_one, update):
-        find_one.side_effect = [None, dict(foo='bar', key=0)]
+    def test_get_or_create_create(self, find_one, find_and_update):
+        find_one.return_value = None
+        find_and_update.return_value = MongoModel(foo='bar', key=0)
         defaults = dict(foo='bar')
         instance, created = self.m.get_or_create(defaults=defaults, key=0)
         assert created
-        assert update.called
+        assert find_and_update.called
+        # The upsert hands back the document; it isn't read again.
+        assert find_one.call_count == 1
         assert instance.foo == 'bar'
 
+    def test_create_missing(self):
+        self.m.create(key='a', foo='bar')
+        post_save = Mock()
+        MongoModel.post_save.connect(post_save)
+        try:
+            instances = MongoModel.create_missing('key', [
+                dict(key='a', foo='baz'), dict(key='b', foo='baz'),
+            ])
+        finally:
+            MongoModel.post_save.disconnect(post_save)
+        assert sorted((i.key, i.foo) for i in instances) == [
+            ('a', 'bar'), ('b', 'baz')]
+        assert MongoModel.c.count() == 2
+        assert not post_save.called
+
+    def test_create_missing_duplicates(self):
+        self.m.create(key='a', foo='bar')
+        error = BulkWriteError(dict(writeErrors=[dict(code=11000)]))
+        with patch.object(MongoModel.c, 'bulk_write', side_effect=error):
+            instances = MongoModel.create_missing('key', [dict(key='a')])
+        assert [i.foo for i in instances] == ['bar']
+
+    def test_create_missing_errors(self):
+        error = BulkWriteError(dict(writeErrors=[dict(code=121)]))
+        with patch.object(MongoModel.c, 'bulk_write', side_effect=error):
+            with pytest.raises(BulkWriteError):
+                MongoModel.create_missing('key', [dict(key='a')])
+
+    def test_create_missing_nothing(self):
+        assert MongoModel.create_missing('key', []) == []
+
+    def connect_signals(self):
+        # Listeners (e.g. the caches) make calls of their own once the
+        # signals are sent, so only the calls made before that count.
+        self.calls = None
+
+        def record_calls(sender):
+            if self.calls is None:
+                self.calls = [call[0] for call in MongoModel.c.method_calls]
+
+        self.signals = Mock()
+        self.signals.pre_save.side_effect = record_calls
+        self.signals.pre_delete.side_effect = record_calls
+        for name in ('pre_save', 'post_save', 'pre_delete', 'post_delete'):
+            getattr(MongoModel, name).connect(getattr(self.signals, name))
+
+    def disconnect_signals(self):
+        for name in ('pre_save', 'post_save', 'pre_delete', 'post_delete'):
+            getattr(MongoModel, name).disconnect(getattr(self.signals, name))
+
+    def collection_calls(self, func, *args, **kwargs):
+        with patch.object(MongoModel, 'c', Mock(wraps=MongoModel.c)):
+            func(*args, **kwargs)
+            return [call[0] for call in MongoModel.c.method_calls]
+
+    def test_save_round_trips(self):
+        instance = self.m.create(key='a', foo='bar')
+        instance.foo = 'baz'
+        # Listeners of post_save may make calls of their own afterwards.
+        assert self.collection_calls(instance.save)[0] == 'update_one'
+        assert MongoModel.get(key='a').foo == 'baz'
+
+    def test_save_pre_save(self):
+        instance = self.m.create(key='a', foo='bar')
+        instance.foo = 'baz'
+        self.connect_signals()
+        try:
+            with patch.object(MongoModel, 'c', Mock(wraps=MongoModel.c)):
+                instance.save()
+        finally:
+            self.disconnect_signals()
+        # Sent before the write, with the document as it was.
+        assert self.calls == ['find_one']
+        assert self.signals.pre_save.call_args[0][0].foo == 'bar'
+        assert self.signals.post_save.call_args[0][0] is instance
+
+    def test_save_new_with_id(self):
+        MongoModel(_id='x', key='a').save()
+        assert MongoModel.get(_id='x').key == 'a'
+
+    def test_update(self):
+        self.m.create(key='a', foo='bar', baz=1)
+        self.connect_signals()
+        try:
+            with patch.object(MongoModel, 'c', Mock(wraps=MongoModel.c)):
+                result = MongoModel.update(
+                    dict(key='a'),
+                    {'$set': dict(foo='qux'), '$unset': dict(baz='')})
+        finally:
+            self.disconnect_signals()
+        assert self.calls == ['find_one']
+        # The collection's own result, as before.
+        assert result['ok'] == 1.0
+        assert self.signals.pre_save.call_args[0][0].foo == 'bar'
+        current = self.signals.post_save.call_args[0][0]
+        assert current.foo == 'qux'
+        assert not hasattr(current, 'baz')
+
+    def test_find_and_update_round_trips(self):
+        self.m.create(key='a', foo='bar', baz=1)
+        current = []
+        calls = self.collection_calls(
+            lambda: current.append(MongoModel.find_and_update(
+                dict(key='a'),
+                {'$set': dict(key='b'), '$unset': dict(baz='')})))
+        assert calls[0] == 'find_one_and_update'
+        assert current[0].key == 'b'
+        assert not hasattr(current[0], 'baz')
+        assert MongoModel.get(key='b') is not None
+
+    def test_find_and_update_pre_save(self):
+        self.m.create(key='a', foo='bar')
+        self.connect_signals()
+        try:
+            with patch.object(MongoModel, 'c', Mock(wraps=MongoModel.c)):
+                current = MongoModel.find_and_update(
+                    dict(key='a'), {'$set': dict(foo='baz')})
+        finally:
+            self.disconnect_signals()
+        assert self.calls == ['find_one']
+        assert self.signals.pre_save.call_args[0][0].foo == 'bar'
+        assert self.signals.post_save.call_args[0][0] is current
+        assert current.foo == 'baz'
+
+    def test_find_and_update_upsert(self):
+        current = MongoModel.find_and_update(
+            dict(key='a'), {'$set': dict(foo='bar')}, upsert=True)
+        assert current.foo == 'bar'
+        assert current._id == MongoModel.get(key='a')._id
+
+    def test_find_and_update_embedded_field(self):
+        self.m.create(key='a', value=dict(ip='1.2.3.4', port=80))
+        current = MongoModel.find_and_update(
+            dict(key='a'), {'$set': {'value.ip': '5.6.7.8'}})
+        assert current.value == dict(ip='5.6.7.8', port=80)
+        assert not hasattr(current, 'value.ip')
+
+    def test_find_and_update_nothing(self):
+        assert MongoModel.find_and_update(
+            dict(key='a'), {'$set': dict(foo=1)}) is None
+
+    def test_remove(self):
+        self.m.create(key='a', foo='bar')
+        self.connect_signals()
+        try:
+            with patch.object(MongoModel, 'c', Mock(wraps=MongoModel.c)):
+                result = MongoModel.remove(key='a')
+        finally:
+            self.disconnect_signals()
+        assert self.calls == ['find_one']
+        assert result['ok'] == 1.0
+        assert self.signals.pre_delete.call_args[0][0].foo == 'bar'
+        assert self.signals.post_delete.call_args[0][0].foo == 'bar'
+        assert MongoModel.get(key='a') is None
+
+    def test_find_and_remove_round_trips(self):
+        self.m.create(key='a', foo='bar')
+        removed = []
+        calls = self.collection_calls(
+            lambda: removed.append(MongoModel.find_and_remove(key='a')))
+        assert calls[0] == 'find_one_and_delete'
+        assert removed[0].foo == 'bar'
+        assert MongoModel.get(key='a') is None
+        assert MongoModel.find_and_remove(key='a') is None
+
+    def test_get_or_create_race(self):
+        MongoModel.c.create_index([('key', 1)], unique=True)
+        self.m.create(key=0, foo='bar')
+        find_one = MongoModel.c.find_one
+        calls = []
+
+        def created_after_lookup(spec):
+            calls.append(spec)
+            return None if len(calls) == 1 else find_one(spec)
+
+        with patch.object(MongoModel.c, 'find_one',
+                          side_effect=created_after_lookup):
+            instance, created = self.m.get_or_create(
+                defaults=dict(foo='baz'), key=0)
+        assert not created
+        assert instance.foo == 'bar'
+        assert MongoModel.c.count() == 1
+
+    def test_ensure_indexes(self):
+        assert MongoModel.ensure_indexes() == []
+
+    def test_save_many(self):
+        existing = self.m.create(key='a', foo='bar')
+        existing.foo = 'baz'
+        new = MongoModel(key='b', foo='baz')
+        post_save, post_save_many = Mock(), Mock()
+        MongoModel.post_save.connect(post_save)
+        MongoModel.post_save_many.connect(post_save_many)
+        try:
+            with patch.object(MongoModel.c, 'bulk_write',
+                              wraps=MongoModel.c.bulk_write) as bulk_write:
+                saved = MongoModel.save_many([existing, new])
+        finally:
+            MongoModel.post_save.disconnect(post_save)
+            MongoModel.post_save_many.disconnect(post_save_many)
+        assert saved == [existing, new]
+        assert bulk_write.call_count == 1
+        assert hasattr(new, '_id')
+        assert MongoModel.get(_id=new._id).foo == 'baz'
+        assert MongoModel.get(key='a').foo == 'baz'
+        assert MongoModel.c.count() == 2
+        assert not post_save.called
+        post_save_many.assert_called_once_with([existing, new])
+
+    def test_save_many_nothing(self):
+        assert MongoModel.save_many([]) == []
+
 
 class TestVersioningMongoModel:
     def setup_method(self):
@@ -141,12 +363,201 @@ class TestVersioningMongoModel:
             delta=dict(deleted=dict(a=1))
         )
         c = Mock()
-        c.find.return_value = [v1, v2, v3, v4]
+        # Newest first, as sorted by the query.
+        c.find.return_value = [v4, v3, v2, v1]
         self.m._versioned_collection = lambda: c
         prev = self.m.previous_version()
         assert prev.b == 3
         assert prev.c == 4
         assert not hasattr(prev, 'a')
+        c.find.assert_called_once_with(dict(switch_id='0'),
+                                       sort=self.m.version_sort)
+
+    def test_previous_version_checkpoint(self):
+        v1 = dict(delta=dict(added=dict(a=1)))
+        v2 = dict(delta=dict(changed=dict(a=(1, 2))),
+                  checkpoint=dict(a=2, b=1))
+        v3 = dict(delta=dict(added=dict(c=3)))
+        c = Mock()
+        c.find.return_value = iter([v3, v2, v1])
+        self.m._versioned_collection = lambda: c
+        prev = self.m.previous_version()
+        assert prev.to_bson() == dict(a=2, b=1, c=3)
+
+
+class TestVersionCheckpoints:
+    def setup_method(self):
+        self.m = VersioningMongoModel(_id='0')
+        self.collection = patch.object(VersioningMongoModel, 'c',
+                                       MockCollection('versioned'))
+        self.collection.start()
+
+    def teardown_method(self):
+        self.collection.stop()
+
+    def save(self, **kwargs):
+        document = dict(_id='0', **kwargs)
+        VersioningMongoModel.c.update_one(
+            {'_id': '0'}, {'$set': document}, upsert=True)
+        VersioningMongoModel(**document).save_version()
+
+    def versions(self):
+        return VersioningMongoModel._versioned_collection().find(
+            dict(switch_id='0'), sort=VersioningMongoModel.version_sort)
+
+    def test_save_version_checkpoint(self):
+        with patch.object(VersioningMongoModel, 'checkpoint_interval', 3):
+            for i in range(7):
+                self.save(a=i)
+        checkpoints = [v.get('checkpoint') for v in self.versions()]
+        assert checkpoints == [None, dict(_id='0', a=5), None, None,
+                               dict(_id='0', a=2), None, None]
+        assert self.m.previous_version().a == 6
+
+    def test_save_version_deleted_checkpoint(self):
+        with patch.object(VersioningMongoModel, 'checkpoint_interval', 2):
+            self.save(a=1)
+            VersioningMongoModel.c.delete_one({'_id': '0'})
+            self.m.save_version()
+        assert self.versions()[0]['checkpoint'] == {}
+        assert self.m.previous_version() is None
+
+    def test_checkpoint_versions(self):
+        for i in range(3):
+            self.save(a=i)
+        assert not any('checkpoint' in v for v in self.versions())
+        assert VersioningMongoModel.checkpoint_versions() == 1
+        assert self.versions()[0]['checkpoint'] == dict(_id='0', a=2)
+        assert VersioningMongoModel.checkpoint_versions() == 0
+
+    def test_save_versions(self):
+        self.save(a=1)
+        models = [VersioningMongoModel(_id='0', a=2),
+                  VersioningMongoModel(_id='1', b=1)]
+        vc = VersioningMongoModel._versioned_collection()
+        with patch.object(vc, 'insert_many',
+                          wraps=vc.insert_many) as insert_many:
+            VersioningMongoModel.save_versions(models, username='test')
+        assert insert_many.call_count == 1
+        assert self.versions()[0]['delta']['changed'] == dict(a=(1, 2))
+        assert self.versions()[0]['username'] == 'test'
+        assert vc.find_one(dict(switch_id='1'))['delta']['added'] == dict(
+            _id='1', b=1)
+
+    def test_list_versions(self):
+        with patch.object(VersioningMongoModel, 'checkpoint_interval', 1):
+            self.save(a=1)
+            self.save(a=2)
+        with patch.object(Switch, 'c', VersioningMongoModel.c):
+            versions = Switch(_id='0').list_versions()
+        assert [v['delta'] for v in versions] == [
+            dict(added={}, deleted={}, changed=dict(a=(1, 2))),
+            dict(added=dict(_id='0', a=1), deleted={}, changed={}),
+        ]
+        assert not any('checkpoint' in v for v in versions)
+        assert 'checkpoint' in self.versions()[0]
+
+
+class TestVersionWriter:
+    def setup_method(self):
+        self.collection = patch.object(VersioningMongoModel, 'c',
+                                       MockCollection('versioned'))
+        self.collection.start()
+        self.writer = VersionWriter(VersioningMongoModel, batch_size=2)
+
+    def teardown_method(self):
+        self.writer.stop()
+        stop_version_writers()
+        self.collection.stop()
+
+    def versions(self):
+        return VersioningMongoModel._versioned_collection().find(
+            dict(switch_id='0'), sort=VersioningMongoModel.version_sort)
+
+    def test_version_documents(self):
+        now = utcnow()
+        with patch.object(VersioningMongoModel, 'checkpoint_interval', 2):
+            docs = VersioningMongoModel.version_documents([
+                ('0', dict(a=1), now, dict(username='a')),
+                ('1', dict(b=1), now, {}),
+                ('0', dict(a=1), now, {}),
+                ('0', dict(a=2), now, {}),
+                ('0', None, now, {}),
+            ])
+        assert [(d['switch_id'], d['delta'], d.get('checkpoint'))
+                for d in docs] == [
+            ('0', dict(added=dict(a=1), deleted={}, changed={}), None),
+            ('1', dict(added=dict(b=1), deleted={}, changed={}), None),
+            ('0', dict(added={}, deleted={}, changed=dict(a=(1, 2))),
+             dict(a=2)),
+            ('0', dict(added={}, deleted=dict(a=2), changed={}), None),
+        ]
+        assert docs[0]['username'] == 'a'
+
+    def test_write(self):
+        self.writer.start()
+        for i in range(5):
+            self.writer.add('0', dict(a=i), username='test')
+        self.writer.flush()
+        versions = self.versions()
+        assert len(versions) == 5
+        assert versions[0]['delta']['changed'] == dict(a=(3, 4))
+        assert versions[0]['username'] == 'test'
+
+    def test_batches(self):
+        for i in range(5):
+            self.writer.add('0', dict(a=i))
+        with patch.object(VersioningMongoModel, 'version_documents',
+                          wraps=VersioningMongoModel.version_documents) as f:
+            self.writer.start()
+            self.writer.flush()
+        assert [len(c[0][0]) for c in f.call_args_list] == [2, 2, 1]
+
+    def test_write_error(self):
+        with patch.object(VersioningMongoModel, 'version_documents',
+                          side_effect=Exception('Boom!')):
+            self.writer.start()
+            self.writer.add('0', dict(a=1))
+            self.writer.flush()
+        self.writer.add('0', dict(a=2))
+        self.writer.flush()
+        assert len(self.versions()) == 1
+
+    def test_stop_flushes(self):
+        self.writer.start()
+        self.writer.add('0', dict(a=1))
+        self.writer.stop()
+        assert not self.writer.is_alive()
+        assert len(self.versions()) == 1
+
+    def test_backlog(self):
+        writer = VersionWriter(VersioningMongoModel, max_backlog=1)
+        writer.add('0', dict(a=1))
+        assert writer.queue.full()
+
+    def test_queue_version(self):
+        model = VersioningMongoModel(_id='0', a={'b': 1})
+        model.queue_version(username='test')
+        model.a['b'] = 2
+        VersioningMongoModel(_id='0').queue_version(deleted=True)
+        writer = VersioningMongoModel.version_writer()
+        assert writer is VersioningMongoModel.version_writer()
+        writer.flush()
+        assert [v['delta'] for v in reversed(self.versions())] == [
+            dict(added=dict(_id='0', a={'b': 1}), deleted={}, changed={}),
+            dict(added={}, deleted=dict(_id='0', a={'b': 1}), changed={}),
+        ]
+
+    def test_create_missing_queues_versions(self):
+        VersioningMongoModel.c.insert_one(dict(_id='a', key='a'))
+        VersioningMongoModel.create_missing('key', [
+            dict(_id='a', key='a'), dict(_id='b', key='b'),
+        ])
+        VersioningMongoModel.version_writer().flush()
+        # Only for the one created.
+        versions = VersioningMongoModel._versioned_collection().find()
+        assert [(v['switch_id'], v['delta']['added'])
+                for v in versions] == [('b', dict(_id='b', key='b'))]
 
 
 class TestConstant:
@@ -209,6 +620,21 @@ class TestSwitch:
         assert version
         assert version['delta']['changed']['key'] == ('test', 'test2')
 
+    def test_ensure_indexes(self):
+        with patch.object(Switch, 'c', MockCollection('switches')):
+            names = Switch.ensure_indexes()
+            assert Switch.ensure_indexes() == names
+            assert Switch.c.indexes['key_1'] == dict(key=[('key', 1)],
+                                                     unique=True)
+            assert 'date_modified_1' in Switch.c.indexes
+            assert 'date_modified_1' in Switch._tombstone_collection().indexes
+            assert list(Switch._versioned_collection().indexes.values()) == [
+                dict(key=[('switch_id', 1), ('timestamp', -1), ('_id', -1)],
+                     unique=False)]
+            Switch.create(key='test')
+            with pytest.raises(DuplicateKeyError):
+                Switch.create(key='test')
+
     def test_construct_with_defaults(self):
         settings.SWITCHBOARD_SWITCH_DEFAULTS = {
             'active_by_default': dict(is_active=True, label='active'),
@@ -221,6 +647,30 @@ class TestSwitch:
         assert inactive_switch.status == DISABLED
         assert inactive_switch.label == 'inactive'
 
+    def test_save_stamps_date_modified(self):
+        self.switch.date_modified = utcnow() - timedelta(days=1)
+        before = utcnow()
+        self.switch.save()
+        assert self.switch.date_modified >= before
+        doc = Switch.c.find_one(dict(key='test'))
+        assert doc['date_modified'] == self.switch.date_modified
+
+    def test_update_stamps_date_modified(self):
+        before = utcnow()
+        Switch.update(dict(key='test'), {'$set': dict(status=GLOBAL)})
+        assert Switch.get(key='test').date_modified >= before
+
+    def test_changed_since(self):
+        since = utcnow()
+        Switch.create(key='new')
+        Switch.remove(key='test')
+        changed, deleted = Switch.changed_since(since)
+        assert [s.key for s in changed] == ['new']
+        assert [d['key'] for d in deleted] == ['test']
+        assert deleted[0]['deleted_id'] == self.switch._id
+        assert Switch.changed_since(utcnow()) == ([], [])
+        Switch._tombstone_collection().drop()
+
     def test_get_status_display(self):
         assert (Switch(status=INHERIT).get_status_display() ==
                       'Inherit')
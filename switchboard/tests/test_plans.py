@@ -0,0 +1,276 @@
+"""
+switchboard.tests.test_plans
+~~~~~~~~~~~~~~~
+
+:copyright: (c) 2015 Kyle Adams.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from unittest.mock import Mock, patch
+
+from ..builtins import IPAddressConditionSet
+from ..conditions import ConditionSet
+from ..manager import SwitchManager, registry_by_namespace
+from ..models import (
+    Switch,
+    DISABLED, GLOBAL, INHERIT, SELECTIVE,
+    INCLUDE, EXCLUDE,
+)
+from ..plans import ChainPlan, Evaluation, SwitchPlan
+
+
+class TestSwitchPlan:
+    def setup_method(self):
+        self.condition_set = Mock()
+        self.condition_set.compile.return_value = 'compiled'
+        self.condition_sets = dict(ns=self.condition_set)
+
+    def plan(self, status, value=None):
+        switch = Switch(key='test', status=status, value=value or {})
+        return SwitchPlan(switch, self.condition_sets)
+
+    def test_global(self):
+        assert self.plan(GLOBAL).is_active(Evaluation([None]), None) is True
+
+    def test_disabled(self):
+        assert self.plan(DISABLED).is_active(Evaluation([None]), True) is False
+
+    def test_inherit(self):
+        plan = self.plan(INHERIT)
+        assert plan.is_active(Evaluation([None]), 'default') == 'default'
+
+    def test_selective_no_conditions_inherits(self):
+        plan = self.plan(SELECTIVE)
+        assert plan.is_active(Evaluation([None]), 'default') == 'default'
+
+    def test_compiles_registered_namespaces_only(self):
+        plan = self.plan(SELECTIVE, dict(ns={'f': []}, other={'f': []}))
+        self.condition_set.compile.assert_called_once_with({'f': []})
+        assert plan.conditions == [(self.condition_set, 'compiled')]
+        assert plan.has_conditions
+
+    def test_unregistered_conditions_are_inactive(self):
+        plan = self.plan(SELECTIVE, dict(other={'f': []}))
+        assert plan.is_active(Evaluation([None]), True) is False
+
+    def test_selective_uses_compiled_conditions(self):
+        self.condition_set.has_active_compiled.return_value = True
+        plan = self.plan(SELECTIVE, dict(ns={'f': []}))
+        evaluation = Evaluation(['foo', None])
+        assert plan.is_active(evaluation, None) is True
+        self.condition_set.has_active_compiled.assert_called_once_with(
+            'compiled', evaluation.instances, evaluation)
+
+    def test_selective_exclusion(self):
+        self.condition_set.has_active_compiled.return_value = False
+        plan = self.plan(SELECTIVE, dict(ns={'f': []}))
+        assert plan.is_active(Evaluation([None]), True) is False
+
+
+    def test_overridden_is_active_checks_raw_condition(self):
+        class LegacyConditionSet(ConditionSet):
+            def is_active(self, instance, condition):
+                if instance == 'foo' and condition == {'f': []}:
+                    return True
+
+        condition_set = LegacyConditionSet()
+        self.condition_sets['ns'] = condition_set
+        plan = self.plan(SELECTIVE, dict(ns={'f': []}))
+        assert plan.raw_conditions == [(condition_set, {'f': []})]
+        assert plan.is_active(Evaluation(['foo', None]), None) is True
+        assert plan.is_active(Evaluation(['bar', None]), None) is False
+
+    def test_overridden_has_active_condition_gets_instances(self):
+        class LegacyConditionSet(ConditionSet):
+            has_active_condition = Mock(return_value=True)
+
+        self.condition_sets['ns'] = LegacyConditionSet()
+        plan = self.plan(SELECTIVE, dict(ns={'f': []}))
+        assert plan.is_active(Evaluation(['foo', None]), None) is True
+        LegacyConditionSet.has_active_condition.assert_called_once_with(
+            {'f': []}, ['foo'])
+
+
+class TestChainPlan:
+    def setup_method(self):
+        self.condition_set = Mock()
+        self.condition_set.compile.return_value = 'compiled'
+        self.condition_sets = dict(ns=self.condition_set)
+
+    def plan(self, status, conditions=False):
+        value = dict(ns={'f': []}) if conditions else {}
+        switch = Switch(key='test', status=status, value=value)
+        return SwitchPlan(switch, self.condition_sets)
+
+    def chain(self, *plans):
+        chain = None
+        for plan in plans:
+            chain = ChainPlan(chain, plan)
+        return chain
+
+    def test_missing(self):
+        chain = self.chain(None, None)
+        assert chain.is_active(Evaluation([None]), 'default') == 'default'
+
+    def test_disabled_parent(self):
+        chain = self.chain(self.plan(DISABLED), self.plan(SELECTIVE, True))
+        assert chain.disabled
+        assert chain.selective == []
+        assert chain.is_active(Evaluation([None]), True) is False
+
+    def test_global_parent(self):
+        chain = self.chain(self.plan(GLOBAL), self.plan(INHERIT), None)
+        assert chain.enabled
+        assert chain.is_active(Evaluation([None]), False) is True
+
+    def test_global_child_of_inherit(self):
+        chain = self.chain(self.plan(INHERIT), self.plan(GLOBAL))
+        assert chain.is_active(Evaluation([None]), None) is True
+
+    def test_disabled_child_of_global(self):
+        chain = self.chain(self.plan(GLOBAL), self.plan(DISABLED))
+        assert chain.is_active(Evaluation([None]), True) is False
+
+    def test_selective(self):
+        chain = self.chain(self.plan(SELECTIVE, True), self.plan(INHERIT))
+        self.condition_set.has_active_compiled.return_value = True
+        assert chain.is_active(Evaluation([None]), False) is True
+        self.condition_set.has_active_compiled.return_value = False
+        assert chain.is_active(Evaluation([None]), True) is False
+
+    def test_selective_results_are_shared(self):
+        parent = self.plan(SELECTIVE, True)
+        self.condition_set.has_active_compiled.return_value = True
+        evaluation = Evaluation([None])
+        self.chain(parent, self.plan(INHERIT)).is_active(evaluation, False)
+        self.chain(parent, self.plan(GLOBAL)).is_active(evaluation, False)
+        assert self.condition_set.has_active_compiled.call_count == 1
+
+
+class TestEvaluation:
+    def test_get_field_value_is_memoized(self):
+        condition_set = Mock()
+        condition_set.get_field_value.return_value = 'value'
+        instance = object()
+        evaluation = Evaluation([instance, None])
+        assert evaluation.get_field_value(condition_set, instance, 'f') == 'value'
+        assert evaluation.get_field_value(condition_set, instance, 'f') == 'value'
+        condition_set.get_field_value.assert_called_once_with(instance, 'f')
+        evaluation.get_field_value(condition_set, None, 'f')
+        evaluation.get_field_value(condition_set, instance, 'g')
+        assert condition_set.get_field_value.call_count == 3
+
+
+class TestManagerPlans:
+    def setup_method(self):
+        self.operator = SwitchManager(auto_create=True)
+        self.operator.register(IPAddressConditionSet)
+
+    def teardown_method(self):
+        Switch.c.drop()
+
+    def test_plan_is_reused_while_cache_is_current(self):
+        Switch.create(key='test', status=GLOBAL)
+        self.operator.cache = Mock()
+        self.operator.cache.get.return_value = None
+        self.operator._populate(reset=True)
+        plan = self.operator.get_plan('test')
+        assert self.operator.get_plan('test') is plan
+
+    def test_plan_is_rebuilt_after_save(self):
+        switch = Switch.create(key='test', status=GLOBAL)
+        self.operator.cache = Mock()
+        self.operator.cache.get.return_value = None
+        plan = self.operator.get_plan('test')
+        switch.status = DISABLED
+        switch.save()
+        new_plan = self.operator.get_plan('test')
+        assert new_plan is not plan
+        assert new_plan.status == DISABLED
+
+    def test_plan_is_rebuilt_after_register(self):
+        Switch.create(key='test', status=GLOBAL)
+        self.operator.cache = Mock()
+        self.operator.cache.get.return_value = None
+        plan = self.operator.get_plan('test')
+        self.operator.register(IPAddressConditionSet)
+        assert self.operator.get_plan('test') is not plan
+
+    def test_condition_values_are_parsed_once(self):
+        condition_set = registry_by_namespace['ip']
+        Switch.create(key='test', status=SELECTIVE, value={
+            'ip': {'percent': [[INCLUDE, '0-50'], [EXCLUDE, '10-20']]},
+        })
+        self.operator.cache = Mock()
+        self.operator.cache.get.return_value = None
+        req = Mock(remote_addr='1.1.1.1', environ={}, headers={}, method='GET')
+        percent = condition_set.fields['percent']
+        with patch.object(percent, 'prepare',
+                          wraps=percent.prepare) as prepare:
+            assert self.operator.is_active('test', req)
+            assert self.operator.is_active('test', req)
+            assert prepare.call_count == 2
+
+    def test_chain_is_reused_while_cache_is_current(self):
+        Switch.create(key='a', status=GLOBAL)
+        Switch.create(key='a:b', status=INHERIT)
+        self.operator.auto_create = False
+        self.operator.cache = Mock()
+        self.operator.cache.get.return_value = None
+        self.operator._populate(reset=True)
+        chain = self.operator.get_chain('a:b:c')
+        assert chain.enabled
+        assert self.operator.get_chain('a:b:c') is chain
+        assert self.operator.get_chain('a:b') is self.operator._chains['a:b']
+        with patch.object(self.operator, 'get_plan') as get_plan:
+            assert self.operator.is_active('a:b:c')
+        assert not get_plan.called
+
+    def test_chain_is_rebuilt_after_save(self):
+        switch = Switch.create(key='a', status=GLOBAL)
+        self.operator.auto_create = False
+        self.operator.cache = Mock()
+        self.operator.cache.get.return_value = None
+        assert self.operator.is_active('a:b')
+        switch.status = DISABLED
+        switch.save()
+        assert not self.operator.is_active('a:b')
+
+    def test_chain_populates_once(self):
+        Switch.create(key='a', status=GLOBAL)
+        Switch.create(key='a:b', status=INHERIT)
+        Switch.create(key='a:b:c', status=INHERIT)
+        self.operator.auto_create = False
+        self.operator.cache = None
+        with patch.object(Switch, 'all', wraps=Switch.all) as all:
+            assert self.operator.is_active('a:b:c')
+        assert all.call_count == 1
+
+    def test_get_field_value_opt_out(self):
+        condition_set = Mock(cache_field_values=False)
+        evaluation = Evaluation([None])
+        evaluation.get_field_value(condition_set, None, 'f')
+        evaluation.get_field_value(condition_set, None, 'f')
+        assert condition_set.get_field_value.call_count == 2
+        assert evaluation.field_values == {}
+
+    def test_shared_field_values(self):
+        condition_set = Mock()
+        condition_set.get_field_value.return_value = 'value'
+        instance = object()
+        field_values = {}
+        Evaluation([instance, None], field_values).get_field_value(
+            condition_set, instance, 'f')
+        Evaluation([instance, None], field_values).get_field_value(
+            condition_set, instance, 'f')
+        condition_set.get_field_value.assert_called_once_with(instance, 'f')
+
+    def test_shared_field_values_checks_identity(self):
+        condition_set = Mock()
+        instance = object()
+        other = object()
+        # Simulate another object having been allocated at the same address.
+        field_values = {(condition_set, id(other), 'f'): (instance, 'stale')}
+        condition_set.get_field_value.return_value = 'fresh'
+        evaluation = Evaluation([other, None], field_values)
+        assert evaluation.get_field_value(condition_set, other, 'f') == 'fresh'
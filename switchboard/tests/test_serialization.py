@@ -0,0 +1,86 @@
+"""
+switchboard.tests.test_serialization
+~~~~~~~~~~~~~~~
+
+:copyright: (c) 2015 Kyle Adams.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from bson import ObjectId
+
+from ..models import Switch, SELECTIVE, INCLUDE
+from ..serialization import CompactCodec, get_codec
+
+
+class TestCompactCodec:
+    def setup_method(self):
+        self.codec = CompactCodec(Switch)
+        self.switch = Switch(_id='1', key='test', status=SELECTIVE,
+                             label='Test', description='A test switch',
+                             value={'ns': {'field': [[INCLUDE, 'a']]}})
+
+    def test_item_keeps_cache_fields(self):
+        switch = self.codec.decode_item(self.codec.encode_item(self.switch))
+        assert isinstance(switch, Switch)
+        assert switch._id == '1'
+        assert switch.key == 'test'
+        assert switch.status == SELECTIVE
+        assert switch.value == self.switch.value
+        assert switch.label == ''
+        assert switch.description == ''
+        assert self.codec.partial
+
+    def test_all_fields(self):
+        codec = CompactCodec(Switch, fields=())
+        assert not codec.partial
+        switch = codec.decode_item(codec.encode_item(self.switch))
+        assert switch.label == 'Test'
+        assert switch.description == 'A test switch'
+
+    def test_may_have_id(self):
+        payload = self.codec.encode_item(self.switch)
+        assert self.codec.may_have_id(payload, '1')
+        assert not self.codec.may_have_id(payload, 'other')
+        assert not self.codec.may_have_id(payload, ObjectId())
+        assert self.codec.may_have_id(memoryview(payload), '1')
+        # Could be anywhere in the pickle.
+        assert self.codec.may_have_id(payload, 2)
+        codec = CompactCodec(Switch, fields=('key',))
+        assert not codec.may_have_id(codec.encode_item(self.switch), '1')
+
+    def test_round_trip(self):
+        items = dict(test=self.codec.encode_item(self.switch))
+        payload = self.codec.encode(items, 'gen', dict(test=1), None)
+        assert payload.startswith(b'SBC\x01')
+        assert self.codec.decode(payload) == (items, 'gen', dict(test=1),
+                                              None)
+
+    def test_compact(self):
+        import pickle
+        items = dict(test=self.codec.encode_item(self.switch))
+        payload = self.codec.encode(items)
+        assert len(payload) < len(pickle.dumps(dict(test=self.switch)))
+
+    def test_other_version_ignored(self):
+        payload = self.codec.encode({})
+        self.codec.header = b'SBC\x02'
+        assert self.codec.decode(payload) is None
+
+    def test_other_fields_ignored(self):
+        payload = self.codec.encode({})
+        codec = CompactCodec(Switch, fields=('key',))
+        assert codec.decode(payload) is None
+
+
+class TestGetCodec:
+    def test_none(self):
+        assert get_codec(None, Switch) is None
+
+    def test_compact(self):
+        codec = get_codec('compact', Switch)
+        assert isinstance(codec, CompactCodec)
+        assert codec.model is Switch
+
+    def test_instance(self):
+        codec = CompactCodec(Switch)
+        assert get_codec(codec, Switch) is codec
@@ -0,0 +1,137 @@
+"""
+switchboard.tests.test_snapshots
+~~~~~~~~~~~~~~~
+
+:copyright: (c) 2015 Kyle Adams.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import os
+import time
+from unittest.mock import patch
+
+import pytest
+
+from ..models import Switch
+from ..serialization import CompactCodec
+from ..snapshots import SnapshotFile, get_snapshot_file
+
+
+def wrap(items, generation, versions, synced_at):
+    return dict(items=items, generation=generation, versions=versions,
+                synced_at=synced_at)
+
+
+class TestSnapshotFile:
+    def setup_method(self):
+        self.codec = CompactCodec(Switch)
+        self.items = dict(a=b'first', b=b'second')
+
+    def create(self, tmp_path):
+        snapshot_file = SnapshotFile(str(tmp_path / 'switches'))
+        snapshot_file.retry_interval = 0
+        return snapshot_file
+
+    def test_no_snapshot(self, tmp_path):
+        snapshot_file = self.create(tmp_path)
+        assert snapshot_file.version() == 0
+        assert snapshot_file.read(self.codec, wrap) == (0, None)
+
+    def test_round_trip(self, tmp_path):
+        writer = self.create(tmp_path)
+        assert writer.write(self.codec, self.items, 'gen', dict(a=1)) == 1
+        reader = self.create(tmp_path)
+        version, data = reader.read(self.codec, wrap)
+        assert version == 1
+        assert {k: bytes(v) for k, v in data['items'].items()} == self.items
+        assert data['generation'] == 'gen'
+        assert data['versions'] == dict(a=1)
+        # The same data is handed out until the version changes.
+        assert reader.read(self.codec, wrap)[1] is data
+
+    def test_values_are_mapped(self, tmp_path):
+        self.create(tmp_path).write(self.codec, self.items)
+        data = self.create(tmp_path).read(self.codec, wrap)[1]
+        assert isinstance(data['items']['a'], memoryview)
+
+    def test_new_versions(self, tmp_path):
+        writer = self.create(tmp_path)
+        reader = self.create(tmp_path)
+        writer.write(self.codec, self.items)
+        first = reader.read(self.codec, wrap)[1]
+        writer.write(self.codec, dict(a=b'changed'))
+        version, data = reader.read(self.codec, wrap)
+        assert version == 2
+        assert bytes(data['items']['a']) == b'changed'
+        # Values already handed out stay readable.
+        assert bytes(first['items']['a']) == b'first'
+
+    def test_old_versions_removed(self, tmp_path):
+        writer = self.create(tmp_path)
+        for n in range(3):
+            writer.write(self.codec, self.items)
+        path = writer.path
+        assert not os.path.exists(f'{path}.1')
+        assert os.path.exists(f'{path}.2')
+        assert os.path.exists(f'{path}.3')
+        assert not os.path.exists(f'{path}.3.tmp')
+
+    def test_other_codec_ignored(self, tmp_path):
+        self.create(tmp_path).write(self.codec, self.items)
+        codec = CompactCodec(Switch, fields=('key',))
+        assert self.create(tmp_path).read(codec, wrap) == (0, None)
+
+    def test_single_writer(self, tmp_path):
+        first = self.create(tmp_path)
+        second = self.create(tmp_path)
+        assert first.acquire()
+        assert first.acquire()
+        assert not second.acquire()
+        # Others can't write while there's a writer.
+        assert second.write(self.codec, self.items) is None
+        assert first.write(self.codec, self.items) == 1
+        first.release()
+        assert second.acquire()
+        second.release()
+
+    def test_touch(self, tmp_path):
+        writer = self.create(tmp_path)
+        reader = self.create(tmp_path)
+        assert reader.age() is None
+        assert writer.acquire()
+        writer.write(self.codec, self.items)
+        assert 0 <= reader.age() < 1
+        later = time.time() + 100
+        with patch.object(time, 'time', return_value=later):
+            assert reader.age() >= 99
+            reader.touch()
+            assert reader.age() >= 99
+            writer.touch()
+            assert reader.age() == 0
+        assert reader.version() == 1
+        writer.release()
+
+    def test_after_fork(self, tmp_path):
+        snapshot_file = self.create(tmp_path)
+        snapshot_file.acquire()
+        snapshot_file._after_fork()
+        assert not snapshot_file.is_writer
+        # In this process the lock was really released along with it.
+        assert self.create(tmp_path).acquire()
+
+    @pytest.mark.skipif(not hasattr(os, 'register_at_fork'),
+                        reason='requires os.fork')
+    def test_forked_worker_takes_over(self, tmp_path):
+        snapshot_file = get_snapshot_file(str(tmp_path / 'switches'))
+        assert snapshot_file.acquire()
+        pid = os.fork()
+        if pid == 0:  # pragma: nocover
+            os._exit(0 if snapshot_file.acquire() else 1)
+        _, status = os.waitpid(pid, 0)
+        assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+        assert not snapshot_file.is_writer
+        snapshot_file.release()
+
+    def test_shared_per_path(self, tmp_path):
+        path = str(tmp_path / 'switches')
+        assert get_snapshot_file(path) is get_snapshot_file(path)
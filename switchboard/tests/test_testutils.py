@@ -63,3 +63,24 @@ class TestSwitchContextManager:
             assert not self.operator.is_active('test')
 
         assert self.operator['test'].status == GLOBAL
+
+    def test_is_active_many(self):
+        self.operator['test'].status = DISABLED
+        switch = self.operator['other']
+        switch.status = GLOBAL
+        switch.save()
+
+        with switches(self.operator, test=True):
+            results = self.operator.is_active_many(['test', 'other'])
+            assert results == dict(test=True, other=True)
+
+        assert self.operator.is_active_many(['test']) == dict(test=False)
+
+    def test_is_active_many_patched_parent(self):
+        switch = self.operator['test:child']
+        switch.status = GLOBAL
+        switch.save()
+
+        with switches(self.operator, test=False):
+            results = self.operator.is_active_many(['test:child'])
+            assert results == {'test:child': False}
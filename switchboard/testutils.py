@@ -35,6 +35,7 @@ class SwitchContextManager:
     def __init__(self, operator=operator, **keys):
         self.operator = operator
         self.is_active_func = operator.is_active
+        self.is_active_many_func = operator.is_active_many
         self.keys = keys
         self._state = {}
         self._values = {
@@ -65,10 +66,38 @@ class SwitchContextManager:
                 return is_active_func(key, *args, **kwargs)
             return wrapped
 
+        def is_active_many(operator):
+            is_active_func = operator.is_active
+            is_active_many_func = operator.is_active_many
+
+            def wrapped(keys, *args, **kwargs):
+                results = {}
+                unpatched = []
+                for key in keys:
+                    if key in self.keys:
+                        results[key] = self.keys[key]
+                    elif self._has_patched_parent(key):
+                        # Let the patched is_active resolve the parents.
+                        results[key] = is_active_func(key, *args, **kwargs)
+                    else:
+                        unpatched.append(key)
+                if unpatched:
+                    results.update(is_active_many_func(unpatched, *args,
+                                                       **kwargs))
+                return {key: results[key] for key in keys}
+            return wrapped
+
         self.operator.is_active = is_active(self.operator)
+        self.operator.is_active_many = is_active_many(self.operator)
 
     def unpatch(self):
         self.operator.is_active = self.is_active_func
+        self.operator.is_active_many = self.is_active_many_func
+
+    def _has_patched_parent(self, key):
+        parts = key.split(':')
+        return any(':'.join(parts[:i]) in self.keys
+                   for i in range(1, len(parts)))
 
 
 switches = SwitchContextManager